@@ -1,115 +1,197 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, request, jsonify, render_template, make_response, after_this_request
 import sqlite3
 import re
 import secrets
 import hashlib
-from datetime import datetime, time as dt_time
+import csv
+import io
+from datetime import datetime, timedelta, timezone
 from functools import wraps
 import os
+import time
 import requests
 import pytz
-from threading import Thread
+import smtplib
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+from threading import BoundedSemaphore, Thread
+from concurrent.futures import ThreadPoolExecutor
+from rule_engine import RuleMatcher, decide, decision_cache, get_scoped_matcher
+from rule_profile import report as rule_stats_report, rule_profiler
+from regex_guard import COMPLEXITY_MODE, analyze_pattern, is_high_risk
+from rate_limit import RATE_LIMIT_ENABLED, admission, bucket_key, limiter, limits_for
+from idempotency import MAX_KEY_LENGTH, REPLAY_HEADERS, idempotency, request_hash, store_key
+from executor import EXECUTION_MODE, Executor, check_sandbox, mock_output
+from maintenance import MAINTENANCE_BACKUP_DIR, Maintenance, storage_jobs
+from output_store import iter_range, load_outputs, save_output
+from assets import assets
+from rule_sets import (CONFLICT_TEST_COMMANDS, TEAM_NAME, check_scope, export_document, find_conflicts, read_document,
+                       sample_matches, user_scopes, validate_rules)
+from response_cache import ResponseCache
+from change_watch import ChangeWatcher, LocalCache
+from storage import InsufficientCredits, IntegrityError, Table, create_storage
+from serialization import (CHUNK_ROWS, MIN_COMPRESS_BYTES, compress_body, compress_stream, encode_rows,
+                           iter_csv_rows, iter_encoded_rows, negotiate_encoding, select_fields)
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = secrets.token_hex(16)
 
-DATABASE = 'command_gateway.db'
+DATABASE = os.environ.get('DATABASE_PATH', 'command_gateway.db')
+# Largest CSV/JSON upload accepted by the bulk endpoints
+BULK_MAX_ROWS = int(os.environ.get('BULK_MAX_ROWS', 5000))
+# Credits a command costs: reserved while it waits for approval, captured when it runs
+CREDITS_PER_COMMAND = 1
+# Largest ?limit= accepted by the command and audit log lists
+LIST_MAX_ROWS = int(os.environ.get('LIST_MAX_ROWS', 5000))
+# Output streams following a running command, per process; each holds a request thread
+STREAM_FOLLOWERS = int(os.environ.get('STREAM_FOLLOWERS', 8))
+# How long one connection follows before it ends and the client resumes with ?offset=
+STREAM_FOLLOW_S = float(os.environ.get('STREAM_FOLLOW_S', 30))
+
+# All data access goes through the repository layer (STORAGE_BACKEND=sqlite|memory)
+storage = create_storage(path=DATABASE)
+
+# Templates link static files through asset_url() (fingerprinted; see assets.py)
+app.jinja_env.globals['asset_url'] = assets.url
 
 # Database initialization
 def init_db():
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    
-    # Users table
-    c.execute('''CREATE TABLE IF NOT EXISTS users
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  username TEXT UNIQUE NOT NULL,
-                  api_key TEXT UNIQUE NOT NULL,
-                  role TEXT NOT NULL CHECK(role IN ('admin', 'member')),
-                  tier TEXT DEFAULT 'junior' CHECK(tier IN ('junior', 'mid', 'senior', 'lead')),
-                  credits INTEGER DEFAULT 100,
-                  email TEXT,
-                  telegram_chat_id TEXT,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    
-    # Rules table
-    c.execute('''CREATE TABLE IF NOT EXISTS rules
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  pattern TEXT NOT NULL,
-                  action TEXT NOT NULL CHECK(action IN ('AUTO_ACCEPT', 'AUTO_REJECT', 'REQUIRE_APPROVAL')),
-                  description TEXT,
-                  approval_threshold INTEGER DEFAULT 1,
-                  time_start TEXT,
-                  time_end TEXT,
-                  timezone TEXT DEFAULT 'UTC',
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  created_by INTEGER,
-                  FOREIGN KEY(created_by) REFERENCES users(id))''')
-    
-    # Commands table
-    c.execute('''CREATE TABLE IF NOT EXISTS commands
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER NOT NULL,
-                  command_text TEXT NOT NULL,
-                  status TEXT NOT NULL CHECK(status IN ('pending', 'accepted', 'rejected', 'executed', 'approved')),
-                  matched_rule_id INTEGER,
-                  credits_deducted INTEGER DEFAULT 0,
-                  execution_output TEXT,
-                  approval_token TEXT,
-                  escalation_at TIMESTAMP,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  executed_at TIMESTAMP,
-                  FOREIGN KEY(user_id) REFERENCES users(id),
-                  FOREIGN KEY(matched_rule_id) REFERENCES rules(id))''')
-    
-    # Approval votes table
-    c.execute('''CREATE TABLE IF NOT EXISTS approval_votes
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  command_id INTEGER NOT NULL,
-                  approver_id INTEGER NOT NULL,
-                  vote TEXT NOT NULL CHECK(vote IN ('approve', 'reject')),
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY(command_id) REFERENCES commands(id),
-                  FOREIGN KEY(approver_id) REFERENCES users(id),
-                  UNIQUE(command_id, approver_id))''')
-    
-    # Audit log table
-    c.execute('''CREATE TABLE IF NOT EXISTS audit_logs
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER,
-                  action_type TEXT NOT NULL,
-                  details TEXT,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY(user_id) REFERENCES users(id))''')
-    
-    conn.commit()
-    conn.close()
-
-# Database helper functions
-def get_db():
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
-
-def execute_query(query, params=(), fetch_one=False, fetch_all=False):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(query, params)
-    if fetch_one:
-        result = c.fetchone()
-    elif fetch_all:
-        result = c.fetchall()
+    storage.init_schema()
+
+def rows_response(table):
+    """JSON array of a storage Table, encoded from its row tuples and honoring ?fields="""
+    try:
+        indexes = select_fields(request.args.get('fields'), table.columns)
+    except ValueError as e:
+        return jsonify({'error': str(e), 'fields': table.columns}), 400
+    
+    if len(table.rows) > CHUNK_ROWS:
+        return Response(iter_encoded_rows(table.rows, table.columns, indexes), mimetype='application/json')
+    return Response(encode_rows(table.rows, table.columns, indexes), mimetype='application/json')
+
+def delta_args(*names, default_limit=None):
+    """Delta sync parameters from the query string: since_id, updated_since and limit.
+
+    Only the names given are read. updated_since is an ISO timestamp (UTC when
+    it has no offset), normalized to the updated_at format so the storage
+    layer compares strings. Raises ValueError on bad values.
+    """
+    args = {}
+    if 'since_id' in names and request.args.get('since_id'):
+        value = request.args['since_id']
+        if not value.isdigit():
+            raise ValueError('since_id must be a non-negative integer')
+        args['since_id'] = int(value)
+    if 'updated_since' in names and request.args.get('updated_since'):
+        try:
+            moment = datetime.fromisoformat(request.args['updated_since'])
+        except ValueError:
+            raise ValueError('updated_since must be an ISO 8601 timestamp')
+        if moment.tzinfo is not None:
+            moment = moment.astimezone(pytz.utc).replace(tzinfo=None)
+        args['updated_since'] = moment.strftime('%Y-%m-%d %H:%M:%S.%f')[:23]
+    if 'limit' in names:
+        value = request.args.get('limit') or str(default_limit)
+        if not value.isdigit() or not 1 <= int(value) <= LIST_MAX_ROWS:
+            raise ValueError(f'limit must be between 1 and {LIST_MAX_ROWS}')
+        args['limit'] = int(value)
+    return args
+
+# Resource versions
+# Each cached list endpoint depends on one or more resources. Every mutation
+# bumps the affected versions in storage, so all workers agree. Before each
+# request the change watcher drops whatever this worker cached for resources
+# that moved since (see change_watch.py).
+response_cache = ResponseCache()
+# API key -> user for authentication, per worker (0 disables)
+USER_CACHE_ENTRIES = int(os.environ.get('USER_CACHE_ENTRIES', 1024))
+user_cache = LocalCache(USER_CACHE_ENTRIES)
+change_watcher = ChangeWatcher(storage.get_versions)
+change_watcher.on_change('users', user_cache.clear)
+for resource in ('users', 'rules', 'pending'):
+    change_watcher.on_change(resource, lambda resource=resource: response_cache.invalidate(resource))
+
+@app.before_request
+def check_for_changes():
+    """Bring this worker's caches up to date with changes committed by other workers"""
+    if request.endpoint not in ('static', 'serve_asset'):
+        change_watcher.check()
+
+def get_user_by_api_key(api_key):
+    """storage.get_user_by_api_key through the worker's user cache"""
+    user = user_cache.get(api_key)
+    if user is None:
+        generation = user_cache.generation()
+        user = storage.get_user_by_api_key(api_key)
+        if user is None:
+            return None
+        user_cache.put(api_key, user, generation)
+    return dict(user)
+
+def conditional_get(*resources):
+    """ETag/If-None-Match support plus an in-process cache keyed by resource versions"""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            versions = storage.get_versions(resources)
+            if versions is None:
+                return f(*args, **kwargs)
+            
+            # Query strings such as ?fields= select a different representation
+            variant = request.query_string.decode()
+            etag = f'"{f.__name__}-{"-".join(str(v) for v in versions)}'
+            if variant:
+                etag += '-' + hashlib.sha256(variant.encode()).hexdigest()[:8]
+            etag += '"'
+            # Weak comparison: compressed responses carry W/ tags
+            if etag in [tag.strip().removeprefix('W/') for tag in request.headers.get('If-None-Match', '').split(',')]:
+                response = make_response('', 304)
+            else:
+                key = (f.__name__, versions, variant)
+                cached = response_cache.get(key)
+                if cached is None:
+                    response = make_response(f(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    response_cache.put(key, (response.get_data(), response.mimetype), resources)
+                else:
+                    body, mimetype = cached
+                    response = make_response(body)
+                    response.mimetype = mimetype
+            response.headers['ETag'] = etag
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return decorated_function
+    return decorator
+
+@app.after_request
+def compress_response(response):
+    """gzip/deflate JSON bodies for clients that accept it"""
+    if response.mimetype != 'application/json' or response.status_code != 200:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding(request.accept_encodings)
+    if encoding is None or 'Content-Encoding' in response.headers:
+        return response
+    
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
     else:
-        result = None
-    conn.commit()
-    conn.close()
-    return result
+        data = response.get_data()
+        if len(data) < MIN_COMPRESS_BYTES:
+            return response
+        response.set_data(compress_body(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        response.headers['ETag'] = 'W/' + etag
+    return response
 
 # Authentication decorator
 def require_auth(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        api_key = request.headers.get('X-API-Key') or request.json.get('api_key') if request.is_json else None
+        api_key = request.headers.get('X-API-Key') or (request.json.get('api_key') if request.is_json else None)
         
         print(f"DEBUG: Headers: {dict(request.headers)}")
         print(f"DEBUG: API Key from headers: {api_key}")
@@ -119,21 +201,117 @@ def require_auth(f):
             print("DEBUG: No API key found")
             return jsonify({'error': 'API key required'}), 401
         
-        user = execute_query(
-            'SELECT * FROM users WHERE api_key = ?',
-            (api_key,),
-            fetch_one=True
-        )
+        user = get_user_by_api_key(api_key)
         
         print(f"DEBUG: User found: {user is not None}")
         
         if not user:
             return jsonify({'error': 'Invalid API key'}), 401
         
-        request.current_user = dict(user)
+        request.current_user = user
+        sync_rate_limit(request.current_user)
         return f(*args, **kwargs)
     return decorated_function
 
+def rate_limited(f):
+    """Shed load and enforce per-key token buckets before any auth or DB work"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not RATE_LIMIT_ENABLED:
+            return f(*args, **kwargs)
+        
+        rejection = admission.try_enter()
+        if rejection:
+            response = jsonify({'error': rejection})
+            response.status_code = 503
+            response.headers['Retry-After'] = '1'
+            return response
+        
+        try:
+            api_key = request.headers.get('X-API-Key') or (request.get_json(silent=True) or {}).get('api_key')
+            if api_key:
+                key = bucket_key(api_key)
+                try:
+                    allowed, retry_after, limits = limiter.consume(key)
+                except sqlite3.Error as e:
+                    # A broken limiter store must not take the gateway down
+                    print(f"[RATE LIMIT] Limiter unavailable, allowing request: {e}")
+                else:
+                    if not allowed:
+                        response = jsonify({'error': 'Rate limit exceeded', 'retry_after': retry_after})
+                        response.status_code = 429
+                        response.headers['Retry-After'] = str(retry_after)
+                        return response
+                    request.rate_limit = (key, limits)
+            return f(*args, **kwargs)
+        finally:
+            admission.leave()
+    return decorated_function
+
+def sync_rate_limit(user):
+    """Give a bucket its owner's role/tier limits once the key is authenticated"""
+    rate_limit = getattr(request, 'rate_limit', None)
+    if not rate_limit:
+        return
+    key, limits = rate_limit
+    desired = limits_for(user)
+    if limits != desired:
+        try:
+            limiter.set_limits(key, user['id'], *desired)
+        except sqlite3.Error as e:
+            print(f"[RATE LIMIT] Could not update limits: {e}")
+
+def idempotent(f):
+    """Replay the first response for a repeated Idempotency-Key header instead of running f again.
+
+    Goes inside require_auth: keys are scoped to the caller. Server errors,
+    429s and streamed bodies are not stored, so those requests can be retried.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        client_key = request.headers.get('Idempotency-Key')
+        if client_key is None:
+            return f(*args, **kwargs)
+        if not 0 < len(client_key) <= MAX_KEY_LENGTH:
+            return jsonify({'error': f'Idempotency-Key must be 1 to {MAX_KEY_LENGTH} characters'}), 400
+        
+        key = store_key(request.current_user['id'], request.method, request.path, client_key)
+        try:
+            outcome, found = idempotency.begin(key, request_hash(request.get_data()))
+        except sqlite3.Error as e:
+            # A broken key store must not take the gateway down
+            print(f"[IDEMPOTENCY] Store unavailable, running request without a key: {e}")
+            return f(*args, **kwargs)
+        
+        if outcome == 'replay':
+            response = Response(found['body'], status=found['status'], headers=found['headers'])
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+        if outcome == 'mismatch':
+            return jsonify({'error': 'Idempotency-Key was already used for a different request'}), 422
+        if outcome == 'busy':
+            response = jsonify({'error': 'A request with this Idempotency-Key is still in progress'})
+            response.status_code = 409
+            response.headers['Retry-After'] = '1'
+            return response
+        
+        claim = found
+        try:
+            response = make_response(f(*args, **kwargs))
+        except BaseException:
+            idempotency.release(key, claim)
+            raise
+        try:
+            if response.is_streamed or response.status_code >= 500 or response.status_code == 429:
+                idempotency.release(key, claim)
+            else:
+                headers = [(name, value) for name, value in response.headers if name in REPLAY_HEADERS]
+                idempotency.complete(key, claim, response.status_code, headers, response.get_data())
+        except sqlite3.Error as e:
+            print(f"[IDEMPOTENCY] Could not store response: {e}")
+        return response
+    return decorated_function
+
 def require_admin(f):
     @wraps(f)
     @require_auth
@@ -149,41 +327,93 @@ def generate_api_key():
 
 # Seed data
 def seed_data():
-    conn = get_db()
-    c = conn.cursor()
-    
-    # Check if admin exists
-    admin = c.execute('SELECT * FROM users WHERE role = ?', ('admin',)).fetchone()
-    if not admin:
-        api_key = generate_api_key()
-        c.execute('INSERT INTO users (username, api_key, role, credits) VALUES (?, ?, ?, ?)',
-                  ('admin', api_key, 'admin', 1000))
-        print(f"Default admin created with API key: {api_key}")
-        print("SAVE THIS API KEY - you'll need it to access the admin panel!")
-    
-    # Check if rules exist
-    rule_count = c.execute('SELECT COUNT(*) FROM rules').fetchone()[0]
-    if rule_count == 0:
-        starter_rules = [
-            (':\\(\\)\\{ :\\|:& \\};:', 'AUTO_REJECT', 'Fork bomb'),
-            ('rm\\s+-rf\\s+/', 'AUTO_REJECT', 'Dangerous rm command'),
-            ('mkfs\\.', 'AUTO_REJECT', 'Filesystem formatting'),
-            ('git\\s+(status|log|diff)', 'AUTO_ACCEPT', 'Safe git commands'),
-            ('^(ls|cat|pwd|echo)', 'AUTO_ACCEPT', 'Safe read commands'),
-        ]
-        admin_id = c.execute('SELECT id FROM users WHERE role = ?', ('admin',)).fetchone()[0]
-        for pattern, action, desc in starter_rules:
-            c.execute('INSERT INTO rules (pattern, action, description, created_by) VALUES (?, ?, ?, ?)',
-                      (pattern, action, desc, admin_id))
-    
-    conn.commit()
-    conn.close()
+    with storage.transaction():
+        # Check if admin exists
+        admins = storage.list_admins()
+        if not admins:
+            api_key = generate_api_key()
+            admin_id = storage.create_user('admin', api_key, 'admin', credits=1000)
+            print(f"Default admin created with API key: {api_key}")
+            print("SAVE THIS API KEY - you'll need it to access the admin panel!")
+        else:
+            admin_id = admins[0]['id']
+        
+        # Check if rules exist
+        if not len(storage.list_rules()):
+            starter_rules = [
+                (':\\(\\)\\{ :\\|:& \\};:', 'AUTO_REJECT', 'Fork bomb'),
+                ('rm\\s+-rf\\s+/', 'AUTO_REJECT', 'Dangerous rm command'),
+                ('mkfs\\.', 'AUTO_REJECT', 'Filesystem formatting'),
+                ('git\\s+(status|log|diff)', 'AUTO_ACCEPT', 'Safe git commands'),
+                ('^(ls|cat|pwd|echo)', 'AUTO_ACCEPT', 'Safe read commands'),
+            ]
+            for pattern, action, desc in starter_rules:
+                storage.create_rule(pattern, action, desc, created_by=admin_id)
+        
+        storage.bump_versions('users', 'rules', 'rules:global')
+
+def load_scoped_matcher(scopes):
+    """Compiled rules for these scopes, in order; only scopes edited since the last call are reloaded"""
+    versions = storage.get_versions(tuple(f'rules:{scope}' for scope in scopes))
+    return get_scoped_matcher(scopes, versions or [None] * len(scopes),
+                              lambda scope: storage.list_rules(scope).dicts())
+
+def warm_up():
+    """Pay first-request costs up front: rule compilation, timezone data, routing, templates"""
+    scopes = {'global'} | {rule['scope'] for rule in storage.list_rules().dicts()}
+    matcher = RuleMatcher.chain([load_scoped_matcher([scope]) for scope in sorted(scopes)])
+    matcher.window_state(datetime.now(pytz.utc))
+    # strptime imports and compiles its locale tables on first use
+    datetime.strptime('00:00', '%H:%M')
+    # Hash and compress static files before the index page links them
+    assets.build()
+    client = app.test_client()
+    client.get('/')
+    client.get('/api/health')
+    return matcher
+
+# Set once create_app() has run, in this process or the master it was forked from
+_created = False
+
+def create_app():
+    """One-time setup (schema, migrations, seed data) and warm-up; returns the WSGI app.
+
+    gunicorn.conf.py loads this once in the master with preload_app, so every
+    forked worker starts with the schema in place and warm caches. Later calls
+    (a forked worker's ASGI lifespan) do nothing.
+    """
+    global _created
+    if _created:
+        return app
+    start = datetime.now()
+    init_db()
+    seed_data()
+    matcher = warm_up()
+    if EXECUTION_MODE == 'sandbox':
+        # Refuses to start (SandboxUnavailable) if commands could read API keys from these
+        data_files = [storage.path, storage.audit_path] if storage.name == 'sqlite' else []
+        check_sandbox(data_files + [idempotency.path, limiter.path, maintenance.state_path, MAINTENANCE_BACKUP_DIR])
+    # Commands of dead processes (lease run out); other hosts' running ones are left alone
+    executor.recover()
+    # Workers must open their own database handles
+    storage.close()
+    elapsed = (datetime.now() - start).total_seconds() * 1000
+    print(f"[STARTUP] Ready in {elapsed:.0f}ms ({len(matcher)} rules compiled)")
+    _created = True
+    return app
+
+def worker_init():
+    """Per-worker setup after fork: nothing database-related is shared with the master"""
+    storage.close()
+    executor.start()
+    maintenance.start()
+    rule_profiler.start(storage)
 
 # Helper Functions for Bonus Features
 
-def check_rule_conflict(new_pattern, exclude_id=None):
-    """Check if a new rule pattern conflicts with existing rules"""
-    rules = execute_query('SELECT id, pattern FROM rules', fetch_all=True)
+def check_rule_conflict(new_pattern, exclude_id=None, scope='global'):
+    """Check if a new rule pattern conflicts with existing rules of its scope"""
+    rules = storage.list_rules(scope).dicts()
     conflicts = []
     
     for rule in rules:
@@ -196,17 +426,7 @@ def check_rule_conflict(new_pattern, exclude_id=None):
             pattern2 = re.compile(rule['pattern'])
             
             # Check if patterns overlap by testing common command patterns
-            test_commands = [
-                'ls -la',
-                'rm -rf /',
-                'git status',
-                'cat file.txt',
-                'echo hello',
-                'mkfs.ext4 /dev/sda',
-                ':(){ :|:& };:'
-            ]
-            
-            for cmd in test_commands:
+            for cmd in CONFLICT_TEST_COMMANDS:
                 match1 = bool(pattern1.search(cmd))
                 match2 = bool(pattern2.search(cmd))
                 if match1 and match2:
@@ -221,31 +441,6 @@ def check_rule_conflict(new_pattern, exclude_id=None):
     
     return conflicts
 
-def evaluate_time_based_rule(rule):
-    """Evaluate if a time-based rule should apply based on current time"""
-    # Convert sqlite3.Row to dict if needed
-    rule_dict = dict(rule) if hasattr(rule, 'keys') else rule
-    
-    if not rule_dict.get('time_start') or not rule_dict.get('time_end'):
-        return True  # No time restriction, always applies
-    
-    try:
-        tz = pytz.timezone(rule_dict.get('timezone', 'UTC'))
-        now = datetime.now(tz)
-        current_time = now.time()
-        
-        time_start = datetime.strptime(rule_dict['time_start'], '%H:%M').time()
-        time_end = datetime.strptime(rule_dict['time_end'], '%H:%M').time()
-        
-        if time_start <= time_end:
-            # Same day window
-            return time_start <= current_time <= time_end
-        else:
-            # Overnight window
-            return current_time >= time_start or current_time <= time_end
-    except:
-        return True  # Default to applying if time parsing fails
-
 def get_user_tier_threshold(user_tier):
     """Get approval threshold based on user tier"""
     thresholds = {
@@ -276,10 +471,6 @@ def send_telegram_notification(chat_id, message, bot_token=None):
 def send_email_notification(email, subject, message, smtp_config=None):
     """Send email notification using SMTP"""
     try:
-        import smtplib
-        from email.mime.text import MIMEText
-        from email.mime.multipart import MIMEMultipart
-        
         # Get SMTP configuration from environment variables
         smtp_server = os.environ.get('SMTP_SERVER', 'smtp.gmail.com')
         smtp_port = int(os.environ.get('SMTP_PORT', 587))
@@ -317,13 +508,79 @@ def send_email_notification(email, subject, message, smtp_config=None):
         print(f"[EMAIL] Failed to send to {email}: {str(e)}")
         return False
 
+# Notifications go through a small bounded pool so SMTP/Telegram latency never
+# holds a request thread or piles up one thread per pending command
+NOTIFY_WORKERS = int(os.environ.get('NOTIFY_WORKERS', 4))
+notifier = ThreadPoolExecutor(max_workers=NOTIFY_WORKERS, thread_name_prefix='notify')
+# Slots for ?follow streams of running commands (see stream_command_output)
+stream_followers = BoundedSemaphore(STREAM_FOLLOWERS)
+
+# Accepted commands run here when EXECUTION_MODE=sandbox (see executor.py)
+executor = Executor(storage)
+# Backups, ANALYZE, checkpoints, vacuum and credit reconciliation, in whichever
+# worker holds the lease (see maintenance.py)
+maintenance = Maintenance([storage.path, storage.audit_path] if storage.name == 'sqlite' else [],
+                          jobs=storage_jobs(storage))
+
+def accepted_command_fields(command_text):
+    """Command columns for an accepted command: mocked now, or queued for the executor.
+
+    Call inside the transaction that writes the command, since a mocked output
+    is stored in the blob store here.
+    """
+    if EXECUTION_MODE == 'sandbox':
+        return {'status': 'accepted', 'execution_status': 'queued'}
+    output = mock_output(command_text)
+    return dict(save_output(storage, output), status='executed', executed_at=datetime.now(), output=output)
+
+def insufficient_credits_response(user, command_text):
+    """Record a command refused because the user's spendable credits do not cover it"""
+    with storage.transaction():
+        storage.create_command(user['id'], command_text, 'rejected')
+        storage.add_audit(user['id'], 'command_rejected', f'Command rejected: insufficient credits - {command_text}')
+    current = storage.get_user(user['id'])
+    return jsonify({
+        'status': 'rejected',
+        'reason': 'Insufficient credits',
+        'credits': current['credits'] if current else 0
+    }), 200
+
+def queue_full_response():
+    """503 while the execution queue is at its limit, else None"""
+    if EXECUTION_MODE != 'sandbox' or not executor.queue_full():
+        return None
+    response = jsonify({'error': 'Execution queue is full, try again shortly'})
+    response.status_code = 503
+    response.headers['Retry-After'] = '5'
+    return response
+
+def accepted_response(command_id, fields, credits_cost, new_balance):
+    """Response for an accepted command; a queued one is handed to the executor once committed"""
+    if fields['status'] == 'executed':
+        return jsonify({
+            'status': 'executed',
+            'command_id': command_id,
+            'credits_deducted': credits_cost,
+            'new_balance': new_balance,
+            'output': fields['output']
+        }), 200
+    
+    @after_this_request
+    def wake_executor(response):
+        executor.notify()
+        return response
+    
+    return jsonify({
+        'status': 'accepted',
+        'command_id': command_id,
+        'credits_deducted': credits_cost,
+        'new_balance': new_balance,
+        'output_url': f'/api/commands/{command_id}/output'
+    }), 202
+
 def notify_approvers(command_id, command_text, user_name, approvers_needed):
     """Notify approvers about a pending command"""
-    admins = execute_query(
-        'SELECT id, username, email, telegram_chat_id FROM users WHERE role = ?',
-        ('admin',),
-        fetch_all=True
-    )
+    admins = storage.list_admins()
     
     message = f"🔔 <b>Approval Required</b>\n\n"
     message += f"User: {user_name}\n"
@@ -346,31 +603,17 @@ def notify_approvers(command_id, command_text, user_name, approvers_needed):
 
 def check_approval_status(command_id):
     """Check if command has enough approvals"""
-    command = execute_query(
-        'SELECT * FROM commands WHERE id = ?',
-        (command_id,),
-        fetch_one=True
-    )
+    command = storage.get_command(command_id)
     
     if not command:
         return False
     
-    command = dict(command)
     rule = None
     if command['matched_rule_id']:
-        rule = execute_query(
-            'SELECT * FROM rules WHERE id = ?',
-            (command['matched_rule_id'],),
-            fetch_one=True
-        )
-        rule = dict(rule) if rule else None
+        rule = storage.get_rule(command['matched_rule_id'])
     
     # Get threshold
-    user = execute_query(
-        'SELECT tier FROM users WHERE id = ?',
-        (command['user_id'],),
-        fetch_one=True
-    )
+    user = storage.get_user(command['user_id'])
     
     if rule and rule.get('approval_threshold'):
         threshold = rule['approval_threshold']
@@ -380,39 +623,23 @@ def check_approval_status(command_id):
         threshold = 1
     
     # Count approvals
-    approvals = execute_query(
-        'SELECT COUNT(*) FROM approval_votes WHERE command_id = ? AND vote = ?',
-        (command_id, 'approve'),
-        fetch_one=True
-    )
-    
-    return approvals[0] >= threshold if approvals else False
+    return storage.count_votes(command_id, 'approve') >= threshold
 
 def escalate_command(command_id):
     """Escalate command to all admins"""
-    command = execute_query(
-        'SELECT c.*, u.username FROM commands c JOIN users u ON c.user_id = u.id WHERE c.id = ?',
-        (command_id,),
-        fetch_one=True
-    )
+    command = storage.get_command(command_id)
+    user = storage.get_user(command['user_id']) if command else None
     
-    if not command:
+    if not command or not user:
         return
     
-    command = dict(command)
+    command['username'] = user['username']
     
     # Update escalation time
-    execute_query(
-        'UPDATE commands SET escalation_at = ? WHERE id = ?',
-        (datetime.now(), command_id)
-    )
+    storage.set_escalation(command_id, datetime.now())
     
     # Notify all admins
-    admins = execute_query(
-        'SELECT email, telegram_chat_id FROM users WHERE role = ?',
-        ('admin',),
-        fetch_all=True
-    )
+    admins = storage.list_admins()
     
     message = f"🚨 <b>ESCALATION: Command Pending Approval</b>\n\n"
     message += f"User: {command['username']}\n"
@@ -438,6 +665,17 @@ def escalate_command(command_id):
 def index():
     return render_template('index.html')
 
+@app.route('/assets/<path:name>')
+def serve_asset(name):
+    """Fingerprinted static file from memory, in the best encoding the client accepts"""
+    found = assets.get(name, request.accept_encodings)
+    if found is None:
+        return jsonify({'error': 'Asset not found'}), 404
+    body, headers = found
+    if request.if_none_match.contains(headers['ETag'].strip('"')):
+        return Response(status=304, headers={k: v for k, v in headers.items() if k != 'Content-Encoding'})
+    return Response(body, headers=headers)
+
 @app.route('/api/health', methods=['GET'])
 def health():
     return jsonify({'status': 'ok'})
@@ -450,7 +688,8 @@ def get_current_user():
         'id': user['id'],
         'username': user['username'],
         'role': user['role'],
-        'credits': user['credits']
+        'credits': user['credits'],
+        'credits_reserved': user['credits_reserved']
     })
 
 @app.route('/api/users', methods=['POST'])
@@ -463,6 +702,7 @@ def create_user():
     tier = data.get('tier', 'junior')
     email = data.get('email', '')
     telegram_chat_id = data.get('telegram_chat_id', '')
+    team = data.get('team') or None
     
     if not username:
         return jsonify({'error': 'Username required'}), 400
@@ -473,20 +713,19 @@ def create_user():
     if tier not in ['junior', 'mid', 'senior', 'lead']:
         return jsonify({'error': 'Invalid tier'}), 400
     
+    if team and not (isinstance(team, str) and TEAM_NAME.match(team)):
+        return jsonify({'error': 'Invalid team name'}), 400
+    
     api_key = generate_api_key()
     
     try:
-        execute_query(
-            'INSERT INTO users (username, api_key, role, credits, tier, email, telegram_chat_id) VALUES (?, ?, ?, ?, ?, ?, ?)',
-            (username, api_key, role, initial_credits, tier, email, telegram_chat_id)
-        )
-        
-        # Log action
-        user_id = request.current_user['id']
-        execute_query(
-            'INSERT INTO audit_logs (user_id, action_type, details) VALUES (?, ?, ?)',
-            (user_id, 'user_created', f'Created user: {username} with role: {role}')
-        )
+        with storage.transaction():
+            storage.create_user(username, api_key, role, initial_credits, tier, email, telegram_chat_id, team)
+            storage.bump_versions('users')
+            
+            # Log action
+            user_id = request.current_user['id']
+            storage.add_audit(user_id, 'user_created', f'Created user: {username} with role: {role}')
         
         return jsonify({
             'message': 'User created successfully',
@@ -495,16 +734,19 @@ def create_user():
             'role': role,
             'credits': initial_credits
         }), 201
-    except sqlite3.IntegrityError:
+    except IntegrityError:
         return jsonify({'error': 'Username already exists'}), 400
 
 @app.route('/api/users', methods=['GET'])
 @require_admin
+@conditional_get('users')
 def list_users():
     print("DEBUG: list_users route called")
-    users = execute_query('SELECT id, username, role, credits, tier, email, telegram_chat_id, created_at FROM users', fetch_all=True)
-    print(f"DEBUG: Found {len(users) if users else 0} users")
-    return jsonify([dict(u) for u in users])
+    try:
+        args = delta_args('updated_since')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return rows_response(storage.list_users(**args))
 
 @app.route('/api/users/<int:user_id>/credits', methods=['PUT'])
 @require_admin
@@ -515,83 +757,237 @@ def update_user_credits(user_id):
     if credits is None or credits < 0:
         return jsonify({'error': 'Valid credits amount required'}), 400
     
-    execute_query(
-        'UPDATE users SET credits = ? WHERE id = ?',
-        (credits, user_id)
-    )
-    
-    # Log action
     admin_id = request.current_user['id']
-    execute_query(
-        'INSERT INTO audit_logs (user_id, action_type, details) VALUES (?, ?, ?)',
-        (admin_id, 'credits_updated', f'Updated credits for user {user_id} to {credits}')
-    )
+    with storage.transaction():
+        storage.update_user(user_id, {'credits': credits}, actor_id=admin_id)
+        storage.bump_versions('users')
+        
+        # Log action
+        storage.add_audit(admin_id, 'credits_updated', f'Updated credits for user {user_id} to {credits}')
     
     return jsonify({'message': 'Credits updated successfully'})
 
+# Bulk provisioning
+
+BULK_USER_COLUMNS = ('id', 'username', 'api_key', 'role', 'tier', 'credits')
+
+def read_bulk_rows(key):
+    """Rows of a bulk upload as dicts: a text/csv body, or a JSON list (bare or under key)"""
+    if request.mimetype == 'text/csv':
+        reader = csv.DictReader(io.StringIO(request.get_data(as_text=True)))
+        # Blank cells count as missing so defaults apply
+        return [{k.strip(): v.strip() for k, v in row.items() if k and isinstance(v, str) and v.strip()}
+                for row in reader]
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        data = data.get(key)
+    if not isinstance(data, list) or not all(isinstance(row, dict) for row in data):
+        raise ValueError(f'Expected a text/csv body or a JSON list of objects (optionally under "{key}")')
+    return data
+
+def check_bulk_size(rows):
+    """Error response for an empty or oversized upload, else None"""
+    if not rows:
+        return jsonify({'error': 'No rows in upload'}), 400
+    if len(rows) > BULK_MAX_ROWS:
+        return jsonify({'error': f'At most {BULK_MAX_ROWS} rows per upload'}), 413
+    return None
+
+def parse_credits(value):
+    """Non-negative whole number of credits from a JSON or CSV value"""
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError('Credits must be a non-negative whole number')
+    try:
+        amount = int(value)
+    except ValueError:
+        raise ValueError('Credits must be a non-negative whole number')
+    if amount < 0:
+        raise ValueError('Credits must be a non-negative whole number')
+    return amount
+
+def summarize_names(names, limit=20):
+    """Comma-separated names for an audit entry, truncated after limit"""
+    shown = ', '.join(str(name) for name in names[:limit])
+    if len(names) > limit:
+        shown += f' (+{len(names) - limit} more)'
+    return shown
+
+@app.route('/api/users/bulk', methods=['POST'])
+@require_admin
+def bulk_create_users():
+    """Create users from a CSV or JSON upload: all rows are validated, then inserted in one transaction"""
+    try:
+        uploaded = read_bulk_rows('users')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    rejection = check_bulk_size(uploaded)
+    if rejection:
+        return rejection
+    
+    rows = []
+    errors = []
+    seen = set()
+    for number, item in enumerate(uploaded, 1):
+        username = str(item.get('username') or '').strip()
+        role = item.get('role') or 'member'
+        tier = item.get('tier') or 'junior'
+        team = item.get('team') or None
+        if isinstance(team, str):
+            team = team.strip() or None
+        error = None
+        if not username:
+            error = 'Username required'
+        elif username in seen:
+            error = 'Duplicate username in upload'
+        elif role not in ['admin', 'member']:
+            error = 'Invalid role'
+        elif tier not in ['junior', 'mid', 'senior', 'lead']:
+            error = 'Invalid tier'
+        elif team and not (isinstance(team, str) and TEAM_NAME.match(team)):
+            error = 'Invalid team name'
+        else:
+            try:
+                credits = parse_credits(item.get('credits', 100))
+            except ValueError as e:
+                error = str(e)
+        seen.add(username)
+        if error:
+            errors.append({'row': number, 'username': username, 'error': error})
+        elif not errors:
+            rows.append((username, generate_api_key(), role, credits, tier,
+                         item.get('email') or '', item.get('telegram_chat_id') or '', team))
+    
+    if not errors:
+        usernames = [row[0] for row in rows]
+        with storage.transaction():
+            # Checked under the write lock so no concurrent request can take a name
+            taken = storage.user_ids_by_username(usernames)
+            if taken:
+                errors = [{'row': number, 'username': username, 'error': 'Username already exists'}
+                          for number, username in enumerate(usernames, 1) if username in taken]
+            else:
+                storage.create_users(rows)
+                ids = storage.user_ids_by_username(usernames)
+                storage.bump_versions('users')
+                storage.add_audit(request.current_user['id'], 'users_bulk_created',
+                                  f'Bulk created {len(rows)} users: {summarize_names(usernames)}')
+    if errors:
+        return jsonify({'error': 'Validation failed, no users were created', 'errors': errors}), 400
+    
+    created = [(ids[username], username, api_key, role, tier, credits)
+               for username, api_key, role, credits, tier, _, _, _ in rows]
+    if request.accept_mimetypes.best_match(['application/json', 'text/csv']) == 'text/csv':
+        response = Response(iter_csv_rows(created, BULK_USER_COLUMNS), status=201, mimetype='text/csv')
+    else:
+        response = Response(iter_encoded_rows(created, BULK_USER_COLUMNS, list(range(len(BULK_USER_COLUMNS)))),
+                            status=201, mimetype='application/json')
+    # The body holds API keys
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/api/users/credits', methods=['PUT'])
+@require_admin
+def bulk_update_credits():
+    """Set (or with mode=add, top up) credits for many users in one transaction"""
+    body = request.get_json(silent=True)
+    mode = request.args.get('mode') or (body.get('mode') if isinstance(body, dict) else None) or 'set'
+    if mode not in ['set', 'add']:
+        return jsonify({'error': 'Mode must be "set" or "add"'}), 400
+    try:
+        uploaded = read_bulk_rows('users')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    rejection = check_bulk_size(uploaded)
+    if rejection:
+        return rejection
+    
+    entries = []
+    errors = []
+    for number, item in enumerate(uploaded, 1):
+        user_id = item.get('user_id')
+        username = item.get('username')
+        try:
+            amount = parse_credits(item.get('credits'))
+        except ValueError as e:
+            errors.append({'row': number, 'error': str(e)})
+            continue
+        if isinstance(user_id, str) and user_id.isdigit():
+            user_id = int(user_id)
+        if user_id is not None and (isinstance(user_id, bool) or not isinstance(user_id, int)):
+            errors.append({'row': number, 'error': 'Invalid user_id'})
+            continue
+        if user_id is None and not username:
+            errors.append({'row': number, 'error': 'user_id or username required'})
+            continue
+        entries.append((number, user_id, username, amount))
+    
+    if not errors:
+        with storage.transaction():
+            by_name = storage.user_ids_by_username([e[2] for e in entries if e[1] is None])
+            known = storage.existing_user_ids([e[1] for e in entries if e[1] is not None])
+            changes = []
+            targets = []
+            seen = set()
+            for number, user_id, username, amount in entries:
+                target = username or user_id
+                if user_id is None:
+                    user_id = by_name.get(username)
+                elif user_id not in known:
+                    user_id = None
+                if user_id is None:
+                    errors.append({'row': number, 'error': f'Unknown user: {target}'})
+                elif user_id in seen:
+                    errors.append({'row': number, 'error': f'User {target} appears more than once'})
+                else:
+                    seen.add(user_id)
+                    changes.append((user_id, amount))
+                    targets.append(target)
+            if not errors:
+                storage.update_credits(changes, add=(mode == 'add'), actor_id=request.current_user['id'])
+                storage.bump_versions('users')
+                verb = 'Added' if mode == 'add' else 'Set'
+                storage.add_audit(request.current_user['id'], 'credits_bulk_updated',
+                                  f'{verb} credits for {len(changes)} users: {summarize_names(targets)}')
+    if errors:
+        return jsonify({'error': 'Validation failed, no credits were changed', 'errors': errors}), 400
+    
+    return jsonify({'message': 'Credits updated successfully', 'mode': mode, 'updated': len(changes)})
+
 @app.route('/api/users/<int:user_id>', methods=['DELETE'])
 @require_admin
 def delete_user(user_id):
     current_admin = request.current_user
     
     # Get user to delete
-    user = execute_query(
-        'SELECT * FROM users WHERE id = ?',
-        (user_id,),
-        fetch_one=True
-    )
+    user = storage.get_user(user_id)
     
     if not user:
         return jsonify({'error': 'User not found'}), 404
     
-    user = dict(user)
-    
     # Prevent deleting yourself
     if user_id == current_admin['id']:
         return jsonify({'error': 'You cannot delete your own account'}), 400
     
     # Prevent deleting the last admin
     if user['role'] == 'admin':
-        admin_count = execute_query(
-            'SELECT COUNT(*) FROM users WHERE role = ?',
-            ('admin',),
-            fetch_one=True
-        )[0]
-        if admin_count <= 1:
+        if len(storage.list_admins()) <= 1:
             return jsonify({'error': 'Cannot delete the last admin'}), 400
     
-    # Delete related records first (for data integrity)
-    # Delete commands by this user
-    execute_query(
-        'DELETE FROM commands WHERE user_id = ?',
-        (user_id,)
-    )
-    
-    # Set audit log user_id to NULL for this user's actions (keep audit trail)
-    execute_query(
-        'UPDATE audit_logs SET user_id = NULL WHERE user_id = ?',
-        (user_id,)
-    )
-    
-    # Delete user
-    execute_query(
-        'DELETE FROM users WHERE id = ?',
-        (user_id,)
-    )
-    
-    # Log action
-    execute_query(
-        'INSERT INTO audit_logs (user_id, action_type, details) VALUES (?, ?, ?)',
-        (current_admin['id'], 'user_deleted', f'Deleted user: {user["username"]} (ID: {user_id})')
-    )
+    with storage.transaction():
+        # Deletes the user's commands and keeps their audit trail with user_id NULL
+        storage.delete_user(user_id)
+        storage.bump_versions('users', 'pending')
+        
+        # Log action
+        storage.add_audit(current_admin['id'], 'user_deleted', f'Deleted user: {user["username"]} (ID: {user_id})')
     
     return jsonify({'message': 'User deleted successfully'})
 
 @app.route('/api/rules', methods=['GET'])
 @require_admin
+@conditional_get('rules')
 def list_rules():
-    rules = execute_query('SELECT * FROM rules ORDER BY id', fetch_all=True)
-    return jsonify([dict(r) for r in rules])
+    return rows_response(storage.list_rules(request.args.get('scope') or None))
 
 @app.route('/api/rules', methods=['POST'])
 @require_admin
@@ -604,6 +1000,7 @@ def create_rule():
     time_start = data.get('time_start', '')
     time_end = data.get('time_end', '')
     timezone = data.get('timezone', 'UTC')
+    scope = data.get('scope') or 'global'
     
     if not pattern or not action:
         return jsonify({'error': 'Pattern and action required'}), 400
@@ -611,14 +1008,27 @@ def create_rule():
     if action not in ['AUTO_ACCEPT', 'AUTO_REJECT', 'REQUIRE_APPROVAL']:
         return jsonify({'error': 'Invalid action'}), 400
     
+    try:
+        check_scope(scope)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
     # Validate regex pattern
     try:
         re.compile(pattern)
     except re.error as e:
         return jsonify({'error': f'Invalid regex pattern: {str(e)}'}), 400
     
+    # Reject patterns prone to catastrophic backtracking (ReDoS)
+    complexity = analyze_pattern(pattern)
+    if is_high_risk(complexity) and COMPLEXITY_MODE == 'reject':
+        return jsonify({
+            'error': 'Pattern is vulnerable to catastrophic backtracking',
+            'complexity': complexity
+        }), 400
+    
     # Check for rule conflicts
-    conflicts = check_rule_conflict(pattern)
+    conflicts = check_rule_conflict(pattern, scope=scope)
     if conflicts:
         return jsonify({
             'error': 'Rule conflicts with existing rules',
@@ -638,37 +1048,166 @@ def create_rule():
     user_id = request.current_user['id']
     
     try:
-        execute_query(
-            'INSERT INTO rules (pattern, action, description, approval_threshold, time_start, time_end, timezone, created_by) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
-            (pattern, action, description, approval_threshold, time_start, time_end, timezone, user_id)
-        )
-        
-        # Log action
-        execute_query(
-            'INSERT INTO audit_logs (user_id, action_type, details) VALUES (?, ?, ?)',
-            (user_id, 'rule_created', f'Created rule: {pattern} -> {action}')
-        )
+        with storage.transaction():
+            storage.create_rule(pattern, action, description, approval_threshold, time_start, time_end, timezone, user_id,
+                                scope)
+            # Only this scope's matchers recompile
+            storage.bump_versions('rules', f'rules:{scope}')
+            
+            # Log action
+            details = f'Created rule: {pattern} -> {action}'
+            if scope != 'global':
+                details += f' [{scope}]'
+            if complexity:
+                details += f' (flagged: {", ".join(i["type"] for i in complexity)})'
+            storage.add_audit(user_id, 'rule_created', details)
         
-        return jsonify({'message': 'Rule created successfully'}), 201
+        response = {'message': 'Rule created successfully'}
+        if complexity:
+            response['warnings'] = complexity
+        return jsonify(response), 201
     except Exception as e:
         return jsonify({'error': str(e)}), 400
 
 @app.route('/api/rules/<int:rule_id>', methods=['DELETE'])
 @require_admin
 def delete_rule(rule_id):
-    execute_query('DELETE FROM rules WHERE id = ?', (rule_id,))
-    
-    # Log action
-    user_id = request.current_user['id']
-    execute_query(
-        'INSERT INTO audit_logs (user_id, action_type, details) VALUES (?, ?, ?)',
-        (user_id, 'rule_deleted', f'Deleted rule {rule_id}')
-    )
+    with storage.transaction():
+        rule = storage.get_rule(rule_id)
+        storage.delete_rule(rule_id)
+        if rule:
+            storage.bump_versions('rules', f"rules:{rule['scope']}")
+        
+        # Log action
+        user_id = request.current_user['id']
+        storage.add_audit(user_id, 'rule_deleted', f'Deleted rule {rule_id}')
     
     return jsonify({'message': 'Rule deleted successfully'})
 
+@app.route('/api/rules/export', methods=['GET'])
+@require_admin
+def export_rules():
+    """The whole rule set as a versioned JSON document, the input format of /api/rules/import"""
+    # Rules and version are read under one lock so they describe the same rule set
+    with storage.transaction():
+        versions = storage.get_versions(('rules',))
+        rules = storage.list_rules().dicts()
+    return jsonify(export_document(rules, versions[0] if versions else None))
+
+@app.route('/api/rules/import', methods=['POST'])
+@require_admin
+def import_rules():
+    """Validate a rule-set document as a whole and apply it atomically.
+
+    mode=merge (default) updates rules with the same scope and pattern in
+    place and appends new ones; mode=replace swaps the entire rule set. Either
+    way each affected scope's version is bumped once, so every worker reloads
+    those scopes' rules once.
+    """
+    document = request.get_json(silent=True)
+    try:
+        imported = read_document(document)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    rejection = check_bulk_size(imported)
+    if rejection:
+        return rejection
+    
+    def flag(name):
+        # Options may come in the query string or the document itself
+        return request.args.get(name, document.get(name)) in (True, '1', 'true')
+    mode = request.args.get('mode', document.get('mode')) or 'merge'
+    if mode not in ['merge', 'replace']:
+        return jsonify({'error': 'Mode must be "merge" or "replace"'}), 400
+    
+    # Patterns, actions, time windows and timezones, in a process pool for large sets
+    results = validate_rules(imported)
+    errors = []
+    positions = {}
+    for index, result in enumerate(results):
+        pattern = result['rule']['pattern'] if result['rule'] else None
+        key = (result['rule']['scope'], pattern) if result['rule'] else None
+        if result['errors']:
+            errors.append({'index': index, 'pattern': pattern, 'errors': result['errors']})
+        elif key in positions:
+            errors.append({'index': index, 'pattern': pattern,
+                           'errors': [f'Duplicate pattern in scope {key[0]} (also at index {positions[key]})']})
+        else:
+            positions[key] = index
+    if errors:
+        return jsonify({'error': 'Validation failed, no rules were changed', 'errors': errors}), 400
+    warnings = [{'index': index, 'pattern': result['rule']['pattern'], 'warnings': result['warnings']}
+                for index, result in enumerate(results) if result['warnings']]
+    
+    user_id = request.current_user['id']
+    with storage.transaction():
+        versions = storage.get_versions(('rules',))
+        current_version = versions[0] if versions else None
+        expected_version = document.get('expected_version')
+        if expected_version is not None and expected_version != current_version:
+            return jsonify({'error': 'Rule set changed since it was exported',
+                            'rule_set_version': current_version}), 409
+        
+        existing = storage.list_rules().dicts()
+        kept = [] if mode == 'replace' else [r for r in existing if (r['scope'], r['pattern']) not in positions]
+        # One pass over each scope's set instead of one per rule; across scopes, precedence decides
+        conflicts = []
+        for scope in sorted({r['rule']['scope'] for r in results}):
+            found = find_conflicts([(r['rule']['pattern'], r['samples']) for r in results if r['rule']['scope'] == scope],
+                                   [(r['pattern'], sample_matches(r['pattern'])) for r in kept if r['scope'] == scope])
+            conflicts.extend(dict(conflict, scope=scope) for conflict in found)
+        if conflicts and not flag('allow_conflicts'):
+            return jsonify({'error': 'Rule set has conflicting rules', 'conflicts': conflicts}), 400
+        
+        updates = []
+        creates = []
+        if mode == 'merge':
+            ids_by_key = {}
+            for rule in existing:
+                ids_by_key.setdefault((rule['scope'], rule['pattern']), []).append(rule['id'])
+        for result in results:
+            rule = result['rule']
+            key = (rule['scope'], rule['pattern'])
+            values = (rule['action'], rule['description'], rule['approval_threshold'],
+                      rule['time_start'], rule['time_end'], rule['timezone'])
+            if mode == 'merge' and key in ids_by_key:
+                updates.extend((rule_id,) + values for rule_id in ids_by_key[key])
+            else:
+                creates.append((rule['pattern'],) + values + (user_id, rule['scope']))
+        summary = {
+            'mode': mode,
+            'created': len(creates),
+            'updated': len(updates),
+            'deleted': len(existing) if mode == 'replace' else 0,
+            'warnings': warnings,
+            'conflicts': conflicts,
+        }
+        
+        if flag('dry_run'):
+            summary['dry_run'] = True
+            summary['rule_set_version'] = current_version
+            return jsonify(summary)
+        
+        if mode == 'replace':
+            storage.delete_all_rules()
+        storage.update_rules(updates)
+        storage.create_rules(creates)
+        scopes = {r['rule']['scope'] for r in results}
+        if mode == 'replace':
+            scopes |= {r['scope'] for r in existing}
+        storage.bump_versions('rules', *sorted(f'rules:{scope}' for scope in scopes))
+        storage.add_audit(user_id, 'rules_imported',
+                          f'Imported {len(imported)} rules ({mode}): {summary["created"]} created, '
+                          f'{summary["updated"]} updated, {summary["deleted"]} deleted')
+        versions = storage.get_versions(('rules',))
+    
+    summary['rule_set_version'] = versions[0] if versions else None
+    return jsonify(summary)
+
 @app.route('/api/commands', methods=['POST'])
+@rate_limited
 @require_auth
+@idempotent
 def submit_command():
     data = request.json
     command_text = data.get('command_text', '').strip()
@@ -679,83 +1218,55 @@ def submit_command():
     user = request.current_user
     
     # Refresh user credits from database to ensure latest balance
-    user_db = execute_query(
-        'SELECT * FROM users WHERE id = ?',
-        (user['id'],),
-        fetch_one=True
-    )
-    if not user_db:
+    user = storage.get_user(user['id'])
+    if not user:
         return jsonify({'error': 'User not found'}), 404
-    user = dict(user_db)
-    
-    # Check credits
-    if user['credits'] <= 0:
-        execute_query(
-            'INSERT INTO commands (user_id, command_text, status) VALUES (?, ?, ?)',
-            (user['id'], command_text, 'rejected')
-        )
-        execute_query(
-            'INSERT INTO audit_logs (user_id, action_type, details) VALUES (?, ?, ?)',
-            (user['id'], 'command_rejected', f'Command rejected: insufficient credits - {command_text}')
-        )
-        return jsonify({
-            'status': 'rejected',
-            'reason': 'Insufficient credits',
-            'credits': user['credits']
-        }), 200
     
-    # Check if this is a resubmission with approval token
+    # A resubmission with an approval token spends the credit reserved at submission
     approval_token = data.get('approval_token')
-    if approval_token:
-        pending_command = execute_query(
-            'SELECT * FROM commands WHERE approval_token = ? AND status = ?',
-            (approval_token, 'approved'),
-            fetch_one=True
-        )
-        if pending_command:
-            pending_command = dict(pending_command)
-            # Execute the approved command
-            credits_cost = 1
-            new_balance = user['credits'] - credits_cost
-            
-            conn = get_db()
-            c = conn.cursor()
-            c.execute('UPDATE users SET credits = ? WHERE id = ?', (new_balance, user['id']))
-            c.execute(
-                'UPDATE commands SET status = ?, credits_deducted = ?, execution_output = ?, executed_at = ? WHERE id = ?',
-                ('executed', credits_cost, f'[MOCKED] Executed: {command_text}', datetime.now(), pending_command['id'])
-            )
-            c.execute(
-                'INSERT INTO audit_logs (user_id, action_type, details) VALUES (?, ?, ?)',
-                (user['id'], 'command_executed', f'Command executed after approval: {command_text}')
-            )
-            conn.commit()
-            conn.close()
-            
-            return jsonify({
-                'status': 'executed',
-                'command_id': pending_command['id'],
-                'credits_deducted': credits_cost,
-                'new_balance': new_balance,
-                'output': f'[MOCKED] Executed: {command_text}'
-            }), 200
-    
-    # Match against rules (first match wins, considering time-based rules)
-    rules = execute_query(
-        'SELECT * FROM rules ORDER BY id',
-        fetch_all=True
-    )
-    
-    matched_rule = None
-    for rule in rules:
+    pending_command = storage.find_command_by_token(approval_token, 'approved') if approval_token else None
+    
+    # Check credits (the spendable balance; reserved credits are not counted)
+    if user['credits'] <= 0 and not pending_command:
+        return insufficient_credits_response(user, command_text)
+    
+    if pending_command:
+        # Only the submitter may run it: the token alone must not let another user execute it
+        if pending_command['user_id'] != user['id']:
+            return jsonify({'error': 'Approval token belongs to another user\'s command'}), 403
+        
+        rejection = queue_full_response()
+        if rejection:
+            return rejection
+        
+        # Execute the approved command (the text that was approved, not the resubmitted one)
+        command_text = pending_command['command_text']
+        credits_cost = CREDITS_PER_COMMAND
+        
         try:
-            if re.search(rule['pattern'], command_text):
-                # Check if time-based rule applies
-                if evaluate_time_based_rule(rule):
-                    matched_rule = dict(rule)
-                    break
-        except re.error:
-            continue
+            with storage.transaction():
+                # Again under the write lock: a concurrent resubmission may have run it already
+                if storage.get_command(pending_command['id'])['status'] != 'approved':
+                    return jsonify({'error': 'Command has already been executed'}), 409
+                fields = accepted_command_fields(command_text)
+                new_balance = storage.capture_credits(user['id'], pending_command['id'], credits_cost)
+                storage.update_command(pending_command['id'], dict(fields, credits_deducted=credits_cost))
+                if fields['status'] == 'executed':
+                    storage.add_audit(user['id'], 'command_executed', f'Command executed after approval: {command_text}')
+                else:
+                    storage.add_audit(user['id'], 'command_queued', f'Command queued after approval: {command_text}')
+                storage.bump_versions('users')
+        except InsufficientCredits:
+            return insufficient_credits_response(user, command_text)
+        
+        return accepted_response(pending_command['id'], fields, credits_cost, new_balance)
+    
+    # Match against the rules of the user's scopes (first match wins, in
+    # RULE_SCOPE_PRECEDENCE order, considering time-based rules). A scope is
+    # reloaded only when its version changes, and repeated commands are
+    # answered from the decision cache.
+    matcher = load_scoped_matcher(user_scopes(user))
+    matched_rule = decide(matcher, command_text)
     
     # Determine action
     if matched_rule:
@@ -766,64 +1277,51 @@ def submit_command():
         action = 'AUTO_REJECT'
         rule_id = None
     
-    # Execute transaction
-    conn = get_db()
-    c = conn.cursor()
+    if action == 'AUTO_ACCEPT':
+        rejection = queue_full_response()
+        if rejection:
+            return rejection
     
+    # Execute transaction
     try:
-        if action == 'AUTO_ACCEPT':
-            # Deduct credits (1 credit per command)
-            credits_cost = 1
-            new_balance = user['credits'] - credits_cost
-            
-            # Update user credits
-            c.execute('UPDATE users SET credits = ? WHERE id = ?', (new_balance, user['id']))
-            
-            # Create command record
-            c.execute(
-                'INSERT INTO commands (user_id, command_text, status, matched_rule_id, credits_deducted, execution_output, executed_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
-                (user['id'], command_text, 'executed', rule_id, credits_cost, f'[MOCKED] Executed: {command_text}', datetime.now())
-            )
-            command_id = c.lastrowid
-            
-            # Log to audit
-            c.execute(
-                'INSERT INTO audit_logs (user_id, action_type, details) VALUES (?, ?, ?)',
-                (user['id'], 'command_executed', f'Command executed: {command_text}')
-            )
-            
-            conn.commit()
+        # Take the write lock up front; the wait feeds load shedding
+        with storage.transaction(lock_wait=admission.record_lock_wait):
+            if action == 'AUTO_ACCEPT':
+                credits_cost = CREDITS_PER_COMMAND
+                
+                # Create command record (executed now, or queued for the executor)
+                fields = accepted_command_fields(command_text)
+                command_id = storage.create_command(
+                    user['id'], command_text, fields['status'], rule_id, credits_deducted=credits_cost,
+                    executed_at=fields.get('executed_at'), execution_status=fields.get('execution_status'),
+                    output_hash=fields.get('output_hash'), output_size=fields.get('output_size')
+                )
+                
+                # Spend the credit; if the balance ran out meanwhile, everything above rolls back
+                new_balance = storage.capture_credits(user['id'], command_id, credits_cost)
+                
+                # Log to audit
+                if fields['status'] == 'executed':
+                    storage.add_audit(user['id'], 'command_executed', f'Command executed: {command_text}')
+                else:
+                    storage.add_audit(user['id'], 'command_queued', f'Command queued for execution: {command_text}')
+                storage.bump_versions('users')
+                
+                return accepted_response(command_id, fields, credits_cost, new_balance)
             
-            return jsonify({
-                'status': 'executed',
-                'command_id': command_id,
-                'credits_deducted': credits_cost,
-                'new_balance': new_balance,
-                'output': f'[MOCKED] Executed: {command_text}'
-            }), 200
-        
-        elif action == 'AUTO_REJECT':
-            # Create command record
-            c.execute(
-                'INSERT INTO commands (user_id, command_text, status, matched_rule_id) VALUES (?, ?, ?, ?)',
-                (user['id'], command_text, 'rejected', rule_id)
-            )
+            elif action == 'AUTO_REJECT':
+                # Create command record
+                storage.create_command(user['id'], command_text, 'rejected', rule_id)
+                
+                # Log to audit
+                storage.add_audit(user['id'], 'command_rejected', f'Command rejected by rule: {command_text}')
+                
+                return jsonify({
+                    'status': 'rejected',
+                    'reason': f'Blocked by rule: {matched_rule["description"] if matched_rule else "No matching rule"}',
+                    'credits': user['credits']
+                }), 200
             
-            # Log to audit
-            c.execute(
-                'INSERT INTO audit_logs (user_id, action_type, details) VALUES (?, ?, ?)',
-                (user['id'], 'command_rejected', f'Command rejected by rule: {command_text}')
-            )
-            
-            conn.commit()
-            
-            return jsonify({
-                'status': 'rejected',
-                'reason': f'Blocked by rule: {matched_rule["description"] if matched_rule else "No matching rule"}',
-                'credits': user['credits']
-            }), 200
-        
-        else:
             # REQUIRE_APPROVAL with voting thresholds
             # Calculate required approvals
             if matched_rule and matched_rule.get('approval_threshold'):
@@ -837,257 +1335,461 @@ def submit_command():
             # Create command record
             escalation_time = datetime.now()
             # Add 1 hour for escalation
-            from datetime import timedelta
             escalation_time = escalation_time + timedelta(hours=1)
             
-            c.execute(
-                'INSERT INTO commands (user_id, command_text, status, matched_rule_id, approval_token, escalation_at) VALUES (?, ?, ?, ?, ?, ?)',
-                (user['id'], command_text, 'pending', rule_id, approval_token, escalation_time)
-            )
-            command_id = c.lastrowid
-            
-            c.execute(
-                'INSERT INTO audit_logs (user_id, action_type, details) VALUES (?, ?, ?)',
-                (user['id'], 'command_pending_approval', f'Command pending approval: {command_text} (threshold: {threshold})')
+            command_id = storage.create_command(
+                user['id'], command_text, 'pending', rule_id,
+                approval_token=approval_token, escalation_at=escalation_time
             )
             
-            conn.commit()
-            
-            # Notify approvers in background
-            Thread(target=notify_approvers, args=(command_id, command_text, user['username'], threshold)).start()
+            # Hold the credit while approvers decide, so waiting commands cannot overspend
+            storage.reserve_credits(user['id'], command_id, CREDITS_PER_COMMAND)
             
-            return jsonify({
-                'status': 'pending',
-                'reason': f'Requires {threshold} approval(s)',
-                'command_id': command_id,
-                'approval_token': approval_token,
-                'threshold': threshold
-            }), 202
+            storage.add_audit(user['id'], 'command_pending_approval', f'Command pending approval: {command_text} (threshold: {threshold})')
+            storage.bump_versions('users', 'pending')
     
+    except InsufficientCredits:
+        return insufficient_credits_response(user, command_text)
     except Exception as e:
-        conn.rollback()
         return jsonify({'error': f'Transaction failed: {str(e)}'}), 500
-    finally:
-        conn.close()
+    
+    # Notify approvers in background
+    notifier.submit(notify_approvers, command_id, command_text, user['username'], threshold)
+    
+    return jsonify({
+        'status': 'pending',
+        'reason': f'Requires {threshold} approval(s)',
+        'command_id': command_id,
+        'approval_token': approval_token,
+        'threshold': threshold,
+        'credits_reserved': CREDITS_PER_COMMAND
+    }), 202
+
+def with_outputs(table):
+    """A command Table plus an output column read from the blob store (?include=output)"""
+    column = table.columns.index('output_hash')
+    outputs = load_outputs(storage, {row[column] for row in table.rows if row[column]})
+    return Table(table.columns + ['output'], [tuple(row) + (outputs.get(row[column]),) for row in table.rows])
 
 @app.route('/api/commands', methods=['GET'])
 @require_auth
 def list_commands():
+    """Newest commands with output size and hash; ?include=output adds the output itself.
+
+    ?since_id= returns only newer commands and ?updated_since= only changed
+    ones, so a client can keep its copy of the list current.
+    """
     user = request.current_user
+    try:
+        args = delta_args('since_id', 'updated_since', 'limit', default_limit=100)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
     if user['role'] == 'admin':
-        commands = execute_query(
-            'SELECT c.*, u.username FROM commands c JOIN users u ON c.user_id = u.id ORDER BY c.created_at DESC LIMIT 100',
-            fetch_all=True
-        )
+        commands = storage.list_commands(**args)
     else:
-        commands = execute_query(
-            'SELECT * FROM commands WHERE user_id = ? ORDER BY created_at DESC LIMIT 100',
-            (user['id'],),
-            fetch_all=True
-        )
-    
-    return jsonify([dict(c) for c in commands])
+        commands = storage.list_commands(user['id'], **args)
+    if request.args.get('include') == 'output':
+        commands = with_outputs(commands)
+    return rows_response(commands)
+
+def visible_command(command_id):
+    """A command the current user may see (their own, or any for admins), else None"""
+    command = storage.get_command(command_id)
+    user = request.current_user
+    if not command or (command['user_id'] != user['id'] and user['role'] != 'admin'):
+        return None
+    return command
+
+@app.route('/api/commands/<int:command_id>', methods=['GET'])
+@require_auth
+def get_command(command_id):
+    command = visible_command(command_id)
+    if not command:
+        return jsonify({'error': 'Command not found'}), 404
+    command.pop('approval_token', None)
+    if request.args.get('include') == 'output':
+        digest = command['output_hash']
+        command['output'] = load_outputs(storage, [digest]).get(digest) if digest else command['execution_output']
+    return jsonify(command)
+
+def output_blob_response(command):
+    """A finished command's output from the blob store: cacheable by content hash, with byte ranges"""
+    blob = storage.get_blob(command['output_hash'])
+    if blob is None:
+        return jsonify({'error': 'Output not found'}), 404
+    size = blob['size']
+    headers = {
+        'ETag': f'"{blob["hash"]}"',
+        'Accept-Ranges': 'bytes',
+        # Finished output never changes
+        'Cache-Control': 'private, max-age=31536000, immutable',
+        'X-Execution-Status': command['execution_status'] or command['status'],
+    }
+    if blob['hash'] in request.if_none_match:
+        return Response(status=304, headers=headers)
+    
+    byte_range = request.range
+    if byte_range and len(byte_range.ranges) == 1 and (not request.if_range.etag or request.if_range.etag == blob['hash']):
+        span = byte_range.range_for_length(size)
+        if span is None:
+            headers['Content-Range'] = f'bytes */{size}'
+            return Response(status=416, headers=headers)
+        start, end = span
+        headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+        headers['Content-Length'] = str(end - start)
+        return Response(iter_range(blob, start, end), status=206, mimetype='text/plain', headers=headers)
+    
+    headers['Vary'] = 'Accept-Encoding'
+    if blob['encoding'] == 'zlib' and request.accept_encodings['deflate']:
+        # Stored zlib data is already a valid HTTP deflate body
+        headers['Content-Encoding'] = 'deflate'
+        headers['Content-Length'] = str(len(blob['data']))
+        return Response(bytes(blob['data']), mimetype='text/plain', headers=headers)
+    headers['Content-Length'] = str(size)
+    return Response(iter_range(blob), mimetype='text/plain', headers=headers)
+
+@app.route('/api/commands/<int:command_id>/output', methods=['GET'])
+@require_auth
+def stream_command_output(command_id):
+    """Command output as plain text, streamed while the command is queued or running.
+
+    Finished output is served from the blob store (output_blob_response) and
+    honors Range. While the command runs, ?offset=N resumes after N characters
+    and ?follow=0 returns what exists now. Output is read back from storage,
+    so any worker can serve the stream.
+
+    A stream follows for at most STREAM_FOLLOW_S, and only STREAM_FOLLOWERS
+    at once: beyond that the response is what exists now, with Retry-After and
+    the offset to resume from in X-Output-Offset.
+    """
+    command = visible_command(command_id)
+    if not command:
+        return jsonify({'error': 'Command not found'}), 404
+    if command['output_hash'] and 'offset' not in request.args:
+        return output_blob_response(command)
+    offset = max(0, request.args.get('offset', 0, type=int))
+    follow = request.args.get('follow', '1') != '0'
+    following = follow and command['execution_status'] in ('queued', 'running')
+    if following and not stream_followers.acquire(blocking=False):
+        follow = following = False
+        busy = True
+    else:
+        busy = False
+    
+    def generate(command):
+        position = offset
+        deadline = time.monotonic() + STREAM_FOLLOW_S
+        while True:
+            digest = command['output_hash']
+            if digest:
+                # Finished: the output has moved to the blob store
+                output = load_outputs(storage, [digest]).get(digest, '')
+            else:
+                output = command['execution_output'] or ''
+            if len(output) > position:
+                yield output[position:].encode()
+                position = len(output)
+            if not follow or command['execution_status'] not in ('queued', 'running') or time.monotonic() > deadline:
+                return
+            time.sleep(0.25)
+            command = storage.get_command(command_id)
+    
+    response = Response(generate(command), mimetype='text/plain')
+    response.headers['Cache-Control'] = 'no-store'
+    response.headers['X-Execution-Status'] = command['execution_status'] or command['status']
+    if following:
+        response.call_on_close(stream_followers.release)
+    if busy:
+        response.headers['Retry-After'] = '1'
+        response.headers['X-Output-Offset'] = str(max(offset, len(command['execution_output'] or '')))
+    return response
 
 @app.route('/api/audit-logs', methods=['GET'])
 @require_admin
 def get_audit_logs():
-    logs = execute_query(
-        'SELECT a.*, u.username FROM audit_logs a LEFT JOIN users u ON a.user_id = u.id ORDER BY a.created_at DESC LIMIT 200',
-        fetch_all=True
-    )
-    return jsonify([dict(l) for l in logs])
+    try:
+        args = delta_args('since_id', 'limit', default_limit=200)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return rows_response(storage.list_audit_logs(**args))
+
+@app.route('/api/credits/ledger', methods=['GET'])
+@require_auth
+def get_credit_ledger():
+    """Credit ledger entries, newest first: the caller's own, or for admins ?user_id= (everyone's without it)"""
+    user = request.current_user
+    try:
+        args = delta_args('since_id', 'limit', default_limit=100)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    user_id = user['id']
+    if user['role'] == 'admin':
+        value = request.args.get('user_id')
+        if value and not value.isdigit():
+            return jsonify({'error': 'user_id must be a positive integer'}), 400
+        user_id = int(value) if value else None
+    return rows_response(storage.credit_ledger(user_id, **args))
 
 @app.route('/api/commands/pending', methods=['GET'])
 @require_admin
+@conditional_get('pending', 'rules')
 def get_pending_commands():
-    """Get all pending commands requiring approval"""
-    commands = execute_query(
-        '''SELECT c.*, u.username, u.tier, 
-           (SELECT COUNT(*) FROM approval_votes WHERE command_id = c.id AND vote = 'approve') as approval_count,
-           (SELECT COUNT(*) FROM approval_votes WHERE command_id = c.id AND vote = 'reject') as rejection_count,
-           COALESCE(r.approval_threshold, ?) as approval_threshold
-           FROM commands c 
-           JOIN users u ON c.user_id = u.id 
-           LEFT JOIN rules r ON c.matched_rule_id = r.id
-           WHERE c.status = 'pending' 
-           ORDER BY c.created_at DESC''',
-        (get_user_tier_threshold('junior'),),
-        fetch_all=True
-    )
-    return jsonify([dict(c) for c in commands])
+    """Get all pending commands requiring approval.
+
+    With ?updated_since= every command changed since then is returned, in any
+    status, so the client can drop the ones that were decided.
+    """
+    try:
+        args = delta_args('updated_since')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return rows_response(storage.list_pending(get_user_tier_threshold('junior'), **args))
 
 @app.route('/api/commands/<int:command_id>/approve', methods=['POST'])
 @require_admin
+@idempotent
 def approve_command(command_id):
     """Approve a pending command"""
     approver_id = request.current_user['id']
     
     # Check if command exists and is pending
-    command = execute_query(
-        'SELECT * FROM commands WHERE id = ?',
-        (command_id,),
-        fetch_one=True
-    )
+    command = storage.get_command(command_id)
     
     if not command:
         return jsonify({'error': 'Command not found'}), 404
     
-    command = dict(command)
-    
     if command['status'] != 'pending':
         return jsonify({'error': 'Command is not pending approval'}), 400
     
-    # Check if already voted
-    existing_vote = execute_query(
-        'SELECT * FROM approval_votes WHERE command_id = ? AND approver_id = ?',
-        (command_id, approver_id),
-        fetch_one=True
-    )
-    
-    if existing_vote:
-        # Update vote
-        execute_query(
-            'UPDATE approval_votes SET vote = ?, created_at = ? WHERE command_id = ? AND approver_id = ?',
-            ('approve', datetime.now(), command_id, approver_id)
-        )
-    else:
-        # Create vote
-        execute_query(
-            'INSERT INTO approval_votes (command_id, approver_id, vote) VALUES (?, ?, ?)',
-            (command_id, approver_id, 'approve')
-        )
-    
-    # Check if threshold met
-    if check_approval_status(command_id):
-        # Mark as approved
-        execute_query(
-            'UPDATE commands SET status = ? WHERE id = ?',
-            ('approved', command_id)
-        )
-        execute_query(
-            'INSERT INTO audit_logs (user_id, action_type, details) VALUES (?, ?, ?)',
-            (approver_id, 'command_approved', f'Command {command_id} approved and ready for execution')
-        )
+    with storage.transaction():
+        # Record the vote (an earlier vote by this approver is replaced)
+        storage.cast_vote(command_id, approver_id, 'approve')
+        storage.bump_versions('pending')
         
-        return jsonify({
-            'message': 'Command approved. Threshold met. User can now execute.',
-            'status': 'approved',
-            'approval_token': command['approval_token']
-        })
-    else:
-        # Get current counts
-        approvals = execute_query(
-            'SELECT COUNT(*) FROM approval_votes WHERE command_id = ? AND vote = ?',
-            (command_id, 'approve'),
-            fetch_one=True
-        )[0]
+        # Check if threshold met
+        if check_approval_status(command_id):
+            # Mark as approved
+            storage.set_command_status(command_id, 'approved')
+            storage.add_audit(approver_id, 'command_approved', f'Command {command_id} approved and ready for execution')
+            
+            return jsonify({
+                'message': 'Command approved. Threshold met. User can now execute.',
+                'status': 'approved',
+                'approval_token': command['approval_token']
+            })
         
-        return jsonify({
-            'message': 'Vote recorded',
-            'approvals': approvals,
-            'status': 'pending'
-        })
+        # Get current counts
+        approvals = storage.count_votes(command_id, 'approve')
+    
+    return jsonify({
+        'message': 'Vote recorded',
+        'approvals': approvals,
+        'status': 'pending'
+    })
 
 @app.route('/api/commands/<int:command_id>/reject', methods=['POST'])
 @require_admin
+@idempotent
 def reject_command(command_id):
     """Reject a pending command"""
     approver_id = request.current_user['id']
     
-    command = execute_query(
-        'SELECT * FROM commands WHERE id = ?',
-        (command_id,),
-        fetch_one=True
-    )
+    command = storage.get_command(command_id)
     
     if not command:
         return jsonify({'error': 'Command not found'}), 404
     
-    command = dict(command)
-    
     if command['status'] != 'pending':
         return jsonify({'error': 'Command is not pending approval'}), 400
     
-    # Record rejection vote
-    existing_vote = execute_query(
-        'SELECT * FROM approval_votes WHERE command_id = ? AND approver_id = ?',
-        (command_id, approver_id),
-        fetch_one=True
-    )
-    
-    if existing_vote:
-        execute_query(
-            'UPDATE approval_votes SET vote = ? WHERE command_id = ? AND approver_id = ?',
-            ('reject', command_id, approver_id)
-        )
-    else:
-        execute_query(
-            'INSERT INTO approval_votes (command_id, approver_id, vote) VALUES (?, ?, ?)',
-            (command_id, approver_id, 'reject')
-        )
-    
-    # If majority reject, reject the command
-    rejections = execute_query(
-        'SELECT COUNT(*) FROM approval_votes WHERE command_id = ? AND vote = ?',
-        (command_id, 'reject'),
-        fetch_one=True
-    )[0]
-    
-    approvals = execute_query(
-        'SELECT COUNT(*) FROM approval_votes WHERE command_id = ? AND vote = ?',
-        (command_id, 'approve'),
-        fetch_one=True
-    )[0]
-    
-    if rejections > approvals:
-        execute_query(
-            'UPDATE commands SET status = ? WHERE id = ?',
-            ('rejected', command_id)
-        )
-        execute_query(
-            'INSERT INTO audit_logs (user_id, action_type, details) VALUES (?, ?, ?)',
-            (approver_id, 'command_rejected', f'Command {command_id} rejected by approver')
-        )
-        return jsonify({'message': 'Command rejected', 'status': 'rejected'})
+    with storage.transaction():
+        # Record rejection vote
+        storage.cast_vote(command_id, approver_id, 'reject')
+        storage.bump_versions('pending')
+        
+        # If majority reject, reject the command
+        rejections = storage.count_votes(command_id, 'reject')
+        approvals = storage.count_votes(command_id, 'approve')
+        
+        if rejections > approvals:
+            storage.set_command_status(command_id, 'rejected')
+            storage.release_credits(command_id, note='rejected')
+            storage.bump_versions('users')
+            storage.add_audit(approver_id, 'command_rejected', f'Command {command_id} rejected by approver')
+            return jsonify({'message': 'Command rejected', 'status': 'rejected'})
     
     return jsonify({'message': 'Rejection vote recorded', 'status': 'pending'})
 
 @app.route('/api/users/<int:user_id>', methods=['PUT'])
 @require_admin
 def update_user(user_id):
-    """Update user details including tier, email, telegram"""
+    """Update user details including tier, team, email, telegram"""
     data = request.json
     tier = data.get('tier')
+    team = data.get('team')
     email = data.get('email')
     telegram_chat_id = data.get('telegram_chat_id')
     
-    updates = []
-    params = []
+    updates = {}
     
     if tier:
         if tier not in ['junior', 'mid', 'senior', 'lead']:
             return jsonify({'error': 'Invalid tier'}), 400
-        updates.append('tier = ?')
-        params.append(tier)
+        updates['tier'] = tier
+    
+    if team is not None:
+        # An empty team takes the user out of their team
+        if team and not (isinstance(team, str) and TEAM_NAME.match(team)):
+            return jsonify({'error': 'Invalid team name'}), 400
+        updates['team'] = team or None
     
     if email is not None:
-        updates.append('email = ?')
-        params.append(email)
+        updates['email'] = email
     
     if telegram_chat_id is not None:
-        updates.append('telegram_chat_id = ?')
-        params.append(telegram_chat_id)
+        updates['telegram_chat_id'] = telegram_chat_id
     
     if not updates:
         return jsonify({'error': 'No fields to update'}), 400
     
-    params.append(user_id)
-    query = f'UPDATE users SET {", ".join(updates)} WHERE id = ?'
-    execute_query(query, tuple(params))
+    with storage.transaction():
+        storage.update_user(user_id, updates)
+        if tier:
+            storage.bump_versions('users', 'pending')
+        else:
+            storage.bump_versions('users')
     
     return jsonify({'message': 'User updated successfully'})
 
+@app.route('/api/admin/rate-limits', methods=['GET'])
+@require_admin
+def get_rate_limits():
+    """Current admission state of this worker, the shared token buckets and stored idempotent responses"""
+    buckets = []
+    if RATE_LIMIT_ENABLED:
+        buckets = limiter.buckets()
+    return jsonify({'enabled': RATE_LIMIT_ENABLED, 'admission': admission.stats(), 'buckets': buckets,
+                    'idempotency': idempotency.stats()})
+
+@app.route('/api/admin/executor', methods=['GET'])
+@require_admin
+def executor_stats():
+    """Execution queue, this worker's pool and the output blob store"""
+    return jsonify(dict(executor.stats(), outputs=storage.blob_stats()))
+
+def analytics_range():
+    """(since, until, day) hour buckets from ?since=&until=&bucket=hour|day; defaults to the last 24 hours (UTC)"""
+    bucket = request.args.get('bucket', 'hour')
+    if bucket not in ('hour', 'day'):
+        raise ValueError('bucket must be hour or day')
+    day = bucket == 'day'
+    bounds = []
+    for name, default in (('since', timedelta(hours=-23)), ('until', timedelta(hours=1))):
+        value = request.args.get(name)
+        moment = datetime.fromisoformat(value) if value else datetime.now(timezone.utc) + default
+        if moment.tzinfo is not None:
+            moment = moment.astimezone(pytz.utc).replace(tzinfo=None)
+        bounds.append(moment.replace(minute=0, second=0, microsecond=0))
+    since, until = bounds
+    if day:
+        # Whole days: since rounds down, until rounds up
+        if until.hour:
+            until = until.replace(hour=0) + timedelta(days=1)
+        since = since.replace(hour=0)
+    if since >= until:
+        raise ValueError('since must be before until')
+    return since.strftime('%Y-%m-%d %H:00'), until.strftime('%Y-%m-%d %H:00'), day
+
+@app.route('/api/analytics', methods=['GET'])
+@require_admin
+def get_analytics():
+    """Usage and approval turnaround per hour or day, read from the rollup tables"""
+    try:
+        since, until, day = analytics_range()
+    except ValueError as e:
+        return jsonify({'error': f'Invalid range: {e}'}), 400
+
+    rules = {}
+    for row in storage.usage_by_rule(since, until).dicts():
+        rule = rules.setdefault(row['rule_id'], {'rule_id': row['rule_id'] or None, 'pattern': row['pattern'],
+                                                 'commands': 0, 'statuses': {}})
+        rule['statuses'][row['status']] = row['commands']
+        rule['commands'] += row['commands']
+    for rule in rules.values():
+        rule['ratios'] = {status: round(count / rule['commands'], 4) for status, count in rule['statuses'].items()}
+
+    turnaround = []
+    for row in storage.approval_turnaround(since, until, day).dicts():
+        turnaround.append({'bucket': row['bucket'], 'outcome': row['outcome'], 'decisions': row['decisions'],
+                           'avg_seconds': round(row['total_seconds'] / row['decisions'], 1),
+                           'max_seconds': round(row['max_seconds'], 1)})
+
+    return jsonify({
+        'since': since,
+        'until': until,
+        'bucket': 'day' if day else 'hour',
+        'commands_by_user': storage.usage_by_user(since, until, day).dicts(),
+        'rules': sorted(rules.values(), key=lambda rule: -rule['commands']),
+        'credits_by_tier': storage.usage_by_tier(since, until, day).dicts(),
+        'approval_turnaround': turnaround,
+    })
+
+@app.route('/api/admin/maintenance', methods=['GET'])
+@require_admin
+def get_maintenance():
+    """Leader, schedule and last run of each database maintenance task"""
+    return jsonify(maintenance.status())
+
+@app.route('/api/admin/maintenance/<task>', methods=['POST'])
+@require_admin
+def request_maintenance(task):
+    """Have the maintenance leader run a task at its next pass, outside the window if need be"""
+    if not maintenance.enabled:
+        return jsonify({'error': 'Maintenance is disabled (or not applicable to this storage backend)'}), 409
+    if task not in maintenance.tasks:
+        return jsonify({'error': f"Unknown task; expected one of {', '.join(maintenance.tasks)}"}), 404
+    maintenance.request(task)
+    storage.add_audit(request.current_user['id'], 'maintenance_requested', f'Requested maintenance task: {task}')
+    return jsonify({'message': f'{task} requested', 'task': task}), 202
+
+@app.route('/api/admin/decision-cache', methods=['GET'])
+@require_admin
+def get_decision_cache_stats():
+    """Hit/miss statistics of this worker's rule decision cache"""
+    return jsonify(decision_cache.stats())
+
+@app.route('/api/admin/rule-stats', methods=['GET'])
+@require_admin
+def get_rule_stats():
+    """Dead, shadowed and most expensive rules, from every worker's flushed counts.
+
+    This worker's counts are flushed first; other workers' arrive within
+    RULE_PROFILE_FLUSH_S. ?top= sets the length of the expensive list.
+    """
+    top = request.args.get('top', 10, type=int)
+    if not rule_profiler.enabled:
+        return jsonify({'error': 'Rule profiling is disabled (RULE_PROFILE=0)'}), 409
+    rule_profiler.flush(storage)
+    return jsonify(rule_stats_report(storage.rule_stats().dicts(), storage.rule_shadows().dicts(), max(1, top)))
+
+@app.route('/api/admin/rule-stats', methods=['DELETE'])
+@require_admin
+def reset_rule_stats():
+    """Start counting afresh, e.g. after pruning or reordering rules"""
+    rule_profiler.take()
+    storage.reset_rule_stats()
+    storage.add_audit(request.current_user['id'], 'rule_stats_reset', 'Reset rule effectiveness counters')
+    return jsonify({'message': 'Rule stats reset'})
+
+@app.route('/api/admin/caches', methods=['GET'])
+@require_admin
+def get_cache_stats():
+    """This worker's in-process caches and the resource versions they were last checked against"""
+    return jsonify({'changes': change_watcher.stats(), 'users': user_cache.stats(),
+                    'responses': response_cache.stats(), 'decisions': decision_cache.stats()})
+
 @app.route('/api/rules/check-conflict', methods=['POST'])
 @require_admin
 def check_rule_conflict_endpoint():
@@ -1095,17 +1797,28 @@ def check_rule_conflict_endpoint():
     data = request.json
     pattern = data.get('pattern')
     exclude_id = data.get('exclude_id')
+    scope = data.get('scope') or 'global'
     
     if not pattern:
         return jsonify({'error': 'Pattern required'}), 400
     
+    try:
+        check_scope(scope)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
     try:
         re.compile(pattern)
     except re.error as e:
         return jsonify({'error': f'Invalid regex: {str(e)}'}), 400
     
-    conflicts = check_rule_conflict(pattern, exclude_id)
-    return jsonify({'conflicts': conflicts, 'has_conflicts': len(conflicts) > 0})
+    complexity = analyze_pattern(pattern)
+    if is_high_risk(complexity) and COMPLEXITY_MODE == 'reject':
+        # Don't run a dangerous pattern against the sample commands
+        return jsonify({'conflicts': [], 'has_conflicts': False, 'complexity': complexity})
+    
+    conflicts = check_rule_conflict(pattern, exclude_id, scope)
+    return jsonify({'conflicts': conflicts, 'has_conflicts': len(conflicts) > 0, 'complexity': complexity})
 
 def check_escalations():
     """Background task to check for commands that need escalation"""
@@ -1114,14 +1827,9 @@ def check_escalations():
         try:
             time.sleep(300)  # Check every 5 minutes
             
-            pending_commands = execute_query(
-                'SELECT * FROM commands WHERE status = ? AND escalation_at IS NOT NULL AND escalation_at <= ?',
-                ('pending', datetime.now()),
-                fetch_all=True
-            )
+            pending_commands = storage.due_escalations(datetime.now())
             
             for cmd in pending_commands:
-                cmd = dict(cmd)
                 # Check if already escalated (simple check to avoid duplicate escalations)
                 if cmd.get('escalation_at'):
                     escalate_command(cmd['id'])
@@ -1129,8 +1837,10 @@ def check_escalations():
             print(f"Error in escalation check: {e}")
 
 if __name__ == '__main__':
-    init_db()
-    seed_data()
+    create_app()
+    executor.start()
+    maintenance.start()
+    rule_profiler.start(storage)
     
     # Start escalation checker in background
     escalation_thread = Thread(target=check_escalations, daemon=True)
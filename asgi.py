@@ -0,0 +1,150 @@
+"""ASGI entry point serving the same Flask app from an event loop.
+
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT
+    gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker 'asgi:create_app()'
+
+Connections (keep-alive, slow uploads, slow readers) belong to the event loop
+and cost no thread while idle. A request borrows a thread from a bounded pool
+only while the Flask view runs (which is where all SQLite access happens) or
+while it produces the next chunk of a streamed body. Routes, auth and
+responses are exactly those of app.py; `gunicorn app:app` keeps working.
+
+Startup matches the WSGI server's: the schema, migrations, seed data and
+recovery of interrupted commands run once (create_app), then every process
+starts its executor, maintenance and rule-profiler threads (worker_init).
+"""
+import asyncio
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import app as gateway
+
+# Upper bound on requests executing at once (and so on open SQLite connections)
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 16))
+MAX_BODY_BYTES = int(os.environ.get('ASGI_MAX_BODY_BYTES', 10 * 1024 * 1024))
+
+_executor = ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix='asgi')
+
+
+def build_environ(scope, body):
+    """WSGI environ for an ASGI http scope"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for raw_name, raw_value in scope['headers']:
+        name = raw_name.decode('latin-1').upper().replace('-', '_')
+        value = raw_value.decode('latin-1')
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            key = name
+        else:
+            key = 'HTTP_' + name
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+
+async def read_body(receive):
+    """Whole request body, or None if it exceeds MAX_BODY_BYTES or the client left"""
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > MAX_BODY_BYTES:
+            return None
+        chunks.append(chunk)
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+def _start(environ, started):
+    """Run the WSGI app up to its first body chunk (runs in the executor)"""
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+
+    result = gateway.app(environ, start_response)
+    iterator = iter(result)
+    return result, iterator, next(iterator, None)
+
+
+def create_app():
+    """One-time setup in a preloading master (gunicorn.conf.py); returns the ASGI app"""
+    gateway.create_app()
+    return app
+
+
+def _startup():
+    # Does nothing when a preloading master already ran it
+    gateway.create_app()
+    gateway.worker_init()
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, _startup)
+            except Exception as e:
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            _executor.shutdown(wait=False)
+            gateway.notifier.shutdown(wait=False)
+            gateway.executor.stop()
+            gateway.maintenance.stop()
+            gateway.rule_profiler.stop()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return  # No websocket routes
+
+    body = await read_body(receive)
+    if body is None:
+        await send({'type': 'http.response.start', 'status': 413,
+                    'headers': [(b'content-type', b'application/json')]})
+        await send({'type': 'http.response.body', 'body': b'{"error":"Request body too large"}'})
+        return
+
+    loop = asyncio.get_running_loop()
+    started = {}
+    result, iterator, chunk = await loop.run_in_executor(_executor, _start, build_environ(scope, body), started)
+    try:
+        await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+        while chunk is not None:
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            chunk = await loop.run_in_executor(_executor, next, iterator, None)
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(result, 'close'):
+            await loop.run_in_executor(_executor, result.close)
@@ -0,0 +1,139 @@
+"""Fingerprinted, precompressed static assets.
+
+At startup (once, in the gunicorn master with preload_app) every file under
+static/ is read, hashed and compressed. Each is then served from memory at a
+URL containing its content hash, e.g. /assets/js/app.3f9c2a7b1e04.js, with
+
+    Cache-Control: public, max-age=31536000, immutable
+
+so browsers and proxies keep it until the content, and so the URL, changes.
+Templates ask for asset_url('js/app.js') instead of url_for('static', ...).
+gzip variants are always made, brotli ones when the brotli package is
+installed; the smallest encoding the client accepts is sent.
+
+`python assets.py build DIR` writes the same fingerprinted files, with .gz
+and .br siblings, for a reverse proxy or CDN to serve /assets/ without
+touching the app (e.g. nginx `gzip_static on`).
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import sys
+
+try:
+    import brotli  # Optional (pip install brotli)
+except ImportError:
+    brotli = None
+
+# 0 serves plain /static/ URLs, re-read on every request (handy while editing the files)
+ASSETS_FINGERPRINT = os.environ.get('ASSETS_FINGERPRINT', '1') == '1'
+# Files smaller than this are only served as-is
+ASSETS_COMPRESS_MIN_BYTES = int(os.environ.get('ASSETS_COMPRESS_MIN_BYTES', 512))
+
+ASSET_URL_PREFIX = '/assets/'
+IMMUTABLE = 'public, max-age=31536000, immutable'
+# Preferred order when the client accepts several equally
+ENCODINGS = ('br', 'gzip')
+
+
+def fingerprinted_name(name, digest):
+    """css/style.css -> css/style.<digest>.css"""
+    stem, ext = os.path.splitext(name)
+    return f'{stem}.{digest}{ext}'
+
+
+def _compress(data):
+    """{encoding: bytes} for the variants worth sending instead of data"""
+    variants = {}
+    if len(data) < ASSETS_COMPRESS_MIN_BYTES:
+        return variants
+    compressed = gzip.compress(data, compresslevel=9, mtime=0)
+    if len(compressed) < len(data):
+        variants['gzip'] = compressed
+    if brotli is not None:
+        compressed = brotli.compress(data, quality=11)
+        if len(compressed) < len(data):
+            variants['br'] = compressed
+    return variants
+
+
+class Assets:
+    """Manifest of the static files: logical name -> fingerprinted name, body and compressed variants"""
+
+    def __init__(self, static_dir):
+        self.static_dir = static_dir
+        self.manifest = {}  # 'js/app.js' -> 'js/app.<hash>.js'
+        self._files = {}    # 'js/app.<hash>.js' -> (content type, etag, {encoding: bytes})
+
+    def build(self):
+        manifest, files = {}, {}
+        for root, _, names in os.walk(self.static_dir):
+            for filename in sorted(names):
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, self.static_dir).replace(os.sep, '/')
+                with open(path, 'rb') as f:
+                    data = f.read()
+                digest = hashlib.sha256(data).hexdigest()[:12]
+                content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+                if content_type.startswith('text/') or content_type == 'application/javascript':
+                    content_type += '; charset=utf-8'
+                manifest[name] = fingerprinted_name(name, digest)
+                files[manifest[name]] = (content_type, f'"{digest}"', dict(_compress(data), identity=data))
+        self.manifest, self._files = manifest, files
+        return self
+
+    def url(self, name):
+        """URL for a file under static/: fingerprinted, or plain when fingerprinting is off or it is unknown"""
+        if ASSETS_FINGERPRINT and name in self.manifest:
+            return ASSET_URL_PREFIX + self.manifest[name]
+        return f'/static/{name}'
+
+    def get(self, fingerprinted, accept_encodings):
+        """(body, headers) for a fingerprinted name and the client's Accept-Encoding, or None if unknown"""
+        entry = self._files.get(fingerprinted)
+        if entry is None:
+            return None
+        content_type, etag, variants = entry
+        offered = [encoding for encoding in ENCODINGS if encoding in variants]
+        encoding = accept_encodings.best_match(offered) if offered else None
+        headers = {'Content-Type': content_type, 'Cache-Control': IMMUTABLE, 'ETag': etag}
+        if offered:
+            headers['Vary'] = 'Accept-Encoding'
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        return variants[encoding or 'identity'], headers
+
+    def stats(self):
+        return {
+            'fingerprint': ASSETS_FINGERPRINT,
+            'brotli': brotli is not None,
+            'files': {name: {'url': ASSET_URL_PREFIX + fingerprinted,
+                             **{encoding: len(body) for encoding, body in self._files[fingerprinted][2].items()}}
+                      for name, fingerprinted in self.manifest.items()},
+        }
+
+    def write(self, out_dir):
+        """Write every fingerprinted file and its .gz/.br variants under out_dir, plus manifest.json"""
+        suffixes = {'identity': '', 'gzip': '.gz', 'br': '.br'}
+        for fingerprinted, (_, _, variants) in self._files.items():
+            target = os.path.join(out_dir, *fingerprinted.split('/'))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            for encoding, body in variants.items():
+                with open(target + suffixes[encoding], 'wb') as f:
+                    f.write(body)
+        with open(os.path.join(out_dir, 'manifest.json'), 'w') as f:
+            json.dump(self.manifest, f, indent=2, sort_keys=True)
+
+
+assets = Assets(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or sys.argv[1] != 'build':
+        print('usage: python assets.py build OUT_DIR')
+        sys.exit(2)
+    assets.build().write(sys.argv[2])
+    for name, fingerprinted in sorted(assets.manifest.items()):
+        print(f'{name} -> {fingerprinted}')
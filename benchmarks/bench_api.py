@@ -0,0 +1,348 @@
+"""Load-test and latency benchmark for the gateway API.
+
+Seeds a throwaway SQLite database with users, rules and history rows, then
+drives the API either in-process through the Flask test client or against a
+locally started gunicorn server, using a pool of concurrent clients.
+``--storage memory`` runs the same scenarios on the in-memory backend, which
+separates application overhead from SQLite cost.
+
+Results are written as JSON so runs can be diffed across commits:
+
+    python benchmarks/bench_api.py --rules 1000 --output before.json
+    python benchmarks/bench_api.py --rules 1000 --output after.json --compare before.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import secrets
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Commands used by the submit scenarios. Filler rules never match these, so
+# every submission scans the whole rule set before reaching its rule.
+SUBMIT_COMMANDS = {
+    'submit_accept': 'ls -la /var/log',
+    'submit_reject': 'rm -rf /tmp/build',
+    'submit_approval': 'deploy service-api --env prod',
+    'submit_nomatch': 'unknown-tool --flag',
+}
+
+# Rules appended after the filler rules (pattern, action, description, threshold)
+ACTION_RULES = [
+    ('rm\\s+-rf\\s+/', 'AUTO_REJECT', 'Dangerous rm command', 1),
+    ('^(ls|cat|pwd|echo)', 'AUTO_ACCEPT', 'Safe read commands', 1),
+    # High threshold keeps voted commands pending so every vote does real work
+    ('^deploy\\s+', 'REQUIRE_APPROVAL', 'Deployments', 1000000),
+]
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+def summarize(latencies, errors, wall_time):
+    """Reduce raw latencies (seconds) into the reported statistics"""
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        'requests': count,
+        'errors': errors,
+        'wall_time_s': round(wall_time, 4),
+        'rps': round(count / wall_time, 2) if wall_time > 0 else 0.0,
+        'mean_ms': round(sum(latencies) / count * 1000, 3) if count else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'max_ms': round(latencies[-1] * 1000, 3) if count else 0.0,
+    }
+
+
+def seed_database(users, rules, history, pending):
+    """Create the schema in the app's storage and bulk-load benchmark data"""
+    import app as gateway
+    from output_store import save_output
+
+    storage = gateway.storage
+    storage.init_schema()
+
+    admin_key = secrets.token_urlsafe(32)
+    member_key = secrets.token_urlsafe(32)
+    with storage.transaction():
+        admin_id = storage.create_user('bench-admin', admin_key, 'admin', 10 ** 9, 'lead')
+        member_id = storage.create_user('bench-member', member_key, 'member', 10 ** 9, 'mid')
+
+        tiers = ['junior', 'mid', 'senior', 'lead']
+        user_ids = [admin_id, member_id] + [
+            storage.create_user(f'user{i}', secrets.token_urlsafe(32), 'member', 100, tiers[i % 4])
+            for i in range(max(0, users - 2))
+        ]
+
+        filler = max(0, rules - len(ACTION_RULES))
+        actions = ['AUTO_ACCEPT', 'AUTO_REJECT', 'REQUIRE_APPROVAL']
+        for i in range(filler):
+            storage.create_rule(f'^bench-tool-{i}\\s+(run|check)', actions[i % 3], f'Filler rule {i}', created_by=admin_id)
+        approval_rule_id = None
+        for pattern, action, desc, threshold in ACTION_RULES:
+            rule_id = storage.create_rule(pattern, action, desc, threshold, created_by=admin_id)
+            if action == 'REQUIRE_APPROVAL':
+                approval_rule_id = rule_id
+
+        now = datetime.now()
+        statuses = ['executed', 'rejected', 'executed', 'approved']
+        for i in range(history):
+            created_at = now - timedelta(seconds=i)
+            output = save_output(storage, f'[MOCKED] Executed: echo history {i}')
+            storage.create_command(random.choice(user_ids), f'echo history {i}', statuses[i % 4], credits_deducted=1,
+                                   created_at=created_at, output_hash=output['output_hash'],
+                                   output_size=output['output_size'])
+            storage.add_audit(random.choice(user_ids), 'command_executed', f'Command executed: echo history {i}',
+                              created_at=created_at)
+
+        # Pending commands consumed one per vote request
+        pending_ids = [
+            storage.create_command(member_id, f'deploy bench-{i}', 'pending', approval_rule_id,
+                                   approval_token=secrets.token_urlsafe(16))
+            for i in range(pending)
+        ]
+
+    return {'admin_key': admin_key, 'member_key': member_key, 'pending_ids': pending_ids}
+
+
+def build_scenarios(seed, requests_per_scenario):
+    """Return (name, api_key, method, path_fn, body) tuples for every scenario"""
+    admin, member = seed['admin_key'], seed['member_key']
+    pending_ids = seed['pending_ids']
+    approve_ids = pending_ids[:requests_per_scenario]
+    reject_ids = pending_ids[requests_per_scenario:2 * requests_per_scenario]
+
+    scenarios = []
+    for name, command in SUBMIT_COMMANDS.items():
+        scenarios.append((name, member, 'POST', lambda i: '/api/commands', {'command_text': command}))
+    scenarios += [
+        ('pending_list', admin, 'GET', lambda i: '/api/commands/pending', None),
+        ('vote_approve', admin, 'POST', lambda i: f'/api/commands/{approve_ids[i % len(approve_ids)]}/approve', None),
+        ('vote_reject', admin, 'POST', lambda i: f'/api/commands/{reject_ids[i % len(reject_ids)]}/reject', None),
+        ('history_admin', admin, 'GET', lambda i: '/api/commands', None),
+        ('history_member', member, 'GET', lambda i: '/api/commands', None),
+        ('audit_logs', admin, 'GET', lambda i: '/api/audit-logs', None),
+        ('rules_list', admin, 'GET', lambda i: '/api/rules', None),
+    ]
+    return scenarios
+
+
+def make_test_client_sender():
+    """Send requests through the in-process Flask test client"""
+    import app as gateway
+
+    local = threading.local()
+
+    def send(api_key, method, path, body):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = gateway.app.test_client()
+        headers = {'X-API-Key': api_key, 'Content-Type': 'application/json'}
+        response = client.open(path, method=method, headers=headers,
+                               data=json.dumps(body) if body is not None else None)
+        return response.status_code
+
+    return send
+
+
+def make_http_sender(base_url):
+    """Send requests over HTTP to a running server"""
+    import requests
+
+    local = threading.local()
+
+    def send(api_key, method, path, body):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        headers = {'X-API-Key': api_key, 'Content-Type': 'application/json'}
+        response = session.request(method, base_url + path, headers=headers,
+                                   data=json.dumps(body) if body is not None else None)
+        return response.status_code
+
+    return send
+
+
+def run_scenario(send, scenario, requests_per_scenario, concurrency):
+    """Fire requests_per_scenario requests with concurrency clients"""
+    name, api_key, method, path_fn, body = scenario
+
+    def one(i):
+        start = time.perf_counter()
+        try:
+            status = send(api_key, method, path_fn(i), body)
+        except Exception:
+            status = 0
+        return time.perf_counter() - start, status
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(requests_per_scenario)))
+    wall_time = time.perf_counter() - wall_start
+
+    latencies = [elapsed for elapsed, _ in results]
+    errors = sum(1 for _, status in results if status == 0 or status >= 400)
+    return summarize(latencies, errors, wall_time)
+
+
+def free_port():
+    with contextlib.closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(db_path, workers):
+    """Start gunicorn on a free local port against the seeded database, configured as the Procfile does"""
+    port = free_port()
+    env = dict(os.environ, DATABASE_PATH=db_path)
+    # gunicorn.conf.py (preload, gc.freeze, per-worker setup) with -w and -b overriding its bind and workers
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '-w', str(workers), '-b', f'127.0.0.1:{port}',
+         'app:create_app()'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError('gunicorn exited during startup')
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return proc, base_url
+        except OSError:
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError('gunicorn did not start within 30s')
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(current, baseline_path):
+    """Print per-scenario change against a previous result file"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"{'scenario':<18} {'rps':>10} {'Δrps':>8} {'p95_ms':>10} {'Δp95':>8}", file=sys.stderr)
+    for name, stats in current['results'].items():
+        base = baseline.get('results', {}).get(name)
+        if not base:
+            continue
+        d_rps = (stats['rps'] - base['rps']) / base['rps'] * 100 if base['rps'] else 0.0
+        d_p95 = (stats['p95_ms'] - base['p95_ms']) / base['p95_ms'] * 100 if base['p95_ms'] else 0.0
+        print(f"{name:<18} {stats['rps']:>10.1f} {d_rps:>+7.1f}% {stats['p95_ms']:>10.2f} {d_p95:>+7.1f}%", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Gateway API load and latency benchmark')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--rules', type=int, default=100, help='total rules (10 to 10000)')
+    parser.add_argument('--history', type=int, default=5000, help='command and audit rows to seed')
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--target', choices=['testclient', 'gunicorn'], default='testclient')
+    parser.add_argument('--storage', choices=['sqlite', 'memory'], default='sqlite',
+                        help='storage backend (memory isolates app overhead; testclient only)')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers')
+    parser.add_argument('--scenarios', help='comma separated subset of scenarios to run')
+    parser.add_argument('--output', help='write JSON results to this file instead of stdout')
+    parser.add_argument('--compare', help='previous JSON result to compare against')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    if not 10 <= args.rules <= 10000:
+        parser.error('--rules must be between 10 and 10000')
+    if args.storage == 'memory' and args.target == 'gunicorn':
+        parser.error('--storage memory is per process and only works with --target testclient')
+    random.seed(args.seed)
+
+    tmpdir = tempfile.mkdtemp(prefix='gateway-bench-')
+    db_path = os.path.join(tmpdir, 'bench.db')
+    # Keep the limiter on the hot path but never let it reject benchmark traffic
+    os.environ['DATABASE_PATH'] = db_path
+    os.environ['STORAGE_BACKEND'] = args.storage
+    os.environ['RATE_LIMIT_DB'] = os.path.join(tmpdir, 'rate_limits.db')
+    os.environ['IDEMPOTENCY_DB'] = os.path.join(tmpdir, 'idempotency.db')
+    os.environ.setdefault('RATE_LIMITS', json.dumps({k: [10 ** 9, 10 ** 9] for k in
+                                                     ('admin', 'lead', 'senior', 'mid', 'junior', 'unauthenticated')}))
+    proc = None
+    # The app prints debug lines on every request; keep them out of the results
+    quiet = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(quiet):
+            seed = seed_database(args.users, args.rules, args.history, 2 * args.requests)
+        if args.target == 'gunicorn':
+            proc, base_url = start_gunicorn(db_path, args.workers)
+            send = make_http_sender(base_url)
+        else:
+            send = make_test_client_sender()
+
+        scenarios = build_scenarios(seed, args.requests)
+        if args.scenarios:
+            wanted = set(args.scenarios.split(','))
+            scenarios = [s for s in scenarios if s[0] in wanted]
+
+        results = {}
+        for scenario in scenarios:
+            with contextlib.redirect_stdout(quiet):
+                results[scenario[0]] = run_scenario(send, scenario, args.requests, args.concurrency)
+            quiet.seek(0)
+            quiet.truncate()
+            print(f"{scenario[0]:<18} {results[scenario[0]]['rps']:>10.1f} req/s  "
+                  f"p50 {results[scenario[0]]['p50_ms']:.2f}ms  p99 {results[scenario[0]]['p99_ms']:.2f}ms",
+                  file=sys.stderr)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait(timeout=10)
+        for name in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir, name))
+        os.rmdir(tmpdir)
+
+    report = {
+        'benchmark': 'api',
+        'commit': git_commit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+        'results': results,
+    }
+
+    if args.compare:
+        compare(report, args.compare)
+
+    payload = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(payload + '\n')
+    else:
+        print(payload)
+
+
+if __name__ == '__main__':
+    main()
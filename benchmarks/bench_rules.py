@@ -0,0 +1,267 @@
+"""Rule-engine microbenchmark and differential correctness check.
+
+Times the first-match step of submit_command in isolation, comparing the
+reference ``re.search`` loop (rule_engine.find_matching_rule) with the
+precompiled RuleMatcher (with and without the rule profiler's counting) and
+with the decision cache on repeated commands,
+across rule-set sizes, pattern styles and command lengths. Results are JSON,
+like bench_api.py.
+
+    python benchmarks/bench_rules.py                       # full grid
+    python benchmarks/bench_rules.py --sizes 10,1000 --styles anchored
+    python benchmarks/bench_rules.py --check-only --check 20000   # differential test only
+    python benchmarks/bench_rules.py --db command_gateway.db   # profile a real rule set
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import string
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from regex_guard import RegexTimeout, analyze_pattern
+from rule_engine import RuleMatcher, decide, decision_cache, find_matching_rule
+from rule_profile import RuleProfiler
+
+ACTIONS = ['AUTO_ACCEPT', 'AUTO_REJECT', 'REQUIRE_APPROVAL']
+TIMEZONES = ['UTC', 'America/New_York', 'Europe/London', 'Asia/Kolkata', 'Australia/Sydney']
+WORDS = ['git', 'ls', 'cat', 'deploy', 'rm', 'kubectl', 'docker', 'make', 'npm', 'ssh',
+         'status', 'apply', 'build', '--force', '-rf', '/tmp', 'prod', 'staging', 'logs', 'echo']
+COMMAND_LENGTHS = {'short': 20, 'medium': 200, 'long': 2000}
+
+
+def make_rule(rule_id, pattern, time_start='', time_end='', tz='UTC'):
+    return {
+        'id': rule_id, 'pattern': pattern, 'action': ACTIONS[rule_id % 3],
+        'description': f'rule {rule_id}', 'approval_threshold': 1,
+        'time_start': time_start, 'time_end': time_end, 'timezone': tz,
+    }
+
+
+def generate_rules(style, count):
+    """Build a rule set of one pattern style; none of them match the filler commands"""
+    rules = []
+    for i in range(count):
+        if style == 'anchored':
+            rules.append(make_rule(i + 1, f'^tool{i}\\s+(run|check)'))
+        elif style == 'literal':
+            rules.append(make_rule(i + 1, f'deploy-service-{i} --force --region'))
+        elif style == 'alternation':
+            rules.append(make_rule(i + 1, f'(kubectl|docker|helm)\\s+rollout{i}\\b'))
+        elif style == 'timewindow':
+            start = f'{i % 24:02d}:00'
+            end = f'{(i + 8) % 24:02d}:30'
+            rules.append(make_rule(i + 1, f'^tool{i}\\s+', start, end, TIMEZONES[i % len(TIMEZONES)]))
+        else:
+            raise ValueError(f'Unknown style: {style}')
+    return rules
+
+
+def generate_command(length, rng):
+    words = []
+    size = 0
+    while size < length:
+        word = rng.choice(WORDS)
+        words.append(word)
+        size += len(word) + 1
+    return ' '.join(words)[:length]
+
+
+def time_matcher(fn, commands, min_time):
+    """Run fn over commands until min_time has elapsed; return mean seconds per call"""
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        for command in commands:
+            fn(command)
+        calls += len(commands)
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return elapsed / calls, calls
+
+
+def run_grid(sizes, styles, lengths, min_time, rng):
+    results = []
+    for style in styles:
+        for size in sizes:
+            rules = generate_rules(style, size)
+            build_start = time.perf_counter()
+            matcher = RuleMatcher(rules, profiler=None)
+            build_time = time.perf_counter() - build_start
+            profiled = RuleMatcher(rules, profiler=RuleProfiler(enabled=True))
+            for length_name in lengths:
+                commands = [generate_command(COMMAND_LENGTHS[length_name], rng) for _ in range(20)]
+                ref_mean, ref_calls = time_matcher(lambda c: find_matching_rule(rules, c), commands, min_time)
+                opt_mean, opt_calls = time_matcher(matcher.match, commands, min_time)
+                profiled_mean, profiled_calls = time_matcher(profiled.match, commands, min_time)
+                cached_mean, cached_calls = time_matcher(lambda c: decide(matcher, c), commands, min_time)
+                row = {
+                    'style': style,
+                    'rules': size,
+                    'command_length': length_name,
+                    'reference_us': round(ref_mean * 1e6, 3),
+                    'compiled_us': round(opt_mean * 1e6, 3),
+                    'profiled_us': round(profiled_mean * 1e6, 3),
+                    'cached_us': round(cached_mean * 1e6, 3),
+                    'speedup': round(ref_mean / opt_mean, 2) if opt_mean else None,
+                    'compile_ms': round(build_time * 1000, 3),
+                    'calls': {'reference': ref_calls, 'compiled': opt_calls, 'profiled': profiled_calls,
+                              'cached': cached_calls},
+                }
+                results.append(row)
+                print(f"{style:<12} {size:>6} {length_name:<7} ref {row['reference_us']:>12.1f}us  "
+                      f"compiled {row['compiled_us']:>10.1f}us  profiled {row['profiled_us']:>10.1f}us  cached {row['cached_us']:>6.1f}us  x{row['speedup']}",
+                      file=sys.stderr)
+    return results
+
+
+def random_pattern(rng):
+    """A random pattern drawn from the shapes admins actually write, plus some invalid ones"""
+    word = rng.choice(WORDS)
+    other = rng.choice(WORDS)
+    shapes = [
+        lambda: '^' + _escape(word),
+        lambda: _escape(word) + '\\s+' + _escape(other),
+        lambda: f'({_escape(word)}|{_escape(other)})',
+        lambda: _escape(word) + '$',
+        lambda: f'\\b{_escape(word)}\\b',
+        lambda: _escape(word)[:2] + '.*' + _escape(other)[-2:],
+        lambda: '[' + ''.join(rng.sample(string.ascii_lowercase, 3)) + ']{2}',
+        lambda: rng.choice(['(unclosed', '[a-', '*bad', 'a{2,1}']),  # invalid, must be skipped
+    ]
+    return rng.choice(shapes)()
+
+
+def _escape(word):
+    return word.replace('/', '\\/').replace('-', '\\-')
+
+
+def random_window(rng):
+    roll = rng.random()
+    if roll < 0.5:
+        return '', '', 'UTC'
+    start = f'{rng.randrange(24):02d}:{rng.choice(["00", "15", "30", "45"])}'
+    end = f'{rng.randrange(24):02d}:{rng.choice(["00", "15", "30", "45"])}'
+    tz = rng.choice(TIMEZONES + ['Not/AZone', None])  # bad zones fall back to "applies"
+    if roll < 0.55:
+        end = 'bogus'  # unparsable windows also fall back to "applies"
+    return start, end, tz
+
+
+def differential_check(iterations, rng):
+    """Compare RuleMatcher against the reference loop on random rule sets and commands"""
+    mismatches = 0
+    matched = 0
+    for i in range(iterations):
+        rules = []
+        for rule_id in range(1, rng.randint(1, 40) + 1):
+            start, end, tz = random_window(rng)
+            rules.append(make_rule(rule_id, random_pattern(rng), start, end, tz))
+        matcher = RuleMatcher(rules)
+        now = datetime(2026, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=rng.randrange(60 * 24 * 366))
+        for _ in range(10):
+            command = generate_command(rng.choice([5, 20, 80, 300]), rng)
+            expected = find_matching_rule(rules, command, now)
+            actual = matcher.match(command, now)
+            cached = decide(matcher, command, now)
+            expected_id = expected['id'] if expected else None
+            actual_id = actual['id'] if actual else None
+            matched += expected_id is not None
+            if expected_id != actual_id or (cached['id'] if cached else None) != expected_id:
+                mismatches += 1
+                if mismatches <= 5:
+                    print(json.dumps({'command': command, 'now': now.isoformat(), 'expected': expected_id,
+                                      'actual': actual_id, 'rules': rules}, default=str), file=sys.stderr)
+    return {'iterations': iterations, 'comparisons': iterations * 10, 'matched': matched, 'mismatches': mismatches,
+            'decision_cache': decision_cache.stats()}
+
+
+def profile_database(db_path, commands, min_time):
+    """Time every rule of a real rule set against sample commands, slowest first"""
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    rules = [dict(r) for r in conn.execute('SELECT * FROM rules ORDER BY id').fetchall()]
+    conn.close()
+
+    matcher = RuleMatcher(rules)
+    per_rule = []
+    for search, window, rule, guarded in matcher.entries:
+        entry = {'rule_id': rule['id'], 'pattern': rule['pattern'], 'guarded': guarded,
+                 'complexity': [issue['type'] for issue in analyze_pattern(rule['pattern'])]}
+        try:
+            mean, _ = time_matcher(search, commands, min_time / max(1, len(rules)))
+            entry['mean_us'] = round(mean * 1e6, 3)
+        except RegexTimeout:
+            entry['mean_us'] = None
+            entry['timed_out'] = True
+        per_rule.append(entry)
+    per_rule.sort(key=lambda r: float('inf') if r['mean_us'] is None else r['mean_us'], reverse=True)
+    total, _ = time_matcher(matcher.match, commands, min_time)
+    return {'database': db_path, 'rules': len(rules), 'compiled_rules': len(matcher),
+            'guarded_rules': matcher.guarded, 'match_us': round(total * 1e6, 3), 'slowest': per_rule[:20]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Rule-engine microbenchmark and differential check')
+    parser.add_argument('--sizes', default='10,100,1000,10000')
+    parser.add_argument('--styles', default='anchored,literal,alternation,timewindow')
+    parser.add_argument('--lengths', default='short,medium,long')
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds to spend per measurement')
+    parser.add_argument('--check', type=int, default=500, help='differential iterations (0 to skip)')
+    parser.add_argument('--check-only', action='store_true', help='skip the timing grid')
+    parser.add_argument('--db', help='profile the rules stored in this database instead of the grid')
+    parser.add_argument('--commands', help='file with one sample command per line (used with --db)')
+    parser.add_argument('--output', help='write JSON results to this file instead of stdout')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    report = {
+        'benchmark': 'rules',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'config': {k: v for k, v in vars(args).items() if k != 'output'},
+    }
+
+    if args.db:
+        if args.commands:
+            with open(args.commands) as f:
+                commands = [line.rstrip('\n') for line in f if line.strip()]
+        else:
+            commands = [generate_command(n, rng) for n in (20, 200, 2000) for _ in range(5)]
+        report['profile'] = profile_database(args.db, commands, args.min_time)
+    elif not args.check_only:
+        report['grid'] = run_grid(
+            [int(s) for s in args.sizes.split(',')],
+            args.styles.split(','),
+            args.lengths.split(','),
+            args.min_time,
+            rng,
+        )
+
+    if args.check:
+        report['differential'] = differential_check(args.check, rng)
+        print(f"differential: {report['differential']['mismatches']} mismatches in "
+              f"{report['differential']['comparisons']} comparisons", file=sys.stderr)
+
+    payload = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(payload + '\n')
+    else:
+        print(payload)
+
+    if report.get('differential', {}).get('mismatches'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
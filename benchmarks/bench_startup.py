@@ -0,0 +1,165 @@
+"""Startup benchmark: time to ready and first-request latency after a restart.
+
+Starts gunicorn against a seeded throwaway database in two modes and, as soon
+as it answers /api/health, sends one wave of concurrent command submissions
+(each on a new connection, so every worker gets some) followed by more waves
+once everything is warm:
+
+    lazy     gunicorn app:app - each worker compiles rules, loads timezone
+             data and imports modules on its first requests
+    preload  gunicorn -c gunicorn.conf.py 'app:create_app()' - setup and
+             warm-up run once in the master before forking
+
+The gap between first_wave and steady_wave latency is the post-restart spike.
+Results are JSON, like bench_api.py:
+
+    python benchmarks/bench_startup.py --rules 1000 --output startup.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench_api import SUBMIT_COMMANDS, free_port, git_commit, seed_database, summarize  # noqa: E402
+
+MODES = {
+    'lazy': lambda conf: ['-c', conf, 'app:app'],
+    'preload': lambda conf: ['-c', os.path.join(ROOT, 'gunicorn.conf.py'), 'app:create_app()'],
+}
+
+
+def start(mode, db_path, empty_conf, workers):
+    """Start gunicorn and return (proc, base_url, seconds until /api/health answered)"""
+    import requests
+
+    port = free_port()
+    env = dict(os.environ, DATABASE_PATH=db_path)
+    started = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-w', str(workers), '-b', f'127.0.0.1:{port}'] + MODES[mode](empty_conf),
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = started + 60
+    while time.perf_counter() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f'gunicorn ({mode}) exited during startup')
+        try:
+            if requests.get(base_url + '/api/health', timeout=1).status_code == 200:
+                return proc, base_url, time.perf_counter() - started
+        except requests.RequestException:
+            time.sleep(0.01)
+    proc.terminate()
+    raise RuntimeError(f'gunicorn ({mode}) did not start within 60s')
+
+
+def wave(base_url, api_key, size):
+    """size concurrent submissions, each on its own connection"""
+    import requests
+
+    def one(_):
+        start = time.perf_counter()
+        try:
+            status = requests.post(base_url + '/api/commands', json={'command_text': SUBMIT_COMMANDS['submit_nomatch']},
+                                   headers={'X-API-Key': api_key}, timeout=30).status_code
+        except requests.RequestException:
+            status = 0
+        return time.perf_counter() - start, status
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=size) as pool:
+        results = list(pool.map(one, range(size)))
+    latencies = [elapsed for elapsed, _ in results]
+    errors = sum(1 for _, status in results if status == 0 or status >= 400)
+    return summarize(latencies, errors, time.perf_counter() - wall_start)
+
+
+def run_mode(mode, db_path, empty_conf, seed, args):
+    proc, base_url, ready = start(mode, db_path, empty_conf, args.workers)
+    try:
+        first = wave(base_url, seed['member_key'], args.wave)
+        for _ in range(args.warm_waves):
+            wave(base_url, seed['member_key'], args.wave)
+        steady = wave(base_url, seed['member_key'], args.wave)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+    return {'ready_ms': round(ready * 1000, 1), 'first_wave': first, 'steady_wave': steady}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Gateway startup and first-request benchmark')
+    parser.add_argument('--rules', type=int, default=1000, help='total rules (10 to 10000)')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers')
+    parser.add_argument('--wave', type=int, default=16, help='concurrent requests per wave')
+    parser.add_argument('--warm-waves', type=int, default=5, help='waves between the first and the steady one')
+    parser.add_argument('--repeat', type=int, default=3, help='restarts per mode (best run is reported)')
+    parser.add_argument('--modes', default='lazy,preload', help='comma separated subset of: ' + ','.join(MODES))
+    parser.add_argument('--output', help='write JSON results to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    if not 10 <= args.rules <= 10000:
+        parser.error('--rules must be between 10 and 10000')
+    modes = args.modes.split(',')
+    unknown = set(modes) - set(MODES)
+    if unknown:
+        parser.error(f"unknown mode(s): {', '.join(sorted(unknown))}")
+
+    tmpdir = tempfile.mkdtemp(prefix='gateway-startup-')
+    db_path = os.path.join(tmpdir, 'bench.db')
+    empty_conf = os.path.join(tmpdir, 'lazy.conf.py')
+    open(empty_conf, 'w').close()
+    os.environ['DATABASE_PATH'] = db_path
+    os.environ['RATE_LIMIT_DB'] = os.path.join(tmpdir, 'rate_limits.db')
+    os.environ['IDEMPOTENCY_DB'] = os.path.join(tmpdir, 'idempotency.db')
+    os.environ.setdefault('RATE_LIMITS', json.dumps({k: [10 ** 9, 10 ** 9] for k in
+                                                     ('admin', 'lead', 'senior', 'mid', 'junior', 'unauthenticated')}))
+    results = {}
+    try:
+        # The lazy mode never creates the schema, so seed before either runs
+        with contextlib.redirect_stdout(io.StringIO()):
+            seed = seed_database(10, args.rules, 0, 0)
+        for mode in modes:
+            runs = [run_mode(mode, db_path, empty_conf, seed, args) for _ in range(args.repeat)]
+            best = min(runs, key=lambda run: run['first_wave']['p95_ms'])
+            results[mode] = best
+            print(f"{mode:<8} ready {best['ready_ms']:>8.1f}ms  "
+                  f"first p50 {best['first_wave']['p50_ms']:.2f}ms max {best['first_wave']['max_ms']:.2f}ms  "
+                  f"steady p50 {best['steady_wave']['p50_ms']:.2f}ms max {best['steady_wave']['max_ms']:.2f}ms",
+                  file=sys.stderr)
+    finally:
+        for name in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir, name))
+        os.rmdir(tmpdir)
+
+    report = {
+        'benchmark': 'startup',
+        'commit': git_commit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {k: v for k, v in vars(args).items() if k != 'output'},
+        'results': results,
+    }
+
+    payload = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(payload + '\n')
+    else:
+        print(payload)
+
+
+if __name__ == '__main__':
+    main()
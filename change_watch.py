@@ -0,0 +1,113 @@
+"""Cross-worker invalidation of in-process caches.
+
+Each gunicorn worker, on every host sharing the database, keeps its own
+caches, but a mutation runs in only one of them. Mutations bump per-resource
+counters in the shared database (storage.bump_versions). Before each request
+a worker compares the counters with the ones it saw last, and clears only the
+caches registered for the resources that moved.
+
+The comparison is cheap. The SQLite backend keeps the counters per connection
+and re-reads the table only when PRAGMA data_version shows another connection
+has committed since. With CHANGE_CHECK_INTERVAL_MS above 0 a worker checks at
+most that often, so its caches may lag other workers by up to that long.
+"""
+import os
+import threading
+import time
+
+CHANGE_CHECK_INTERVAL_MS = int(os.environ.get('CHANGE_CHECK_INTERVAL_MS', 0))
+
+
+class ChangeWatcher:
+    """Calls the invalidators registered for a resource when its version changes"""
+
+    def __init__(self, read_versions, interval_s=CHANGE_CHECK_INTERVAL_MS / 1000):
+        self._read_versions = read_versions  # resources -> tuple of versions, or None
+        self.interval_s = interval_s
+        self._listeners = {}  # resource -> [invalidate()]
+        self._seen = {}
+        self._lock = threading.Lock()
+        self._next_check = 0.0
+        self.checks = 0
+        self.invalidations = {}
+
+    def on_change(self, resource, invalidate):
+        self._listeners.setdefault(resource, []).append(invalidate)
+
+    def check(self):
+        """Invalidate the caches of resources changed since the last check; returns their names"""
+        now = time.monotonic()
+        if now < self._next_check or not self._listeners:
+            return []
+        self._next_check = now + self.interval_s
+        resources = tuple(self._listeners)
+        versions = self._read_versions(resources)
+        with self._lock:
+            self.checks += 1
+            if versions is None:
+                # Versioning unavailable: nothing cached can be trusted
+                changed = list(resources)
+            else:
+                changed = [resource for resource, version in zip(resources, versions)
+                           if self._seen.get(resource) != version]
+                self._seen.update(zip(resources, versions))
+            for resource in changed:
+                self.invalidations[resource] = self.invalidations.get(resource, 0) + 1
+        for resource in changed:
+            for invalidate in self._listeners[resource]:
+                invalidate()
+        return changed
+
+    def stats(self):
+        with self._lock:
+            return {'interval_ms': round(self.interval_s * 1000), 'checks': self.checks,
+                    'versions': dict(self._seen), 'invalidations': dict(self.invalidations)}
+
+
+class LocalCache:
+    """Bounded dict for a ChangeWatcher to clear.
+
+    A value loaded before a clear() is never stored after it: callers take
+    generation() before loading and pass it to put().
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def generation(self):
+        return self._generation
+
+    def put(self, key, value, generation):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            if generation != self._generation:
+                return
+            if len(self._entries) >= self.max_entries and key not in self._entries:
+                # Dropped wholesale: refilling costs one query per key
+                self._entries.clear()
+            self._entries[key] = value
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'max_entries': self.max_entries,
+                    'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,469 @@
+"""Execution of accepted commands.
+
+EXECUTION_MODE=mock (the default) keeps the old behavior: nothing runs and the
+output is a placeholder, produced inline by submit_command. With
+EXECUTION_MODE=sandbox, accepted commands are queued in the commands table
+(execution_status 'queued') and returned to the client at once. A bounded pool
+of threads in every server process claims queued commands and runs each one as
+a subprocess:
+
+    - as EXECUTION_USER, a separate OS account that cannot read the gateway's
+      database, audit file, backups or API keys (startup fails otherwise)
+    - argv from shlex.split, never a shell, so ';', '|' and '$(...)' are inert
+    - an empty temporary working directory and a minimal environment
+    - CPU, address-space, file-size and open-file rlimits
+    - a wall-clock timeout, after which the whole process group is killed
+    - an output cap, after which the command is killed
+
+Output is written to execution_output as it arrives, so any worker can stream
+it to the client, and moved to the output blob store when the command finishes. Because the queue is the database, claims are atomic across
+gunicorn workers and per-user concurrency limits (by tier) hold globally.
+
+A running command is leased to the process (host:pid) that claimed it, which
+renews the lease while it runs. Only commands whose lease ran out are marked
+interrupted, so a restarting server leaves other hosts' and masters' commands
+alone.
+"""
+import codecs
+import json
+import os
+import select
+import shlex
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+try:
+    import grp
+    import pwd
+    import resource
+except ImportError:  # Not available on Windows; the limits are skipped
+    grp = pwd = resource = None
+
+EXECUTION_MODE = os.environ.get('EXECUTION_MODE', 'mock')
+# Threads running commands per server process
+EXECUTION_WORKERS = int(os.environ.get('EXECUTION_WORKERS', 4))
+EXECUTION_TIMEOUT_S = float(os.environ.get('EXECUTION_TIMEOUT_S', 30))
+EXECUTION_CPU_SECONDS = int(os.environ.get('EXECUTION_CPU_SECONDS', 10))
+EXECUTION_MEMORY_MB = int(os.environ.get('EXECUTION_MEMORY_MB', 512))
+EXECUTION_OUTPUT_BYTES = int(os.environ.get('EXECUTION_OUTPUT_BYTES', 64 * 1024))
+# Submissions are refused (503) while this many commands are queued
+EXECUTION_QUEUE_LIMIT = int(os.environ.get('EXECUTION_QUEUE_LIMIT', 1000))
+# How often idle executors look for work queued by other processes
+EXECUTION_POLL_S = float(os.environ.get('EXECUTION_POLL_MS', 500)) / 1000.0
+# Running commands are leased for this long and renewed every third of it; a
+# command whose lease runs out was left by a dead process
+EXECUTION_LEASE_S = float(os.environ.get('EXECUTION_LEASE_S', 60))
+# OS account (and optionally group) commands run as; the gateway switches to it
+# in the child, so it must run as root or with CAP_SETUID/CAP_SETGID/CAP_CHOWN
+EXECUTION_USER = os.environ.get('EXECUTION_USER', '')
+EXECUTION_GROUP = os.environ.get('EXECUTION_GROUP', '')
+
+if EXECUTION_MODE not in ('mock', 'sandbox'):
+    EXECUTION_MODE = 'mock'
+
+# Commands one user may have running at once, by role for admins and by tier
+DEFAULT_CONCURRENCY_LIMITS = {
+    'admin': 4,
+    'lead': 4,
+    'senior': 2,
+    'mid': 2,
+    'junior': 1,
+}
+CONCURRENCY_LIMITS = dict(DEFAULT_CONCURRENCY_LIMITS)
+CONCURRENCY_LIMITS.update(json.loads(os.environ.get('EXECUTION_CONCURRENCY', '{}')))
+
+# Finished states stored in execution_status
+STATUS_MESSAGES = {
+    'timed_out': f'[Timed out after {EXECUTION_TIMEOUT_S:g}s]',
+    'output_limit': f'[Output truncated at {EXECUTION_OUTPUT_BYTES} bytes, command stopped]',
+}
+
+# Output is written to storage at most this often while a command runs
+_FLUSH_INTERVAL = 0.25
+_FILE_SIZE_BYTES = 16 * 1024 * 1024
+_OPEN_FILES = 256
+
+
+class SandboxUnavailable(RuntimeError):
+    """Commands could reach the gateway's own files, so sandbox mode must not start"""
+
+
+def concurrency_limit(job):
+    key = 'admin' if job.get('role') == 'admin' else job.get('tier') or 'junior'
+    return CONCURRENCY_LIMITS.get(key, CONCURRENCY_LIMITS['junior'])
+
+
+def mock_output(command_text):
+    return f'[MOCKED] Executed: {command_text}'
+
+
+def _sandbox_env(workdir):
+    # Nothing from the gateway's environment (API tokens, SMTP passwords) leaks in
+    return {
+        'PATH': os.environ.get('EXECUTION_PATH', '/usr/local/bin:/usr/bin:/bin'),
+        'HOME': workdir,
+        'TMPDIR': workdir,
+        'LANG': 'C.UTF-8',
+    }
+
+
+def sandbox_identity():
+    """(uid, gid) commands run as; SandboxUnavailable unless that is an unprivileged, separate account"""
+    if pwd is None:
+        raise SandboxUnavailable('Sandbox mode needs a POSIX system')
+    if not EXECUTION_USER:
+        raise SandboxUnavailable('EXECUTION_USER is not set; commands would run as the gateway user')
+    try:
+        account = pwd.getpwnam(EXECUTION_USER)
+        gid = grp.getgrnam(EXECUTION_GROUP).gr_gid if EXECUTION_GROUP else account.pw_gid
+    except KeyError as e:
+        raise SandboxUnavailable(f'Unknown user or group: {e.args[0]}')
+    if account.pw_uid in (0, os.getuid()) or gid == 0:
+        raise SandboxUnavailable(f'EXECUTION_USER {EXECUTION_USER} must be an unprivileged account other than '
+                                 f'the one the gateway runs as')
+    return account.pw_uid, gid
+
+
+def _limits():
+    return {
+        'cpu': EXECUTION_CPU_SECONDS,
+        'memory': EXECUTION_MEMORY_MB * 1024 * 1024,
+        'fsize': _FILE_SIZE_BYTES,
+        'nofile': _OPEN_FILES,
+    }
+
+
+def _apply_limits(limits):
+    if resource is None:
+        return
+    for name, value in (('RLIMIT_CPU', limits['cpu']), ('RLIMIT_AS', limits['memory']),
+                        ('RLIMIT_FSIZE', limits['fsize']), ('RLIMIT_NOFILE', limits['nofile']),
+                        ('RLIMIT_CORE', 0)):
+        if hasattr(resource, name):
+            resource.setrlimit(getattr(resource, name), (value, value))
+
+
+def _drop_privileges(uid, gid):
+    # Groups first: once the uid changes they can no longer be changed
+    os.setgroups([])
+    os.setgid(gid)
+    os.setuid(uid)
+
+
+def _exposed(paths):
+    """Those of paths the current user can read or write, or could once they are created"""
+    exposed = []
+    for path in paths:
+        nearest = path
+        while not os.path.exists(nearest) and os.path.dirname(nearest) != nearest:
+            nearest = os.path.dirname(nearest)
+        if nearest != path or os.path.isdir(path):
+            # A directory the user can enter, or the files that will be made in it
+            reachable = os.access(nearest, os.X_OK) or os.access(nearest, os.W_OK)
+        else:
+            reachable = os.access(path, os.R_OK) or os.access(path, os.W_OK)
+        if reachable:
+            exposed.append(path)
+    return exposed
+
+
+def _trampoline(uid, gid, **settings):
+    """argv that starts this file as the sandbox trampoline"""
+    return [sys.executable, '-I', os.path.abspath(__file__), json.dumps(dict(_limits(), uid=uid, gid=gid, **settings))]
+
+
+def check_sandbox(paths):
+    """SandboxUnavailable unless EXECUTION_USER can switch in and reach none of paths.
+
+    The probe runs through the same trampoline as commands, so it also fails
+    when the gateway lacks the privileges to switch users.
+    """
+    uid, gid = sandbox_identity()
+    paths = [os.path.abspath(path) for path in paths]
+    # SQLite's side files hold recent writes too
+    paths += [path + suffix for path in paths for suffix in ('-wal', '-shm', '-journal') if os.path.exists(path + suffix)]
+    result = subprocess.run(_trampoline(uid, gid, probe=paths), stdin=subprocess.DEVNULL, capture_output=True,
+                            text=True, cwd='/', env=_sandbox_env('/'), timeout=30)
+    if result.returncode != 0:
+        raise SandboxUnavailable(f'Cannot run commands as {EXECUTION_USER}: {result.stderr.strip()}')
+    exposed = json.loads(result.stdout)
+    if exposed:
+        raise SandboxUnavailable(f'{EXECUTION_USER} can read or write {", ".join(exposed)}; keep the gateway\'s '
+                                 f'files in a directory only the gateway user can enter')
+    return uid, gid
+
+
+def _kill(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def run_sandboxed(command_text, on_output):
+    """Run a command under the sandbox limits; on_output(text) gets output as it arrives.
+
+    Returns (execution_status, exit_code). The child is started through this
+    file, which applies the rlimits, switches to EXECUTION_USER and then execs
+    the command, so nothing runs between fork and exec in the (threaded)
+    server process.
+    """
+    try:
+        argv = shlex.split(command_text)
+    except ValueError as e:
+        on_output(f'Cannot parse command: {e}\n')
+        return 'failed', None
+    if not argv:
+        return 'failed', None
+
+    uid, gid = sandbox_identity()
+    workdir = tempfile.mkdtemp(prefix='gateway-job-')
+    try:
+        os.chown(workdir, uid, gid)
+        proc = subprocess.Popen(
+            _trampoline(uid, gid) + argv,
+            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            cwd=workdir, env=_sandbox_env(workdir), start_new_session=True
+        )
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        deadline = time.monotonic() + EXECUTION_TIMEOUT_S
+        fd = proc.stdout.fileno()
+        size = 0
+        state = None
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                state = 'timed_out'
+                break
+            ready, _, _ = select.select([fd], [], [], min(remaining, 1.0))
+            if not ready:
+                continue
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            if size + len(chunk) > EXECUTION_OUTPUT_BYTES:
+                chunk = chunk[:EXECUTION_OUTPUT_BYTES - size]
+                state = 'output_limit'
+            size += len(chunk)
+            on_output(decoder.decode(chunk))
+            if state:
+                break
+
+        if state is None:
+            # Output closed; the process may still be finishing
+            try:
+                proc.wait(timeout=max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                state = 'timed_out'
+        if state:
+            _kill(proc)
+        exit_code = proc.wait()
+        proc.stdout.close()
+        tail = decoder.decode(b'', final=True)
+        if state:
+            tail += '\n' + STATUS_MESSAGES[state] + '\n'
+        if tail:
+            on_output(tail)
+        return state or ('succeeded' if exit_code == 0 else 'failed'), exit_code
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+class Executor:
+    """Pool of threads that claim queued commands from storage and run them"""
+
+    def __init__(self, storage, workers=EXECUTION_WORKERS):
+        self.storage = storage
+        self.workers = workers
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+        self.owner = None
+        self._active = set()  # Commands this process is running, by id
+        self._running = 0
+        self._completed = 0
+
+    def start(self):
+        """Start the pool in this process (again after a fork); no-op in mock mode"""
+        if EXECUTION_MODE != 'sandbox':
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.owner = f'{socket.gethostname()}:{self._pid}'
+            self._active = set()
+            self._stop.clear()
+            self._threads = [threading.Thread(target=self._loop, name=f'executor-{i}', daemon=True)
+                             for i in range(self.workers)]
+            self._threads.append(threading.Thread(target=self._lease_loop, name='executor-lease', daemon=True))
+            for thread in self._threads:
+                thread.start()
+
+    def stop(self):
+        with self._lock:
+            self._pid = None
+        self._stop.set()
+        self._wake.set()
+
+    def notify(self):
+        """Wake this process's pool for a command it just queued"""
+        self.start()
+        self._wake.set()
+
+    def recover(self):
+        """Mark commands whose process died (their lease ran out) as interrupted"""
+        count = self.storage.interrupt_running(datetime.now())
+        if count:
+            print(f"[EXECUTOR] Marked {count} interrupted command(s)")
+        return count
+
+    def queue_full(self):
+        return self.storage.count_queued() >= EXECUTION_QUEUE_LIMIT
+
+    def stats(self):
+        return {
+            'mode': EXECUTION_MODE,
+            'workers': self.workers if self._pid == os.getpid() else 0,
+            'running': self._running,
+            'completed': self._completed,
+            'queued': self.storage.count_queued(),
+            'concurrency_limits': CONCURRENCY_LIMITS,
+        }
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                job = self._claim()
+            except Exception as e:
+                print(f"[EXECUTOR] Could not claim a command: {e}")
+                job = None
+            if job is None:
+                self._wake.wait(EXECUTION_POLL_S)
+                self._wake.clear()
+                continue
+            try:
+                self._run(job)
+            except Exception as e:
+                print(f"[EXECUTOR] Command {job['id']} failed: {e}")
+
+    def _lease_loop(self):
+        """Renew this process's leases, and now and then recover commands of dead ones"""
+        last_recovery = time.monotonic()
+        while not self._stop.wait(EXECUTION_LEASE_S / 3):
+            try:
+                self._renew()
+                if time.monotonic() - last_recovery >= EXECUTION_LEASE_S:
+                    last_recovery = time.monotonic()
+                    self.recover()
+            except Exception as e:
+                print(f"[EXECUTOR] Could not renew leases: {e}")
+
+    def _renew(self, claimed=None):
+        # Under the write lock, so a concurrent claim is either in the set or not yet committed
+        with self.storage.transaction():
+            with self._lock:
+                if claimed is not None:
+                    self._active.add(claimed)
+                active = list(self._active)
+            self.storage.lease_commands(self.owner, active, EXECUTION_LEASE_S)
+
+    def _claim(self):
+        """Mark the oldest runnable queued command as running, leased to this process, and return it"""
+        # Cheap read first so idle pools do not take the write lock
+        if not self.storage.queued_commands(1):
+            return None
+        with self.storage.transaction():
+            running = self.storage.running_counts()
+            for job in self.storage.queued_commands(100):
+                if running.get(job['user_id'], 0) < concurrency_limit(job):
+                    self.storage.update_command(job['id'], {'execution_status': 'running'})
+                    try:
+                        self._renew(claimed=job['id'])
+                    except BaseException:
+                        with self._lock:
+                            self._active.discard(job['id'])
+                        raise
+                    return job
+        return None
+
+    def _run(self, job):
+        # Imported here: this file doubles as the sandbox trampoline, which
+        # runs isolated (python -I) and must only need the standard library
+        from output_store import save_output
+
+        command_id = job['id']
+        output = []
+        last_flush = [time.monotonic()]
+
+        def on_output(text):
+            output.append(text)
+            now = time.monotonic()
+            if now - last_flush[0] >= _FLUSH_INTERVAL:
+                self.storage.update_command(command_id, {'execution_output': ''.join(output)})
+                last_flush[0] = now
+
+        with self._lock:
+            self._running += 1
+        try:
+            try:
+                status, exit_code = run_sandboxed(job['command_text'], on_output)
+            except (OSError, SandboxUnavailable) as e:
+                output.append(f'Could not start command: {e}\n')
+                status, exit_code = 'failed', None
+            try:
+                with self.storage.transaction():
+                    self.storage.update_command(command_id, dict(
+                        save_output(self.storage, ''.join(output)),
+                        status='executed',
+                        execution_status=status,
+                        exit_code=exit_code,
+                        executed_at=datetime.now(),
+                    ))
+                    action = 'command_executed' if status == 'succeeded' else 'command_failed'
+                    self.storage.add_audit(job['user_id'], action,
+                                           f'Command {command_id} finished ({status}, exit {exit_code}): {job["command_text"]}')
+            except Exception as e:
+                # Never leave it running, holding one of its user's concurrency slots:
+                # a single update, with the output kept inline
+                print(f"[EXECUTOR] Could not record the result of command {command_id}: {e}")
+                self.storage.update_command(command_id, {
+                    'status': 'executed',
+                    'execution_status': 'failed',
+                    'exit_code': exit_code,
+                    'execution_output': ''.join(output) + f'\n[Could not record the result: {e}]\n',
+                    'executed_at': datetime.now(),
+                })
+        finally:
+            with self._lock:
+                self._active.discard(command_id)
+                self._running -= 1
+                self._completed += 1
+
+
+if __name__ == '__main__':
+    # Sandbox trampoline: executor.py SETTINGS_JSON ARGV...
+    settings = json.loads(sys.argv[1])
+    _apply_limits(settings)
+    try:
+        _drop_privileges(settings['uid'], settings['gid'])
+    except OSError as e:
+        sys.stderr.write(f'Cannot switch to uid {settings["uid"]}: {e.strerror}\n')
+        sys.exit(126)
+    if 'probe' in settings:
+        sys.stdout.write(json.dumps(_exposed(settings['probe'])))
+        sys.exit(0)
+    try:
+        os.execvp(sys.argv[2], sys.argv[2:])
+    except OSError as e:
+        sys.stderr.write(f'{sys.argv[2]}: {e.strerror}\n')
+        sys.exit(127)
@@ -0,0 +1,27 @@
+"""gunicorn settings for the gateway (used by the Procfile).
+
+    gunicorn -c gunicorn.conf.py 'app:create_app()'
+
+The app is imported, migrated, seeded and warmed once in the master, then
+forked, so workers share the compiled rules, timezone data and imported
+modules copy-on-write and serve their first request at full speed. Each
+worker opens its own SQLite handles after the fork.
+"""
+import gc
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 4))
+preload_app = True
+
+
+def when_ready(server):
+    # Runs in the master after the app is loaded and before workers fork: move
+    # everything allocated so far out of the collector's reach, so collections
+    # in the workers do not touch (and copy) the shared pages
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import app
+    app.worker_init()
@@ -0,0 +1,167 @@
+"""Idempotency-Key support for POSTs that must not run twice.
+
+A client that retries a request with the same Idempotency-Key header gets
+the response of the first attempt replayed, not a second command, credit
+deduction or vote. Keys are scoped to the caller and the route and are bound
+to a hash of the request body, so reusing a key for a different request is
+refused.
+
+The first request claims the key. A concurrent duplicate waits for that claim
+to be completed and then replays the stored response. It polls, since the
+claim may be held by another gunicorn worker. A claim left behind by a
+crashed process lapses after IDEMPOTENCY_LOCK_S, and the next retry does the
+work. Responses are kept for IDEMPOTENCY_TTL_S in a small SQLite file shared
+by all workers, like the rate limiter's buckets.
+"""
+import hashlib
+import json
+import os
+import random
+import secrets
+import sqlite3
+import threading
+import time
+
+IDEMPOTENCY_DB = os.environ.get('IDEMPOTENCY_DB', 'idempotency.db')
+# How long a completed response is replayed
+IDEMPOTENCY_TTL_S = int(os.environ.get('IDEMPOTENCY_TTL_S', 24 * 3600))
+# How long a claim holds the key before it is assumed dead
+IDEMPOTENCY_LOCK_S = float(os.environ.get('IDEMPOTENCY_LOCK_S', 30))
+# How long a duplicate waits for the first request before giving up (409)
+IDEMPOTENCY_WAIT_S = float(os.environ.get('IDEMPOTENCY_WAIT_S', 10))
+
+MAX_KEY_LENGTH = 255
+# Headers stored with a response and replayed
+REPLAY_HEADERS = ('Content-Type', 'Location', 'Retry-After')
+
+_POLL_SECONDS = 0.02
+
+
+def store_key(user_id, method, path, key):
+    """Stored form of a client key: scoped to caller and route, and never kept raw"""
+    return hashlib.sha256(f'{user_id}\0{method}\0{path}\0{key}'.encode()).hexdigest()[:32]
+
+
+def request_hash(body):
+    return hashlib.sha256(body).hexdigest()[:32]
+
+
+class IdempotencyStore:
+    """Claims and stored responses, shared by all worker processes through a small SQLite file"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._initialized = False
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            if not self._initialized:
+                conn.execute('''CREATE TABLE IF NOT EXISTS idempotency_keys
+                                (key TEXT PRIMARY KEY,
+                                 request_hash TEXT NOT NULL,
+                                 claim TEXT,
+                                 status INTEGER,
+                                 headers TEXT,
+                                 body BLOB,
+                                 claimed_at REAL NOT NULL,
+                                 expires_at REAL NOT NULL)''')
+                self._initialized = True
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _live(self, row, now):
+        """A stored row that still counts: a response within its TTL, or a claim within its lock time"""
+        if row is None:
+            return None
+        hashed, status, headers, body, claimed_at, expires_at = row
+        if status is None and claimed_at + IDEMPOTENCY_LOCK_S <= now:
+            return None
+        if expires_at <= now:
+            return None
+        return {'request_hash': hashed, 'status': status, 'headers': json.loads(headers or '[]'), 'body': body}
+
+    def _get(self, conn, key):
+        return conn.execute(
+            'SELECT request_hash, status, headers, body, claimed_at, expires_at FROM idempotency_keys WHERE key = ?',
+            (key,)
+        ).fetchone()
+
+    def _claim(self, key, hashed, claim):
+        """Claim key, or return the live record that holds it"""
+        now = time.time()
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            record = self._live(self._get(conn, key), now)
+            if record is None:
+                conn.execute(
+                    """INSERT OR REPLACE INTO idempotency_keys
+                       (key, request_hash, claim, status, headers, body, claimed_at, expires_at)
+                       VALUES (?, ?, ?, NULL, NULL, NULL, ?, ?)""",
+                    (key, hashed, claim, now, now + IDEMPOTENCY_TTL_S)
+                )
+                if random.random() < 0.01:
+                    conn.execute('DELETE FROM idempotency_keys WHERE expires_at < ?', (now,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return record
+
+    def begin(self, key, hashed, wait=IDEMPOTENCY_WAIT_S):
+        """Claim key for a request, or find the response stored for it.
+
+        Returns one of:
+            ('run', claim)        the caller does the work, then complete() or release() with claim
+            ('replay', record)    a finished duplicate; record has status, headers and body
+            ('mismatch', None)    the key was used for a different request body
+            ('busy', None)        the first request was still running after wait seconds
+        """
+        deadline = time.monotonic() + wait
+        while True:
+            # A plain read first: replays never take the write lock
+            record = self._live(self._get(self._conn(), key), time.time())
+            if record is None:
+                claim = secrets.token_hex(8)
+                record = self._claim(key, hashed, claim)
+                if record is None:
+                    return 'run', claim
+            if record['request_hash'] != hashed:
+                return 'mismatch', None
+            if record['status'] is not None:
+                return 'replay', record
+            if time.monotonic() >= deadline:
+                return 'busy', None
+            time.sleep(_POLL_SECONDS)
+
+    def complete(self, key, claim, status, headers, body):
+        """Store the response for a key this request claimed (unless its claim lapsed and was taken over)"""
+        now = time.time()
+        self._conn().execute(
+            """UPDATE idempotency_keys SET status = ?, headers = ?, body = ?, expires_at = ?
+               WHERE key = ? AND claim = ? AND status IS NULL""",
+            (status, json.dumps(headers), body, now + IDEMPOTENCY_TTL_S, key, claim)
+        )
+
+    def release(self, key, claim):
+        """Give up a claim without storing a response, so a retry does the work"""
+        self._conn().execute('DELETE FROM idempotency_keys WHERE key = ? AND claim = ? AND status IS NULL',
+                             (key, claim))
+
+    def stats(self):
+        now = time.time()
+        stored, claimed = self._conn().execute(
+            '''SELECT COUNT(status), COUNT(*) - COUNT(status) FROM idempotency_keys
+               WHERE expires_at > ? AND (status IS NOT NULL OR claimed_at > ?)''',
+            (now, now - IDEMPOTENCY_LOCK_S)
+        ).fetchone()
+        return {'stored_responses': stored, 'in_progress': claimed, 'ttl_s': IDEMPOTENCY_TTL_S}
+
+
+idempotency = IdempotencyStore(IDEMPOTENCY_DB)
@@ -0,0 +1,498 @@
+"""Scheduled maintenance of the SQLite databases, run by one elected worker.
+
+Every server process starts a maintenance thread, but only the holder of a
+lease (a row in MAINTENANCE_DB, renewed while it works) runs tasks, so a
+gunicorn restart or a dead worker hands the job to another process within
+MAINTENANCE_LEASE_S. The tasks, each on its own interval and only inside the
+low-traffic window MAINTENANCE_WINDOW (UTC hours), on the main database file
+and on the audit file:
+
+    backup      a consistent snapshot through SQLite's online backup API,
+                copied MAINTENANCE_BACKUP_PAGES pages per step with a pause
+                between steps, then integrity-checked; old ones are pruned
+    optimize    ANALYZE the first time, PRAGMA optimize after that
+    checkpoint  PRAGMA wal_checkpoint(TRUNCATE), so the WAL file shrinks back
+    vacuum      PRAGMA incremental_vacuum, a few pages per write transaction
+
+plus jobs that work through the storage layer rather than on files:
+
+    reconcile_credits   release credit reservations left by decided or deleted
+                        commands and check every balance against the credit
+                        ledger (Storage.reconcile_credits)
+
+A backup that keeps being restarted by concurrent writes is finished in one
+step: in WAL mode that holds only a read snapshot, which never blocks writers.
+The last run of each task (status, duration, detail) is kept in
+MAINTENANCE_DB for GET /api/admin/maintenance.
+
+Command line (run from the app directory):
+
+    python maintenance.py status
+    python maintenance.py run backup|optimize|checkpoint|vacuum|reconcile_credits
+    python maintenance.py verify BACKUP_FILE
+    python maintenance.py vacuum-full    # offline: enables incremental vacuum on an older database
+"""
+import json
+import os
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+MAINTENANCE_ENABLED = os.environ.get('MAINTENANCE_ENABLED', '1') == '1'
+MAINTENANCE_DB = os.environ.get('MAINTENANCE_DB', 'maintenance.db')
+# Low-traffic hours (UTC) in which tasks may start, 'start-end'; empty means any time
+MAINTENANCE_WINDOW = os.environ.get('MAINTENANCE_WINDOW', '02-05')
+MAINTENANCE_POLL_S = float(os.environ.get('MAINTENANCE_POLL_S', 60))
+MAINTENANCE_LEASE_S = float(os.environ.get('MAINTENANCE_LEASE_S', 300))
+MAINTENANCE_BACKUP_DIR = os.environ.get('MAINTENANCE_BACKUP_DIR', 'backups')
+MAINTENANCE_BACKUP_KEEP = int(os.environ.get('MAINTENANCE_BACKUP_KEEP', 7))
+MAINTENANCE_BACKUP_PAGES = int(os.environ.get('MAINTENANCE_BACKUP_PAGES', 256))
+MAINTENANCE_BACKUP_SLEEP_MS = float(os.environ.get('MAINTENANCE_BACKUP_SLEEP_MS', 20))
+MAINTENANCE_VACUUM_PAGES = int(os.environ.get('MAINTENANCE_VACUUM_PAGES', 500))
+
+# Hours between runs of each task; 0 disables it
+TASK_INTERVALS_H = {
+    'backup': float(os.environ.get('MAINTENANCE_BACKUP_INTERVAL_H', 24)),
+    'optimize': float(os.environ.get('MAINTENANCE_OPTIMIZE_INTERVAL_H', 24)),
+    'checkpoint': float(os.environ.get('MAINTENANCE_CHECKPOINT_INTERVAL_H', 1)),
+    'vacuum': float(os.environ.get('MAINTENANCE_VACUUM_INTERVAL_H', 24)),
+    'reconcile_credits': float(os.environ.get('MAINTENANCE_RECONCILE_INTERVAL_H', 24)),
+}
+
+# Restarts after which a paged backup is finished in a single step
+_BACKUP_MAX_RESTARTS = 3
+_LEASE = 'maintenance'
+
+
+class _BackupRestarted(Exception):
+    pass
+
+
+def in_window(hour, window=MAINTENANCE_WINDOW):
+    """Whether the UTC hour falls in a 'start-end' window (which may wrap past midnight)"""
+    if not window:
+        return True
+    start, end = (int(part) for part in window.split('-'))
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+
+def _connect(path):
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    return conn
+
+
+def backup(db_path, target_dir=MAINTENANCE_BACKUP_DIR, keep=MAINTENANCE_BACKUP_KEEP, on_progress=None):
+    """Snapshot db_path into target_dir, verify it and prune old snapshots; returns a detail dict"""
+    os.makedirs(target_dir, exist_ok=True)
+    name = f"{os.path.splitext(os.path.basename(db_path))[0]}-{datetime.now(timezone.utc):%Y%m%d-%H%M%S}.db"
+    final = os.path.join(target_dir, name)
+    partial = final + '.partial'
+    restarts = 0
+    remaining_before = None
+
+    def progress(status, remaining, total):
+        nonlocal restarts, remaining_before
+        if remaining_before is not None and remaining > remaining_before:
+            restarts += 1  # Another connection wrote to the database; SQLite started over
+            if restarts > _BACKUP_MAX_RESTARTS:
+                raise _BackupRestarted
+        remaining_before = remaining
+        if on_progress:
+            on_progress()
+        # Between steps the source is unlocked, so writers and checkpoints get their turn
+        time.sleep(MAINTENANCE_BACKUP_SLEEP_MS / 1000.0)
+
+    source = _connect(db_path)
+    try:
+        target = sqlite3.connect(partial)
+        try:
+            try:
+                source.backup(target, pages=MAINTENANCE_BACKUP_PAGES, progress=progress)
+                single_step = False
+            except _BackupRestarted:
+                source.backup(target)
+                single_step = True
+            # The copy inherits the source's WAL mode; a standalone snapshot
+            # should be a single file, with no -wal/-shm left by later readers
+            target.execute('PRAGMA journal_mode=DELETE')
+        finally:
+            target.close()
+    finally:
+        source.close()
+    os.replace(partial, final)
+
+    check = verify_backup(final, restore=False)
+    if not check['ok']:
+        raise RuntimeError(f"backup {final} failed verification: {check.get('error') or check['integrity']}")
+    pruned = _prune(target_dir, os.path.splitext(os.path.basename(db_path))[0], keep)
+    return {'file': final, 'bytes': os.path.getsize(final), 'restarts': restarts, 'single_step': single_step,
+            'pruned': pruned}
+
+
+def _prune(target_dir, prefix, keep):
+    snapshots = sorted(f for f in os.listdir(target_dir) if f.startswith(prefix + '-') and f.endswith('.db'))
+    removed = snapshots[:-keep] if keep > 0 else []
+    for name in removed:
+        for suffix in ('', '-wal', '-shm', '-journal'):
+            try:
+                os.remove(os.path.join(target_dir, name + suffix))
+            except FileNotFoundError:
+                pass
+    return removed
+
+
+def verify_backup(path, restore=True):
+    """Check that a backup file is intact and, with restore, that the app can open a restored copy.
+
+    The restore is made into a temporary file through the backup API (the way a
+    real restore would be copied), migrated with init_schema and queried.
+    """
+    from storage_sqlite import SCHEMA_VERSION, SQLiteStorage
+
+    result = {'file': path, 'ok': False}
+    if not os.path.isfile(path):
+        result['error'] = 'no such file'
+        return result
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        result['integrity'] = '; '.join(row[0] for row in conn.execute('PRAGMA integrity_check'))
+        result['schema_version'] = conn.execute('PRAGMA user_version').fetchone()[0]
+        tables = [row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name")]
+        result['rows'] = {table: conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0] for table in tables}
+        result['ok'] = result['integrity'] == 'ok'
+        # The audit file has no users to restore into the app; its integrity check is the test
+        if result['ok'] and restore and 'users' in tables:
+            with tempfile.TemporaryDirectory() as workdir:
+                restored_path = os.path.join(workdir, 'restored.db')
+                restored = sqlite3.connect(restored_path)
+                conn.backup(restored)
+                restored.close()
+                storage = SQLiteStorage(restored_path)
+                storage.init_schema()
+                result['restored'] = {'users': len(storage.list_users()), 'rules': len(storage.list_rules()),
+                                      'admins': len(storage.list_admins())}
+                storage.close()
+                result['ok'] = result['restored']['admins'] > 0
+        if result['schema_version'] < SCHEMA_VERSION:
+            result['note'] = f'schema version {result["schema_version"]} is migrated to {SCHEMA_VERSION} on restore'
+    except sqlite3.DatabaseError as e:
+        result['ok'] = False
+        result['error'] = str(e)
+    finally:
+        conn.close()
+    return result
+
+
+def optimize(db_path):
+    """Refresh the query planner's statistics (a bounded ANALYZE)"""
+    conn = _connect(db_path)
+    try:
+        conn.execute('PRAGMA analysis_limit=1000')
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone() is None:
+            conn.execute('ANALYZE')
+            return {'ran': 'ANALYZE'}
+        conn.execute('PRAGMA optimize')
+        return {'ran': 'PRAGMA optimize'}
+    finally:
+        conn.close()
+
+
+def checkpoint(db_path):
+    """Copy the WAL into the database and truncate it"""
+    conn = _connect(db_path)
+    try:
+        busy, wal_pages, moved = conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+        if busy:
+            raise RuntimeError(f'checkpoint blocked by readers ({moved} of {wal_pages} WAL pages copied)')
+        return {'wal_pages': wal_pages, 'checkpointed': moved}
+    finally:
+        conn.close()
+
+
+def vacuum(db_path, step=MAINTENANCE_VACUUM_PAGES):
+    """Return free pages to the filesystem, a few at a time so each write lock is short"""
+    conn = _connect(db_path)
+    try:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            return {'skipped': 'auto_vacuum is not INCREMENTAL; run `python maintenance.py vacuum-full` once, offline'}
+        free_before = free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        while free:
+            # executescript steps the pragma to completion (execute() would free a single page)
+            conn.executescript(f'PRAGMA incremental_vacuum({min(free, step)})')
+            remaining = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            if remaining >= free:
+                break
+            free = remaining
+            time.sleep(0.01)
+        return {'freed_pages': free_before - free, 'page_size': conn.execute('PRAGMA page_size').fetchone()[0]}
+    finally:
+        conn.close()
+
+
+def vacuum_full(db_path):
+    """Switch an existing database to incremental auto-vacuum (rewrites the file; run with the app stopped)"""
+    conn = _connect(db_path)
+    try:
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.execute('VACUUM')
+        return {'auto_vacuum': conn.execute('PRAGMA auto_vacuum').fetchone()[0]}
+    finally:
+        conn.close()
+
+
+TASKS = {
+    'backup': backup,
+    'optimize': optimize,
+    'checkpoint': checkpoint,
+    'vacuum': vacuum,
+}
+
+
+class Maintenance:
+    """Lease election, scheduling and the last-run record, shared by all workers through MAINTENANCE_DB"""
+
+    def __init__(self, db_paths, jobs=None, state_path=MAINTENANCE_DB, enabled=MAINTENANCE_ENABLED):
+        self.db_paths = list(db_paths)
+        # Storage-level jobs, name -> callable returning a detail dict; run once per pass, not per file
+        self.jobs = dict(jobs or {})
+        self.tasks = [task for task in TASK_INTERVALS_H if task in TASKS or task in self.jobs]
+        self.state_path = state_path
+        self.enabled = enabled and bool(self.db_paths)
+        self.holder = f'{socket.gethostname()}:{os.getpid()}'
+        self._local = threading.local()
+        self._initialized = False
+        self._thread = None
+        self._stop = threading.Event()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.state_path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            if not self._initialized:
+                conn.execute('''CREATE TABLE IF NOT EXISTS leases
+                                (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at REAL NOT NULL)''')
+                conn.execute('''CREATE TABLE IF NOT EXISTS maintenance_runs
+                                (task TEXT PRIMARY KEY,
+                                 status TEXT,
+                                 started_at REAL,
+                                 duration_ms REAL,
+                                 detail TEXT,
+                                 last_success_at REAL,
+                                 requested_at REAL)''')
+                self._initialized = True
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def start(self):
+        """Start this process's maintenance thread (once per worker, after fork)"""
+        if not self.enabled or (self._thread is not None and self._thread.is_alive()):
+            return
+        self.holder = f'{socket.gethostname()}:{os.getpid()}'
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name='maintenance', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.wait(MAINTENANCE_POLL_S):
+            try:
+                self.tick()
+            except Exception as e:
+                print(f"[MAINTENANCE] Error: {e}")
+
+    def acquire_lease(self):
+        """Take or renew the lease; True if this process holds it"""
+        now = time.time()
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT holder, expires_at FROM leases WHERE name = ?', (_LEASE,)).fetchone()
+            held = row is None or row[0] == self.holder or row[1] <= now
+            if held:
+                conn.execute('INSERT OR REPLACE INTO leases (name, holder, expires_at) VALUES (?, ?, ?)',
+                             (_LEASE, self.holder, now + MAINTENANCE_LEASE_S))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return held
+
+    def _renew(self):
+        self._conn().execute('UPDATE leases SET expires_at = ? WHERE name = ? AND holder = ?',
+                             (time.time() + MAINTENANCE_LEASE_S, _LEASE, self.holder))
+
+    def due(self, now=None):
+        """Tasks to run now: requested ones, and in the window those whose interval has passed"""
+        now = time.time() if now is None else now
+        runs = {row[0]: row[1:] for row in
+                self._conn().execute('SELECT task, last_success_at, started_at, requested_at FROM maintenance_runs')}
+        window = in_window(datetime.fromtimestamp(now, timezone.utc).hour)
+        due = []
+        for task in self.tasks:
+            interval_h = TASK_INTERVALS_H[task]
+            last_success, started, requested = runs.get(task, (None, None, None))
+            if requested and (started is None or requested > started):
+                due.append(task)
+            elif window and interval_h > 0:
+                # A failed run is retried after a tenth of the interval, not at once
+                last = max(last_success or 0, (started or 0) - interval_h * 3600 * 0.9)
+                if now - last >= interval_h * 3600:
+                    due.append(task)
+        return due
+
+    def tick(self):
+        """One scheduler pass: run due tasks if this process is the leader"""
+        if not self.acquire_lease():
+            return []
+        ran = []
+        for task in self.due():
+            if self._stop.is_set() or not self.acquire_lease():
+                break
+            self.run(task)
+            ran.append(task)
+        return ran
+
+    def run(self, task):
+        """Run one task now in this thread and record the outcome"""
+        started = time.time()
+        self._conn().execute(
+            '''INSERT INTO maintenance_runs (task, status, started_at) VALUES (?, 'running', ?)
+               ON CONFLICT(task) DO UPDATE SET status = 'running', started_at = excluded.started_at''',
+            (task, started)
+        )
+        # Detail per database file; the task fails if it fails on any of them
+        detail, statuses = {}, set()
+        if task in self.jobs:
+            try:
+                detail = self.jobs[task]()
+                statuses.add('ok')
+            except Exception as e:
+                detail = {'error': str(e)}
+                statuses.add('failed')
+        for path in (self.db_paths if task in TASKS else []):
+            try:
+                if task == 'backup':
+                    result = backup(path, on_progress=self._renew_every(30))
+                else:
+                    result = TASKS[task](path)
+                statuses.add('skipped' if 'skipped' in result else 'ok')
+            except Exception as e:
+                result = {'error': str(e)}
+                statuses.add('failed')
+            detail[os.path.basename(path)] = result
+        status = 'failed' if 'failed' in statuses else 'ok' if 'ok' in statuses else 'skipped'
+        duration_ms = (time.time() - started) * 1000
+        self._conn().execute(
+            '''UPDATE maintenance_runs SET status = ?, duration_ms = ?, detail = ?,
+                      last_success_at = CASE WHEN ? = 'failed' THEN last_success_at ELSE ? END
+               WHERE task = ?''',
+            (status, duration_ms, json.dumps(detail), status, started, task)
+        )
+        print(f"[MAINTENANCE] {task} {status} in {duration_ms:.0f}ms {detail}")
+        return {'status': status, 'duration_ms': round(duration_ms, 1),
+                ('detail' if task in self.jobs else 'files'): detail}
+
+    def _renew_every(self, seconds):
+        last = [time.monotonic()]
+
+        def renew():
+            if time.monotonic() - last[0] >= seconds:
+                self._renew()
+                last[0] = time.monotonic()
+        return renew
+
+    def request(self, task):
+        """Ask the leader to run a task at its next pass, inside the window or not"""
+        self._conn().execute(
+            '''INSERT INTO maintenance_runs (task, requested_at) VALUES (?, ?)
+               ON CONFLICT(task) DO UPDATE SET requested_at = excluded.requested_at''',
+            (task, time.time())
+        )
+
+    def status(self):
+        conn = self._conn()
+        lease = conn.execute('SELECT holder, expires_at FROM leases WHERE name = ?', (_LEASE,)).fetchone()
+        runs = {row[0]: row for row in conn.execute(
+            'SELECT task, status, started_at, duration_ms, detail, last_success_at, requested_at FROM maintenance_runs')}
+        tasks = {}
+        for task in self.tasks:
+            interval_h = TASK_INTERVALS_H[task]
+            _, status, started, duration_ms, detail, last_success, requested = runs.get(task, (task,) + (None,) * 6)
+            tasks[task] = {
+                'interval_h': interval_h,
+                'status': status,
+                'started_at': _iso(started),
+                'duration_ms': round(duration_ms, 1) if duration_ms is not None else None,
+                'detail': json.loads(detail) if detail else None,
+                'last_success_at': _iso(last_success),
+                'requested': bool(requested and (started is None or requested > started)),
+            }
+        return {
+            'enabled': self.enabled,
+            'window_utc': MAINTENANCE_WINDOW or None,
+            'leader': lease[0] if lease and lease[1] > time.time() else None,
+            'tasks': tasks,
+        }
+
+
+def _iso(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ') if epoch else None
+
+
+def storage_jobs(storage):
+    """Jobs run against the app's storage; changes are announced so other workers drop cached users"""
+    def reconcile_credits():
+        result = storage.reconcile_credits()
+        if result['released'] or result['drift']:
+            storage.bump_versions('users')
+        return result
+
+    return {'reconcile_credits': reconcile_credits}
+
+
+def _jobs(db_path):
+    from storage import create_storage
+
+    return storage_jobs(create_storage('sqlite', db_path))
+
+
+def main(argv):
+    from storage import audit_database_path
+
+    db_path = os.environ.get('DATABASE_PATH', 'command_gateway.db')
+    db_paths = [db_path, audit_database_path(db_path)]
+    usage = __doc__.split('Command line (run from the app directory):')[1]
+    if not argv:
+        print(usage)
+        return 2
+    command, args = argv[0], argv[1:]
+    if command == 'status':
+        print(json.dumps(Maintenance(db_paths, jobs=_jobs(db_path)).status(), indent=2))
+    elif command == 'run' and len(args) == 1 and args[0] in TASK_INTERVALS_H:
+        print(json.dumps(Maintenance(db_paths, jobs=_jobs(db_path)).run(args[0]), indent=2))
+    elif command == 'verify' and len(args) == 1:
+        result = verify_backup(args[0])
+        print(json.dumps(result, indent=2))
+        return 0 if result['ok'] else 1
+    elif command == 'vacuum-full':
+        print(json.dumps({path: vacuum_full(path) for path in db_paths}, indent=2))
+    else:
+        print(usage)
+        return 2
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
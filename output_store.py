@@ -0,0 +1,77 @@
+"""Content-addressed storage for command output.
+
+Finished output is kept out of the commands table, in output_blobs, keyed by
+the SHA-256 of its UTF-8 bytes. Commands only reference it (output_hash,
+output_size), so history and pending listings stay small, and identical
+outputs (the same command run twice) are stored once. Blobs are compressed
+with zlib unless that does not make them smaller.
+
+While a command runs its partial output stays inline in execution_output,
+where the streaming endpoint reads it; the executor moves it here when the
+command finishes.
+"""
+import hashlib
+import os
+import zlib
+
+# Outputs smaller than this are stored as-is
+OUTPUT_COMPRESS_MIN_BYTES = int(os.environ.get('OUTPUT_COMPRESS_MIN_BYTES', 256))
+OUTPUT_COMPRESS_LEVEL = int(os.environ.get('OUTPUT_COMPRESS_LEVEL', 6))
+
+# Bytes read or produced per step when a blob is streamed
+CHUNK_BYTES = 64 * 1024
+
+
+def pack(text):
+    """(hash, size, encoding, data) for an output string"""
+    raw = text.encode('utf-8')
+    digest = hashlib.sha256(raw).hexdigest()
+    if len(raw) >= OUTPUT_COMPRESS_MIN_BYTES:
+        compressed = zlib.compress(raw, OUTPUT_COMPRESS_LEVEL)
+        if len(compressed) < len(raw):
+            return digest, len(raw), 'zlib', compressed
+    return digest, len(raw), 'identity', raw
+
+
+def unpack(blob):
+    """The original bytes of a stored blob"""
+    if blob['encoding'] == 'zlib':
+        return zlib.decompress(blob['data'])
+    return bytes(blob['data'])
+
+
+def iter_range(blob, start=0, end=None):
+    """Yield bytes start..end (exclusive) of a blob, decompressing only as far as needed"""
+    end = blob['size'] if end is None else min(end, blob['size'])
+    data = memoryview(blob['data'])
+    if blob['encoding'] != 'zlib':
+        for position in range(start, end, CHUNK_BYTES):
+            yield bytes(data[position:min(position + CHUNK_BYTES, end)])
+        return
+
+    decompressor = zlib.decompressobj()
+    position = 0
+    for offset in range(0, len(data), CHUNK_BYTES):
+        chunk = decompressor.decompress(data[offset:offset + CHUNK_BYTES])
+        chunk_start, position = position, position + len(chunk)
+        if position <= start:
+            continue
+        yield chunk[max(0, start - chunk_start):end - chunk_start]
+        if position >= end:
+            return
+    tail = decompressor.flush()
+    if tail and position < end:
+        yield tail[max(0, start - position):end - position]
+
+
+def save_output(storage, text):
+    """Store text (once per distinct content) and return the command fields that reference it"""
+    digest, size, encoding, data = pack(text)
+    storage.put_blob(digest, size, encoding, data)
+    return {'output_hash': digest, 'output_size': size, 'execution_output': None}
+
+
+def load_outputs(storage, digests):
+    """{hash: text} for the given hashes (missing ones are left out)"""
+    return {digest: unpack(blob).decode('utf-8', 'replace')
+            for digest, blob in storage.get_blobs(set(digests)).items()}
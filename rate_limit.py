@@ -0,0 +1,191 @@
+import hashlib
+import json
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1') != '0'
+# Bucket state lives in its own file so limiter writes never contend with the
+# gateway database; every gunicorn worker opens the same file
+RATE_LIMIT_DB = os.environ.get('RATE_LIMIT_DB', 'rate_limits.db')
+
+# (requests per minute, burst) by role for admins and by tier for members
+DEFAULT_RATE_LIMITS = {
+    'admin': (600, 100),
+    'lead': (240, 60),
+    'senior': (120, 40),
+    'mid': (60, 20),
+    'junior': (30, 10),
+}
+RATE_LIMITS = dict(DEFAULT_RATE_LIMITS)
+RATE_LIMITS.update({k: tuple(v) for k, v in json.loads(os.environ.get('RATE_LIMITS', '{}')).items()})
+# Applied before we know who the key belongs to (first request, unknown keys)
+UNAUTHENTICATED_LIMIT = RATE_LIMITS.get('unauthenticated', RATE_LIMITS['junior'])
+
+# Admission control: concurrent submissions per worker process, and the
+# average SQLite write-lock wait above which new submissions are shed
+MAX_INFLIGHT_COMMANDS = int(os.environ.get('MAX_INFLIGHT_COMMANDS', 32))
+LOCK_WAIT_SHED_MS = float(os.environ.get('LOCK_WAIT_SHED_MS', 500))
+
+# Buckets idle this long are pruned now and then
+_IDLE_SECONDS = 3600
+
+
+def limits_for(user):
+    """(capacity, refill per second) for a user row"""
+    key = 'admin' if user['role'] == 'admin' else user.get('tier') or 'junior'
+    per_minute, burst = RATE_LIMITS.get(key, RATE_LIMITS['junior'])
+    return float(burst), per_minute / 60.0
+
+def bucket_key(api_key):
+    # Never store raw API keys outside the users table
+    return hashlib.sha256(api_key.encode()).hexdigest()[:32]
+
+
+class TokenBucketLimiter:
+    """Token buckets shared by all worker processes through a small SQLite file"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._initialized = False
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')  # Losing bucket state on a crash is harmless
+            if not self._initialized:
+                conn.execute('''CREATE TABLE IF NOT EXISTS rate_buckets
+                                (key TEXT PRIMARY KEY,
+                                 user_id INTEGER,
+                                 tokens REAL NOT NULL,
+                                 capacity REAL NOT NULL,
+                                 refill_rate REAL NOT NULL,
+                                 updated_at REAL NOT NULL)''')
+                self._initialized = True
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def consume(self, key, cost=1.0):
+        """Take cost tokens from a bucket.
+
+        Returns (allowed, retry_after_seconds, limits) where limits is the
+        (capacity, refill_rate) the bucket is currently configured with.
+        """
+        now = time.time()
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT tokens, capacity, refill_rate, updated_at FROM rate_buckets WHERE key = ?',
+                (key,)
+            ).fetchone()
+            if row:
+                tokens, bucket_capacity, bucket_rate, updated_at = row
+                tokens = min(bucket_capacity, tokens + max(0.0, now - updated_at) * bucket_rate)
+            else:
+                per_minute, burst = UNAUTHENTICATED_LIMIT
+                bucket_capacity, bucket_rate = float(burst), per_minute / 60.0
+                tokens = bucket_capacity
+                if random.random() < 0.01:
+                    conn.execute('DELETE FROM rate_buckets WHERE updated_at < ?', (now - _IDLE_SECONDS,))
+
+            if tokens >= cost:
+                allowed, retry_after = True, 0
+                tokens -= cost
+            else:
+                allowed = False
+                retry_after = math.ceil((cost - tokens) / bucket_rate) if bucket_rate > 0 else 60
+
+            conn.execute(
+                '''INSERT INTO rate_buckets (key, tokens, capacity, refill_rate, updated_at) VALUES (?, ?, ?, ?, ?)
+                   ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at''',
+                (key, tokens, bucket_capacity, bucket_rate, now)
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return allowed, retry_after, (bucket_capacity, bucket_rate)
+
+    def set_limits(self, key, user_id, capacity, refill_rate):
+        """Reconfigure a bucket once its owner's role and tier are known"""
+        conn = self._conn()
+        # A bucket claimed for the first time keeps what it spent but gets the
+        # owner's full burst; afterwards a smaller limit only caps the tokens
+        conn.execute(
+            '''UPDATE rate_buckets
+               SET tokens = CASE WHEN user_id IS NULL THEN MAX(0, ? - (capacity - tokens)) ELSE MIN(tokens, ?) END,
+                   user_id = ?, capacity = ?, refill_rate = ?
+               WHERE key = ?''',
+            (capacity, capacity, user_id, capacity, refill_rate, key)
+        )
+
+    def buckets(self):
+        """Known buckets with their current token counts (raw keys are never stored)"""
+        now = time.time()
+        rows = self._conn().execute(
+            'SELECT user_id, tokens, capacity, refill_rate, updated_at FROM rate_buckets WHERE user_id IS NOT NULL'
+        ).fetchall()
+        return [{
+            'user_id': user_id,
+            'tokens': round(min(capacity, tokens + max(0.0, now - updated_at) * rate), 2),
+            'capacity': capacity,
+            'per_minute': round(rate * 60, 2),
+        } for user_id, tokens, capacity, rate, updated_at in rows]
+
+
+class AdmissionController:
+    """Per-process concurrency cap plus load shedding on SQLite lock waits"""
+
+    def __init__(self, max_inflight, shed_ms, half_life=1.0):
+        self.max_inflight = max_inflight
+        self.shed_seconds = shed_ms / 1000.0
+        self.half_life = half_life
+        self._lock = threading.Lock()
+        self._inflight = 0
+        self._lock_wait = 0.0
+        self._sampled_at = time.monotonic()
+
+    def _decayed_wait(self, now):
+        # Decays toward zero while nothing is measured, so shedding always ends
+        return self._lock_wait * 0.5 ** ((now - self._sampled_at) / self.half_life)
+
+    def try_enter(self):
+        """Returns None when admitted, otherwise a reason string"""
+        with self._lock:
+            if self._inflight >= self.max_inflight:
+                return 'Too many concurrent submissions'
+            if self._decayed_wait(time.monotonic()) > self.shed_seconds:
+                return 'Database is overloaded'
+            self._inflight += 1
+            return None
+
+    def leave(self):
+        with self._lock:
+            self._inflight -= 1
+
+    def record_lock_wait(self, seconds):
+        with self._lock:
+            now = time.monotonic()
+            self._lock_wait = 0.7 * self._decayed_wait(now) + 0.3 * seconds
+            self._sampled_at = now
+
+    def stats(self):
+        with self._lock:
+            return {
+                'inflight': self._inflight,
+                'max_inflight': self.max_inflight,
+                'lock_wait_ms': round(self._decayed_wait(time.monotonic()) * 1000, 3),
+                'shed_threshold_ms': self.shed_seconds * 1000,
+            }
+
+
+limiter = TokenBucketLimiter(RATE_LIMIT_DB)
+admission = AdmissionController(MAX_INFLIGHT_COMMANDS, LOCK_WAIT_SHED_MS)
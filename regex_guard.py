@@ -0,0 +1,470 @@
+import json
+import os
+import queue
+import re
+import select
+import subprocess
+import sys
+import threading
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:  # Python < 3.11
+    import sre_parse
+    import sre_constants
+
+try:
+    import re2  # Optional linear-time engine (pip install google-re2)
+except ImportError:
+    re2 = None
+
+# Per-match time budget for high-risk patterns (see guarded_search)
+MATCH_TIMEOUT_MS = int(os.environ.get('REGEX_MATCH_TIMEOUT_MS', 100))
+# Helper processes per server process, so flagged rules are matched in parallel
+REGEX_WORKERS = max(1, int(os.environ.get('REGEX_WORKERS', 4)))
+# Action applied when a flagged pattern exceeds its budget (fail closed)
+TIMEOUT_ACTION = os.environ.get('REGEX_TIMEOUT_ACTION', 'AUTO_REJECT')
+# 'reject' refuses high-risk patterns at rule creation, 'flag' only warns
+COMPLEXITY_MODE = os.environ.get('REGEX_COMPLEXITY_MODE', 'reject')
+
+if TIMEOUT_ACTION not in ('AUTO_REJECT', 'REQUIRE_APPROVAL'):
+    TIMEOUT_ACTION = 'AUTO_REJECT'
+
+# Repeats with at least this many iterations are treated like unbounded ones
+_LARGE_REPEAT = 10
+
+# Character sets are approximated over ASCII plus three tokens standing in for
+# non-ASCII word, space and other characters
+_NON_ASCII = 128
+_NON_ASCII_WORD, _NON_ASCII_SPACE, _NON_ASCII_OTHER = 128, 129, 130
+_ALL = frozenset(range(_NON_ASCII_OTHER + 1))
+_EMPTY = frozenset()
+
+_CATEGORY_PATTERNS = {
+    'CATEGORY_DIGIT': (r'\d', {_NON_ASCII_WORD}),
+    'CATEGORY_NOT_DIGIT': (r'\D', {_NON_ASCII_WORD, _NON_ASCII_SPACE, _NON_ASCII_OTHER}),
+    'CATEGORY_SPACE': (r'\s', {_NON_ASCII_SPACE}),
+    'CATEGORY_NOT_SPACE': (r'\S', {_NON_ASCII_WORD, _NON_ASCII_OTHER}),
+    'CATEGORY_WORD': (r'\w', {_NON_ASCII_WORD}),
+    'CATEGORY_NOT_WORD': (r'\W', {_NON_ASCII_SPACE, _NON_ASCII_OTHER}),
+}
+_CATEGORY_SETS = {
+    name: frozenset(c for c in range(_NON_ASCII) if re.match(p, chr(c))) | tokens
+    for name, (p, tokens) in _CATEGORY_PATTERNS.items()
+}
+
+_REPEATS = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+
+
+class RegexTimeout(Exception):
+    """Raised when a guarded pattern does not finish within its time budget"""
+
+
+# Static complexity analysis
+
+def _char_token(ch):
+    if ch.isalnum() or ch == '_':
+        return _NON_ASCII_WORD
+    if ch.isspace():
+        return _NON_ASCII_SPACE
+    return _NON_ASCII_OTHER
+
+def _literal_set(code):
+    if code >= _NON_ASCII:
+        return frozenset([_char_token(chr(code))])
+    ch = chr(code)
+    # Both cases, so IGNORECASE patterns are never under-approximated
+    return frozenset(ord(c) for c in {ch.lower(), ch.upper()} if ord(c) < _NON_ASCII) | {code}
+
+def _in_set(items):
+    chars = set()
+    negate = False
+    for op, av in items:
+        if op == sre_constants.NEGATE:
+            negate = True
+        elif op == sre_constants.LITERAL:
+            chars |= _literal_set(av)
+        elif op == sre_constants.RANGE:
+            lo, hi = av
+            chars |= set(range(lo, min(hi, _NON_ASCII - 1) + 1))
+            if hi >= _NON_ASCII:
+                chars |= {_NON_ASCII_WORD, _NON_ASCII_SPACE, _NON_ASCII_OTHER}
+        elif op == sre_constants.CATEGORY:
+            chars |= _CATEGORY_SETS.get(str(av), _ALL)
+        else:
+            return _ALL
+    if negate:
+        return (_ALL - chars) | {_NON_ASCII_WORD, _NON_ASCII_SPACE, _NON_ASCII_OTHER}
+    return frozenset(chars)
+
+def _element_first(op, av):
+    """(first-char set, nullable) for a single parsed element"""
+    if op == sre_constants.LITERAL:
+        return _literal_set(av), False
+    if op == sre_constants.NOT_LITERAL:
+        return _ALL - {av}, False
+    if op == sre_constants.ANY:
+        return _ALL, False
+    if op == sre_constants.IN:
+        return _in_set(av), False
+    if op in (sre_constants.AT, sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+        return _EMPTY, True
+    if op == sre_constants.SUBPATTERN:
+        return _sequence_first(av[3])
+    if op == sre_constants.ATOMIC_GROUP:
+        return _sequence_first(av)
+    if op in _REPEATS or op == sre_constants.POSSESSIVE_REPEAT:
+        first, nullable = _sequence_first(av[2])
+        return first, nullable or av[0] == 0
+    if op == sre_constants.BRANCH:
+        first, nullable = set(), False
+        for branch in av[1]:
+            f, n = _sequence_first(branch)
+            first |= f
+            nullable = nullable or n
+        return frozenset(first), nullable
+    if op == sre_constants.GROUPREF_EXISTS:
+        yes_first, yes_null = _sequence_first(av[1])
+        no_first, no_null = _sequence_first(av[2]) if av[2] else (_EMPTY, True)
+        return yes_first | no_first, yes_null or no_null
+    # Back-references and anything unknown: assume the worst
+    return _ALL, True
+
+def _sequence_first(seq):
+    first = set()
+    for op, av in seq:
+        f, nullable = _element_first(op, av)
+        first |= f
+        if not nullable:
+            return frozenset(first), False
+    return frozenset(first), True
+
+def _sequence_last(seq):
+    """Characters a parsed sequence can end with"""
+    last = set()
+    for op, av in reversed(list(seq)):
+        if op == sre_constants.SUBPATTERN:
+            l, nullable = _sequence_last(av[3]), _sequence_first(av[3])[1]
+        elif op in _REPEATS or op == sre_constants.POSSESSIVE_REPEAT:
+            l = _sequence_last(av[2])
+            nullable = av[0] == 0 or _sequence_first(av[2])[1]
+        elif op == sre_constants.BRANCH:
+            l = frozenset().union(*[_sequence_last(branch) for branch in av[1]])
+            nullable = _element_first(op, av)[1]
+        else:
+            l, nullable = _element_first(op, av)
+            if op not in (sre_constants.LITERAL, sre_constants.NOT_LITERAL,
+                          sre_constants.ANY, sre_constants.IN):
+                l = _consumable([(op, av)])
+        last |= l
+        if not nullable:
+            break
+    return frozenset(last)
+
+def _is_variable(op, av):
+    """Whether an element can match strings of different lengths"""
+    if op in _REPEATS:
+        lo, hi = sre_parse.SubPattern(sre_parse.State(), [(op, av)]).getwidth()
+        return lo != hi
+    if op == sre_constants.BRANCH:
+        widths = {tuple(branch.getwidth()) for branch in av[1]}
+        return len(widths) > 1 or any(lo != hi for lo, hi in widths)
+    return False
+
+def _consumable(seq):
+    """Every character a parsed sequence can consume"""
+    chars = set()
+    for op, av in seq:
+        if op == sre_constants.SUBPATTERN:
+            chars |= _consumable(av[3])
+        elif op == sre_constants.ATOMIC_GROUP:
+            chars |= _consumable(av)
+        elif op in _REPEATS or op == sre_constants.POSSESSIVE_REPEAT:
+            chars |= _consumable(av[2])
+        elif op == sre_constants.BRANCH:
+            for branch in av[1]:
+                chars |= _consumable(branch)
+        elif op == sre_constants.GROUPREF_EXISTS:
+            chars |= _consumable(av[1])
+            if av[2]:
+                chars |= _consumable(av[2])
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            continue
+        else:
+            chars |= _element_first(op, av)[0]
+    return frozenset(chars)
+
+def _is_large(max_count):
+    return max_count == sre_constants.MAXREPEAT or max_count >= _LARGE_REPEAT
+
+def _describe(max_count):
+    return 'unbounded' if max_count == sre_constants.MAXREPEAT else f'up to {max_count}'
+
+def _find_ambiguous_repeats(seq, follow, issues):
+    """Inner variable-length elements that can end with a character that may also follow them"""
+    for i, (op, av) in enumerate(seq):
+        rest_first, rest_nullable = _sequence_first(seq[i + 1:])
+        element_follow = rest_first | follow if rest_nullable else rest_first
+        if _is_variable(op, av) and _sequence_last([(op, av)]) & element_follow:
+            issues.append('nested_quantifier')
+            return
+        if op in _REPEATS:
+            body = av[2]
+            _find_ambiguous_repeats(body, element_follow | _sequence_first(body)[0], issues)
+        elif op == sre_constants.SUBPATTERN:
+            _find_ambiguous_repeats(av[3], element_follow, issues)
+        elif op == sre_constants.BRANCH:
+            for branch in av[1]:
+                _find_ambiguous_repeats(branch, element_follow, issues)
+        # Atomic groups and possessive repeats never backtrack into themselves
+
+def _find_overlapping_branches(seq):
+    for op, av in seq:
+        if op == sre_constants.SUBPATTERN:
+            if _find_overlapping_branches(av[3]):
+                return True
+        elif op == sre_constants.BRANCH:
+            firsts = [_sequence_first(branch) for branch in av[1]]
+            for a in range(len(firsts)):
+                for b in range(a + 1, len(firsts)):
+                    # Same first character, or both able to match nothing
+                    if firsts[a][0] & firsts[b][0] or (firsts[a][1] and firsts[b][1]):
+                        return True
+    return False
+
+def _walk(seq, issues):
+    for op, av in seq:
+        if op in _REPEATS:
+            min_count, max_count, body = av
+            if _is_large(max_count):
+                # What can follow one iteration is the start of the next one
+                found = []
+                _find_ambiguous_repeats(body, _sequence_first(body)[0], found)
+                if found:
+                    issues.append({
+                        'type': 'nested_quantifier',
+                        'severity': 'high',
+                        'message': f'Quantified group ({_describe(max_count)}) contains an inner quantifier '
+                                   f'that can match the same characters in more than one way',
+                    })
+                if _find_overlapping_branches(body):
+                    issues.append({
+                        'type': 'ambiguous_alternation',
+                        'severity': 'high',
+                        'message': f'Alternation inside a {_describe(max_count)} repeat has branches '
+                                   f'that can start with the same character',
+                    })
+            _walk(body, issues)
+        elif op == sre_constants.SUBPATTERN:
+            _walk(av[3], issues)
+        elif op == sre_constants.ATOMIC_GROUP:
+            _walk(av, issues)
+        elif op == sre_constants.POSSESSIVE_REPEAT:
+            _walk(av[2], issues)
+        elif op == sre_constants.BRANCH:
+            for branch in av[1]:
+                _walk(branch, issues)
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            _walk(av[1], issues)
+        elif op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+            issues.append({
+                'type': 'backreference',
+                'severity': 'medium',
+                'message': 'Back-references cannot run on a linear-time engine',
+            })
+
+    # Unbounded repeats in sequence that can trade characters with each other
+    unbounded = [i for i, (op, av) in enumerate(seq)
+                 if op in _REPEATS and av[1] == sre_constants.MAXREPEAT]
+    for x, i in enumerate(unbounded):
+        for j in unbounded[x + 1:]:
+            shared = _sequence_last(seq[i][1][2]) & _sequence_first(seq[j][1][2])[0]
+            if not shared:
+                continue
+            between = seq[i + 1:j]
+            if all(_sequence_first([e])[1] or _consumable([e]) <= shared for e in between):
+                issues.append({
+                    'type': 'overlapping_quantifiers',
+                    'severity': 'medium',
+                    'message': 'Two unbounded quantifiers can match the same characters, '
+                               'which makes failing matches polynomially slow',
+                })
+                return
+
+def analyze_pattern(pattern):
+    """Return a list of backtracking risks found in a regex pattern"""
+    try:
+        parsed = sre_parse.parse(pattern)
+    except (re.error, RecursionError, OverflowError):
+        return []  # Invalid patterns are reported by re.compile
+    issues = []
+    _walk(list(parsed), issues)
+    # Collapse duplicates found at several nesting levels
+    unique = []
+    for issue in issues:
+        if issue not in unique:
+            unique.append(issue)
+    return unique
+
+def is_high_risk(issues):
+    return any(issue['severity'] == 'high' for issue in issues)
+
+
+# Match-time budget
+
+def _worker_main():
+    """Child process loop: one JSON [pattern, text] request per line on stdin"""
+    compiled = {}
+    out = sys.stdout
+    out.write('"ready"\n')
+    out.flush()
+    for line in sys.stdin:
+        try:
+            pattern, text = json.loads(line)
+            regex = compiled.get(pattern)
+            if regex is None:
+                regex = compiled[pattern] = re.compile(pattern)
+            reply = [True, regex.search(text) is not None]
+        except Exception as e:
+            reply = [False, str(e)]
+        out.write(json.dumps(reply) + '\n')
+        out.flush()
+
+
+class RegexWorker:
+    """A killable helper process that evaluates risky patterns under a deadline"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._proc = None
+        self._pid = None
+
+    def _start(self):
+        proc = subprocess.Popen(
+            [sys.executable, '-I', os.path.abspath(__file__)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+        # Startup is not charged to any match's budget
+        if not self._readable(proc, 30):
+            proc.kill()
+            raise RuntimeError('Regex worker failed to start')
+        proc.stdout.readline()
+        self._proc, self._pid = proc, os.getpid()
+
+    def _stop(self):
+        try:
+            self._proc.kill()
+            self._proc.wait(1)
+        except Exception:
+            pass
+        self._proc = None
+
+    @staticmethod
+    def _readable(proc, timeout):
+        ready, _, _ = select.select([proc.stdout], [], [], timeout)
+        return bool(ready)
+
+    def _ensure_started(self):
+        if self._pid != os.getpid():
+            # Inherited across fork: the process belongs to our parent
+            self._proc = None
+            self._pid = None
+        if self._proc is None or self._proc.poll() is not None:
+            self._start()
+
+    def warm(self):
+        with self._lock:
+            self._ensure_started()
+
+    def search(self, pattern, text, timeout):
+        # Uncontended: RegexWorkerPool hands each worker to one match at a time
+        with self._lock:
+            self._ensure_started()
+            try:
+                self._proc.stdin.write((json.dumps([pattern, text]) + '\n').encode())
+                self._proc.stdin.flush()
+            except OSError:
+                self._stop()
+                raise RegexTimeout(pattern)
+            if not self._readable(self._proc, timeout):
+                # Catastrophic backtracking: kill the worker, the next call restarts it
+                self._stop()
+                raise RegexTimeout(pattern)
+            line = self._proc.stdout.readline()
+            if not line:
+                self._stop()
+                raise RegexTimeout(pattern)
+            ok, result = json.loads(line)
+            if not ok:
+                raise re.error(result)
+            return result
+
+
+class RegexWorkerPool:
+    """RegexWorkers lent to one match at a time; waiting for one is bounded too"""
+
+    def __init__(self, size=REGEX_WORKERS):
+        # Last in, first out: the warm workers are reused and the rest start on demand
+        self._idle = queue.LifoQueue()
+        for _ in range(size):
+            self._idle.put(RegexWorker())
+
+    def warm(self):
+        worker = self._idle.get()
+        try:
+            worker.warm()
+        finally:
+            self._idle.put(worker)
+
+    def search(self, pattern, text, timeout):
+        # The wait gets its own budget, then the match gets a full one
+        try:
+            worker = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            # Every helper is busy with a slow match: fail closed rather than queue behind them
+            raise RegexTimeout(pattern)
+        try:
+            return worker.search(pattern, text, timeout)
+        finally:
+            self._idle.put(worker)
+
+
+_workers = RegexWorkerPool()
+
+class GuardedSearch:
+    """search() replacement for risky patterns that never exceeds the time budget"""
+
+    def __init__(self, pattern, timeout_ms=None):
+        self.pattern = pattern
+        self.timeout = (timeout_ms if timeout_ms is not None else MATCH_TIMEOUT_MS) / 1000.0
+        self.linear = None
+        if re2 is not None:
+            try:
+                self.linear = re2.compile(pattern)
+            except Exception:
+                self.linear = None  # Needs backtracking features, use the worker
+
+    def warm(self):
+        if self.linear is None:
+            _workers.warm()
+
+    def __call__(self, text):
+        if self.linear is not None:
+            return self.linear.search(text) is not None
+        return _workers.search(self.pattern, text, self.timeout)
+
+
+def guarded_search(pattern):
+    """Return a search callable for a high-risk pattern, or None when plain re is safe enough.
+
+    Medium risks (overlapping quantifiers such as .*sudo.*) are at worst
+    polynomial in the command length and run inline: a round trip to the
+    helper process costs about 100 times the search itself.
+    """
+    if not is_high_risk(analyze_pattern(pattern)):
+        return None
+    return GuardedSearch(pattern)
+
+
+if __name__ == '__main__':
+    _worker_main()
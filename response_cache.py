@@ -0,0 +1,49 @@
+import threading
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """Small LRU of serialized responses keyed by (endpoint, resource versions).
+
+    Versions only ever increase, so an entry can never be served for data
+    that changed after it was stored. Entries are tagged with the resources
+    they depend on, and invalidate() drops those of a resource that changed
+    instead of leaving them to age out.
+    """
+
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (value, resources)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, resources=()):
+        with self._lock:
+            self._entries[key] = (value, resources)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, resource):
+        with self._lock:
+            for key in [key for key, (_, resources) in self._entries.items() if resource in resources]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
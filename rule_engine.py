@@ -0,0 +1,384 @@
+import itertools
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+import pytz
+
+from regex_guard import MATCH_TIMEOUT_MS, TIMEOUT_ACTION, RegexTimeout, guarded_search
+from rule_profile import RULE_PROFILE_SAMPLE, rule_profiler
+
+# Approximate memory budget for memoized decisions (0 disables the cache)
+DECISION_CACHE_BYTES = int(os.environ.get('DECISION_CACHE_BYTES', 8 * 1024 * 1024))
+# Per-entry overhead on top of the command text (key tuple, OrderedDict node, value)
+_ENTRY_OVERHEAD = 200
+
+
+def evaluate_time_based_rule(rule, now=None):
+    """Evaluate if a time-based rule should apply based on current time"""
+    # Convert sqlite3.Row to dict if needed
+    rule_dict = dict(rule) if hasattr(rule, 'keys') else rule
+
+    if not rule_dict.get('time_start') or not rule_dict.get('time_end'):
+        return True  # No time restriction, always applies
+
+    try:
+        tz = pytz.timezone(rule_dict.get('timezone', 'UTC'))
+        now = now.astimezone(tz) if now else datetime.now(tz)
+        current_time = now.time()
+
+        time_start = datetime.strptime(rule_dict['time_start'], '%H:%M').time()
+        time_end = datetime.strptime(rule_dict['time_end'], '%H:%M').time()
+
+        return _time_in_window(current_time, time_start, time_end)
+    except:
+        return True  # Default to applying if time parsing fails
+
+def _time_in_window(current_time, time_start, time_end):
+    if time_start <= time_end:
+        # Same day window
+        return time_start <= current_time <= time_end
+    else:
+        # Overnight window
+        return current_time >= time_start or current_time <= time_end
+
+def _compile_time_window(rule_dict):
+    """Pre-parse a rule's time window; None means the rule always applies"""
+    if not rule_dict.get('time_start') or not rule_dict.get('time_end'):
+        return None
+    try:
+        tz = pytz.timezone(rule_dict.get('timezone', 'UTC'))
+        time_start = datetime.strptime(rule_dict['time_start'], '%H:%M').time()
+        time_end = datetime.strptime(rule_dict['time_end'], '%H:%M').time()
+    except:
+        return None  # Same fallback as evaluate_time_based_rule
+    return (tz, time_start, time_end)
+
+def find_matching_rule(rules, command_text, now=None):
+    """Reference matcher: first rule whose pattern matches and whose time window is open"""
+    for rule in rules:
+        try:
+            if re.search(rule['pattern'], command_text):
+                # Check if time-based rule applies
+                if evaluate_time_based_rule(rule, now):
+                    return dict(rule)
+        except re.error:
+            continue
+    return None
+
+
+def _timeout_rule(rule):
+    """Fail-closed stand-in for a rule whose pattern ran out of time"""
+    print(f"[REGEX] Rule {rule['id']} exceeded its {MATCH_TIMEOUT_MS}ms match budget, applying {TIMEOUT_ACTION}")
+    timed_out = dict(rule)
+    timed_out['action'] = TIMEOUT_ACTION
+    timed_out['description'] = f"Rule {rule['id']} pattern exceeded its match time budget"
+    timed_out['timed_out'] = True
+    return timed_out
+
+
+class RuleMatcher:
+    """Precompiled first-match evaluator equivalent to find_matching_rule.
+
+    Patterns are compiled once and time windows parsed once, so a match costs
+    one regex search per rule instead of a compile-cache lookup (or a full
+    recompile once the rule set outgrows the ``re`` module cache). Patterns
+    flagged by regex_guard run under a time budget and fail closed. With a
+    profiler, decisions are counted per rule and a sample of them timed
+    (see rule_profile.py).
+    """
+
+    _generations = itertools.count(1)
+
+    def __init__(self, rules, profiler=rule_profiler):
+        entries = []
+        for rule in rules:
+            rule_dict = dict(rule)
+            try:
+                regex = re.compile(rule_dict['pattern'])
+            except re.error:
+                continue  # Never matches, same as the reference loop
+            guard = guarded_search(rule_dict['pattern'])
+            if guard is not None:
+                guard.warm()
+            entries.append((guard or regex.search, _compile_time_window(rule_dict), rule_dict, guard is not None))
+        self._index(entries, profiler)
+
+    @classmethod
+    def chain(cls, matchers, profiler=rule_profiler):
+        """One matcher trying each of matchers' rules in turn, without recompiling any pattern"""
+        if len(matchers) == 1:
+            return matchers[0]
+        chained = cls.__new__(cls)
+        chained._index([entry for matcher in matchers for entry in matcher.entries], profiler)
+        return chained
+
+    def _index(self, entries, profiler):
+        self.entries = entries
+        self.guarded = sum(1 for _, _, _, guarded in entries if guarded)
+        # Identifies this rule set in decision cache keys
+        self.generation = next(self._generations)
+        self.by_id = {rule['id']: rule for _, _, rule, _ in entries}
+        self.windows = [window for _, window, _, _ in entries if window is not None]
+        self._state_memo = (None, 0)
+        # Names the decision cache entries of the matcher in this role (see get_scoped_matcher)
+        self.name = None
+        self.profiler = profiler if profiler is not None and profiler.enabled else None
+        if self.profiler is not None:
+            self.slots = [self.profiler.slot(rule['id']) for _, _, rule, _ in entries]
+            self.slots_by_id = {rule['id']: slot for (_, _, rule, _), slot in zip(entries, self.slots)}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def match(self, command_text, now=None):
+        if self.profiler is None:
+            return self._match(command_text, now)
+        if random.random() < RULE_PROFILE_SAMPLE:
+            return self._match_profiled(command_text, now)
+        rule = self._match(command_text, now)
+        if rule is not None:
+            self.count_match(rule['id'])
+        return rule
+
+    def _match(self, command_text, now):
+        for search, window, rule, guarded in self.entries:
+            if guarded:
+                # Skip closed windows before spending the budget on the pattern
+                if window is not None and not _window_open(window, now):
+                    continue
+                try:
+                    if search(command_text):
+                        return dict(rule)
+                except RegexTimeout:
+                    return _timeout_rule(rule)
+                except re.error:
+                    pass  # Rejected by the helper's re: never matches, like an invalid pattern
+                continue
+            if search(command_text):
+                if window is None or _window_open(window, now):
+                    return dict(rule)
+        return None
+
+    def _match_profiled(self, command_text, now):
+        """_match(), timing each search, then trying the rules behind the winner"""
+        profiler = self.profiler
+        evaluations, total_ns, max_ns = profiler.evaluations, profiler.total_ns, profiler.max_ns
+        for position, (search, window, rule, guarded) in enumerate(self.entries):
+            if guarded and window is not None and not _window_open(window, now):
+                continue
+            slot = self.slots[position]
+            timed_out = False
+            start = time.perf_counter_ns()
+            try:
+                found = search(command_text)
+            except RegexTimeout:
+                found, timed_out = None, True
+            except re.error:
+                found = None
+            elapsed = time.perf_counter_ns() - start
+            evaluations[slot] += 1
+            total_ns[slot] += elapsed
+            if elapsed > max_ns[slot]:
+                max_ns[slot] = elapsed
+            if timed_out:
+                self.count_match(rule['id'])
+                return _timeout_rule(rule)
+            if found and (guarded or window is None or _window_open(window, now)):
+                self.count_match(rule['id'])
+                self._sample_shadows(position, command_text, now)
+                return dict(rule)
+        return None
+
+    def count_match(self, rule_id):
+        """Count a decision by a rule, including ones served from the decision cache"""
+        if self.profiler is not None:
+            slot = self.slots_by_id[rule_id]
+            self.profiler.matches[slot] += 1
+            self.profiler.last_match[slot] = time.time()
+
+    def _sample_shadows(self, winner, command_text, now):
+        """Try the rules after the winner: each that matches too was shadowed by it"""
+        shadows, winner_slot = self.profiler.shadows, self.slots[winner]
+        for position in range(winner + 1, len(self.entries)):
+            search, window, _rule, guarded = self.entries[position]
+            if guarded or not search(command_text) or (window is not None and not _window_open(window, now)):
+                continue
+            slot = self.slots[position]
+            self.profiler.shadowed[slot] += 1
+            shadows[(slot, winner_slot)] = shadows.get((slot, winner_slot), 0) + 1
+
+
+    def window_state(self, now):
+        """Bitmask of which time windows are open at now.
+
+        Windows start and end on whole local minutes, so the state can only
+        change exactly on a minute boundary; it is computed once per minute.
+        """
+        if not self.windows:
+            return 0
+        stamp = now.timestamp()
+        minute = int(stamp // 60)
+        on_boundary = stamp == minute * 60
+        memo_minute, memo_state = self._state_memo
+        if memo_minute == minute and not on_boundary:
+            return memo_state
+        state = 0
+        for bit, window in enumerate(self.windows):
+            if _window_open(window, now):
+                state |= 1 << bit
+        if not on_boundary:
+            self._state_memo = (minute, state)
+        return state
+
+
+def _window_open(window, now):
+    tz, time_start, time_end = window
+    current = now.astimezone(tz) if now else datetime.now(tz)
+    return _time_in_window(current.time(), time_start, time_end)
+
+
+_scope_matchers = {}  # scope -> (version, RuleMatcher)
+_chained_matchers = {}  # tuple of scopes -> (versions, RuleMatcher)
+
+def get_scoped_matcher(scopes, versions, load_rules):
+    """RuleMatcher over the rules of scopes, tried in that order.
+
+    Each scope is compiled on its own, and load_rules(scope) only runs when
+    that scope's version changes, so an edit to one team's rules recompiles
+    only that team's. A version of None (versioning unavailable) always reloads.
+    """
+    parts = []
+    for scope, version in zip(scopes, versions):
+        cached = _scope_matchers.get(scope)
+        if version is None or cached is None or cached[0] != version:
+            matcher = RuleMatcher(load_rules(scope))
+            if version is not None:
+                _scope_matchers[scope] = (version, matcher)
+        else:
+            matcher = cached[1]
+        parts.append(matcher)
+    key = tuple(scopes)
+    cached = _chained_matchers.get(key)
+    if None in versions or cached is None or cached[0] != tuple(versions):
+        chained = RuleMatcher.chain(parts)
+        chained.name = key
+        if None not in versions:
+            _chained_matchers[key] = (tuple(versions), chained)
+        return chained
+    return cached[1]
+
+
+class DecisionCache:
+    """LRU of first-match decisions, bounded by approximate memory size.
+
+    Keys are (command text, rule-set generation, window state). Entries for an
+    older rule set or window state can never be hit again, so a matcher's
+    entries are dropped as soon as either changes. Matchers for other scopes
+    (see get_scoped_matcher) keep theirs.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._scopes = {}  # matcher name -> (generation, window state) of its live entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        size = sys.getsizeof(key[0]) + _ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+                self.evictions += 1
+
+    def set_scope(self, name, scope):
+        """Drop the entries of the matcher called name when its rule set or window state changes"""
+        if self._scopes.get(name) == scope:
+            return
+        with self._lock:
+            previous = self._scopes.get(name)
+            if previous != scope:
+                stale = [key for key in self._entries if key[1:] == previous]
+                for key in stale:
+                    self._bytes -= self._entries.pop(key)[1]
+                if stale:
+                    self.invalidations += 1
+                self._scopes[name] = scope
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.max_bytes > 0,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+decision_cache = DecisionCache(DECISION_CACHE_BYTES)
+
+def decide(matcher, command_text, now=None):
+    """matcher.match(command_text, now), memoized per rule set and window state.
+
+    Only the matched rule id and action are cached; the rule itself comes
+    from the matcher. Guarded-pattern timeouts are never cached.
+    """
+    if decision_cache.max_bytes <= 0:
+        return matcher.match(command_text, now)
+    now = now or datetime.now(timezone.utc)
+    state = matcher.window_state(now)
+    decision_cache.set_scope(matcher.name, (matcher.generation, state))
+    key = (command_text, matcher.generation, state)
+    cached = decision_cache.get(key)
+    if cached is not None:
+        rule_id, _action = cached
+        if rule_id is None:
+            return None
+        matcher.count_match(rule_id)
+        return dict(matcher.by_id[rule_id])
+
+    rule = matcher.match(command_text, now)
+    if rule is None:
+        decision_cache.put(key, (None, None))
+    elif not rule.get('timed_out'):
+        decision_cache.put(key, (rule['id'], rule['action']))
+    return rule
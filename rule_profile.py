@@ -0,0 +1,166 @@
+"""Rule effectiveness profiling: which rules fire, which are shadowed, which are slow.
+
+RuleMatcher.match() counts how often each rule decided a command, including
+decisions served from the decision cache. Timing every search would cost more
+than the search itself, so only a sample of decisions (RULE_PROFILE_SAMPLE)
+is profiled in full. For those, each rule records its searches and how long
+they took, in total and at worst.
+
+First match wins, so a rule that would also have matched behind the winner
+leaves no trace. A sampled decision therefore also tries the later rules, and
+each one that matches is counted as shadowed by the winner. Guarded patterns
+are skipped there, since that would spend their time budget.
+
+Counters live in flat arrays indexed by a slot per rule id, shared by every
+matcher a worker builds. Increments take no lock, so under heavy concurrency
+a few counts can be lost.
+
+Each worker adds its counts to the rule_stats and rule_shadows tables every
+RULE_PROFILE_FLUSH_S seconds. GET /api/admin/rule-stats flushes the serving
+worker's counts and reports on all workers' totals with report().
+"""
+import os
+import threading
+from array import array
+from datetime import datetime, timezone
+
+# 0 turns the counters (and their timing overhead) off
+RULE_PROFILE = os.environ.get('RULE_PROFILE', '1') == '1'
+# Fraction of decisions timed per rule and checked for shadowed rules
+RULE_PROFILE_SAMPLE = float(os.environ.get('RULE_PROFILE_SAMPLE', 0.02))
+RULE_PROFILE_FLUSH_S = float(os.environ.get('RULE_PROFILE_FLUSH_S', 60))
+
+_COUNTERS = ('evaluations', 'matches', 'shadowed', 'total_ns', 'max_ns')
+
+
+class RuleProfiler:
+    """Per-rule counters of one worker since its last flush"""
+
+    def __init__(self, enabled=RULE_PROFILE):
+        self.enabled = enabled
+        self._slots = {}  # rule id -> index into the arrays
+        self._rule_ids = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stop = threading.Event()
+        self.flushes = 0
+        self._reset()
+
+    def _reset(self):
+        size = len(self._rule_ids)
+        for name in _COUNTERS:
+            setattr(self, name, array('Q', bytes(8 * size)))
+        self.last_match = array('d', bytes(8 * size))
+        self.shadows = {}  # (slot, winner slot) -> samples
+
+    def slot(self, rule_id):
+        """Index of a rule's counters, allocated the first time a matcher sees it"""
+        slot = self._slots.get(rule_id)
+        if slot is None:
+            with self._lock:
+                slot = self._slots.get(rule_id)
+                if slot is None:
+                    slot = len(self._rule_ids)
+                    self._rule_ids.append(rule_id)
+                    for name in _COUNTERS:
+                        getattr(self, name).append(0)
+                    self.last_match.append(0.0)
+                    self._slots[rule_id] = slot
+        return slot
+
+    def take(self):
+        """(rows, shadows) counted since the last take(), and start over.
+
+        rows are (rule_id, evaluations, matches, shadowed, total_ns, max_ns, last_match_at)
+        for rules with any count; shadows are (rule_id, shadowed_by, samples).
+        """
+        with self._lock:
+            counters = [getattr(self, name) for name in _COUNTERS]
+            last_match, shadows, rule_ids = self.last_match, self.shadows, list(self._rule_ids)
+            self._reset()
+        rows = []
+        for slot, rule_id in enumerate(rule_ids):
+            counts = [counter[slot] for counter in counters]
+            if any(counts):
+                matched = last_match[slot]
+                rows.append((rule_id, *counts, _stamp(matched) if matched else None))
+        return rows, [(rule_ids[slot], rule_ids[winner], samples) for (slot, winner), samples in shadows.items()]
+
+    def flush(self, storage):
+        """Add this worker's counts to the stats tables; returns the number of rules written"""
+        rows, shadows = self.take()
+        if rows or shadows:
+            storage.add_rule_stats(rows, shadows)
+            self.flushes += 1
+        return len(rows)
+
+    def start(self, storage):
+        """Start this process's flush thread (once per worker, after fork)"""
+        if not self.enabled or self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, args=(storage,), name='rule-profile', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self, storage):
+        while not self._stop.wait(RULE_PROFILE_FLUSH_S):
+            try:
+                self.flush(storage)
+            except Exception as e:
+                print(f"[RULES] Could not flush rule stats: {e}")
+
+
+def _stamp(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def report(stats, shadows, top=10):
+    """Dead, shadowed and most expensive rules from rule_stats() and rule_shadows() dicts.
+
+    dead       never matched and never seen behind a winner
+    shadowed   seen matching behind an earlier rule in sampled decisions;
+               fully_shadowed when it never decided a command itself
+    expensive  the top rules by search time in sampled decisions
+    """
+    patterns = {rule['id']: rule['pattern'] for rule in stats}
+    shadowed_by = {}
+    for shadow in shadows:
+        if shadow['rule_id'] in patterns and shadow['shadowed_by'] in patterns:
+            shadowed_by.setdefault(shadow['rule_id'], []).append(
+                {'id': shadow['shadowed_by'], 'pattern': patterns[shadow['shadowed_by']], 'samples': shadow['samples']})
+
+    rules = []
+    positions = {}  # scope -> rules seen so far; each scope's set is evaluated on its own
+    for rule in stats:
+        evaluations = rule['evaluations']
+        position = positions[rule['scope']] = positions.get(rule['scope'], 0) + 1
+        rules.append({
+            'id': rule['id'], 'scope': rule['scope'], 'position': position, 'pattern': rule['pattern'],
+            'action': rule['action'],
+            'matches': rule['matches'], 'sampled_evaluations': evaluations, 'shadowed_samples': rule['shadowed'],
+            'sampled_ms': round(rule['total_ns'] / 1e6, 3),
+            'mean_us': round(rule['total_ns'] / evaluations / 1e3, 3) if evaluations else None,
+            'max_us': round(rule['max_ns'] / 1e3, 3),
+            'last_match_at': rule['last_match_at'],
+        })
+    since = [rule['since'] for rule in stats if rule['since']]
+    return {
+        'since': min(since) if since else None,
+        'matched_decisions': sum(rule['matches'] for rule in rules),
+        'sample_rate': RULE_PROFILE_SAMPLE,
+        'dead': [rule for rule in rules if not rule['matches'] and not rule['shadowed_samples']],
+        'shadowed': [dict(rule, fully_shadowed=not rule['matches'],
+                          shadowed_by=sorted(shadowed_by.get(rule['id'], []), key=lambda s: -s['samples']))
+                     for rule in rules if rule['shadowed_samples']],
+        'expensive': sorted((rule for rule in rules if rule['sampled_evaluations']),
+                            key=lambda rule: -rule['sampled_ms'])[:top],
+        'rules': rules,
+    }
+
+
+rule_profiler = RuleProfiler()
@@ -0,0 +1,204 @@
+import json
+import os
+import re
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import pytz
+
+from regex_guard import COMPLEXITY_MODE, analyze_pattern, is_high_risk
+
+# Rule-set documents produced by export and accepted by import
+FORMAT = 'command-gateway-rules'
+FORMAT_VERSION = 1
+RULE_FIELDS = ('pattern', 'action', 'description', 'approval_threshold', 'time_start', 'time_end', 'timezone', 'scope')
+ACTIONS = ('AUTO_ACCEPT', 'AUTO_REJECT', 'REQUIRE_APPROVAL')
+TIERS = ('junior', 'mid', 'senior', 'lead')
+
+# A rule applies to everyone ('global'), to one team's members ('team:<name>')
+# or to one tier ('tier:<tier>'). A command is matched against the requester's
+# scopes in this order, first match wins: by default a team's rules come
+# before its members' tier rules, and both before global rules.
+RULE_SCOPE_PRECEDENCE = tuple(os.environ.get('RULE_SCOPE_PRECEDENCE', 'team,tier,global').split(','))
+# Team names, as stored in users.team and used in 'team:<name>' scopes
+TEAM_NAME = re.compile(r'^[a-z0-9][a-z0-9_.-]{0,63}$')
+
+# Imports at least this large are validated in a process pool
+RULE_IMPORT_PARALLEL_MIN = int(os.environ.get('RULE_IMPORT_PARALLEL_MIN', 500))
+RULE_IMPORT_WORKERS = int(os.environ.get('RULE_IMPORT_WORKERS', min(4, os.cpu_count() or 1)))
+
+# Two rules conflict when they both match one of these (as in check_rule_conflict)
+CONFLICT_TEST_COMMANDS = [
+    'ls -la',
+    'rm -rf /',
+    'git status',
+    'cat file.txt',
+    'echo hello',
+    'mkfs.ext4 /dev/sda',
+    ':(){ :|:& };:'
+]
+
+
+def export_document(rules, rule_set_version):
+    """Versioned JSON document for a rule set, in evaluation order"""
+    return {
+        'format': FORMAT,
+        'format_version': FORMAT_VERSION,
+        'rule_set_version': rule_set_version,
+        'exported_at': datetime.now(timezone.utc).isoformat(),
+        'rules': [{field: rule.get(field) for field in RULE_FIELDS} for rule in rules],
+    }
+
+
+def read_document(document):
+    """The rule list of an import document; ValueError if it is not one we understand"""
+    if not isinstance(document, dict) or not isinstance(document.get('rules'), list):
+        raise ValueError('Expected a rule-set document with a "rules" list')
+    if document.get('format', FORMAT) != FORMAT:
+        raise ValueError(f'Unknown document format: {document.get("format")}')
+    version = document.get('format_version', FORMAT_VERSION)
+    if not isinstance(version, int) or not 1 <= version <= FORMAT_VERSION:
+        raise ValueError(f'Unsupported format_version: {version}')
+    return document['rules']
+
+
+def check_scope(scope):
+    """scope if it names a valid rule scope, else ValueError"""
+    kind, _, name = scope.partition(':') if isinstance(scope, str) else ('', '', '')
+    if kind == 'global' and not name:
+        return scope
+    if kind == 'team' and TEAM_NAME.match(name):
+        return scope
+    if kind == 'tier' and name in TIERS:
+        return scope
+    raise ValueError(f'Invalid scope: {scope!r} (expected "global", "team:<name>" or "tier:<tier>")')
+
+
+def user_scopes(user):
+    """Rule scopes that apply to a user, in RULE_SCOPE_PRECEDENCE order"""
+    scopes = {'global': 'global',
+              'team': f"team:{user['team']}" if user.get('team') else None,
+              'tier': f"tier:{user['tier']}" if user.get('tier') else None}
+    return [scopes[kind] for kind in RULE_SCOPE_PRECEDENCE if scopes.get(kind)]
+
+
+def sample_matches(pattern):
+    """Indexes of the CONFLICT_TEST_COMMANDS a pattern matches (none if it does not compile)"""
+    try:
+        regex = re.compile(pattern)
+    except re.error:
+        return []
+    return [i for i, command in enumerate(CONFLICT_TEST_COMMANDS) if regex.search(command)]
+
+
+def validate_rule(rule):
+    """Check one imported rule; returns {'rule', 'errors', 'warnings', 'samples'}.
+
+    Self-contained (no database, no app state) so it can run in a pool process.
+    """
+    errors = []
+    warnings = []
+    if not isinstance(rule, dict):
+        return {'rule': None, 'errors': ['Rule must be an object'], 'warnings': [], 'samples': []}
+
+    pattern = rule.get('pattern')
+    action = rule.get('action')
+    normalized = {
+        'pattern': pattern,
+        'action': action,
+        'description': rule.get('description') or '',
+        'approval_threshold': rule.get('approval_threshold', 1),
+        'time_start': rule.get('time_start') or '',
+        'time_end': rule.get('time_end') or '',
+        'timezone': rule.get('timezone') or 'UTC',
+        'scope': rule.get('scope') or 'global',
+    }
+    samples = []
+
+    if not pattern or not isinstance(pattern, str):
+        errors.append('Pattern required')
+    else:
+        try:
+            re.compile(pattern)
+        except re.error as e:
+            errors.append(f'Invalid regex pattern: {e}')
+        else:
+            complexity = analyze_pattern(pattern)
+            if is_high_risk(complexity) and COMPLEXITY_MODE == 'reject':
+                errors.append('Pattern is vulnerable to catastrophic backtracking')
+            else:
+                warnings.extend(complexity)
+                samples = sample_matches(pattern)
+
+    if action not in ACTIONS:
+        errors.append('Invalid action')
+
+    threshold = normalized['approval_threshold']
+    if threshold is None:
+        normalized['approval_threshold'] = 1
+    elif isinstance(threshold, bool) or not isinstance(threshold, int) or threshold < 1:
+        errors.append('approval_threshold must be a positive whole number')
+
+    for field in ('time_start', 'time_end'):
+        if normalized[field]:
+            try:
+                datetime.strptime(normalized[field], '%H:%M')
+            except (TypeError, ValueError):
+                errors.append(f'Invalid {field}. Use HH:MM')
+
+    if not isinstance(normalized['timezone'], str) or normalized['timezone'] not in pytz.all_timezones_set:
+        errors.append(f'Unknown timezone: {normalized["timezone"]}')
+
+    try:
+        check_scope(normalized['scope'])
+    except ValueError as e:
+        errors.append(str(e))
+
+    return {'rule': normalized, 'errors': errors, 'warnings': warnings, 'samples': samples}
+
+
+def _validate_in_process(chunk):
+    """validate_rule over a chunk in a fresh interpreter (python rule_sets.py)"""
+    result = subprocess.run([sys.executable, '-I', os.path.abspath(__file__)], input=json.dumps(chunk).encode(),
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=120, check=True)
+    return json.loads(result.stdout)
+
+
+def validate_rules(rules):
+    """validate_rule for every rule, split over a pool of processes when the set is large"""
+    if len(rules) < RULE_IMPORT_PARALLEL_MIN or RULE_IMPORT_WORKERS < 2:
+        return [validate_rule(rule) for rule in rules]
+    # Separate interpreters (like the regex_guard worker) rather than forks of
+    # a threaded server that holds SQLite handles
+    size = -(-len(rules) // RULE_IMPORT_WORKERS)
+    chunks = [rules[start:start + size] for start in range(0, len(rules), size)]
+    try:
+        with ThreadPoolExecutor(max_workers=len(chunks)) as pool:
+            return [result for results in pool.map(_validate_in_process, chunks) for result in results]
+    except (OSError, ValueError, subprocess.SubprocessError) as e:
+        print(f"[RULES] Validation workers failed ({e}), validating in process")
+        return [validate_rule(rule) for rule in rules]
+
+
+def find_conflicts(imported, existing):
+    """Test commands matched by an imported rule and by at least one other rule.
+
+    imported and existing are lists of (pattern, samples), all of one scope:
+    across scopes, precedence decides. Conflicts among existing rules alone
+    are not reported; they predate the import.
+    """
+    conflicts = []
+    for i, command in enumerate(CONFLICT_TEST_COMMANDS):
+        new = [pattern for pattern, samples in imported if i in samples]
+        if not new:
+            continue
+        old = [pattern for pattern, samples in existing if i in samples]
+        if len(new) + len(old) > 1:
+            conflicts.append({'conflict_command': command, 'imported': new, 'existing': old})
+    return conflicts
+
+
+if __name__ == '__main__':
+    json.dump([validate_rule(rule) for rule in json.load(sys.stdin)], sys.stdout)
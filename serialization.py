@@ -0,0 +1,119 @@
+import csv
+import io
+import json
+import zlib
+from datetime import date, datetime
+from json.encoder import encode_basestring_ascii
+
+try:
+    import orjson  # Optional, much faster encoder (pip install orjson)
+except ImportError:
+    orjson = None
+
+# Rows encoded per chunk when streaming a response body
+CHUNK_ROWS = 500
+# Bodies smaller than this are not worth compressing
+MIN_COMPRESS_BYTES = 1024
+
+_ENCODINGS = {
+    'gzip': 31,     # zlib wbits for a gzip container
+    'deflate': 15,  # HTTP "deflate" is the zlib format
+}
+
+
+def select_fields(fields_arg, columns):
+    """Column indexes for a ?fields=a,b projection; all columns when absent"""
+    # Like dict(row), a repeated column name keeps its first position and last value
+    positions = {}
+    for i, name in enumerate(columns):
+        positions[name] = i
+    if not fields_arg:
+        return list(positions.values())
+    wanted = [f.strip() for f in fields_arg.split(',') if f.strip()]
+    unknown = [f for f in wanted if f not in positions]
+    if unknown:
+        raise ValueError(f'Unknown field(s): {", ".join(unknown)}')
+    return [positions[f] for f in dict.fromkeys(wanted)]
+
+def _encode_value(value):
+    if value is None:
+        return 'null'
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    if isinstance(value, int):
+        return int.__repr__(value)
+    if isinstance(value, str):
+        return encode_basestring_ascii(value)
+    if isinstance(value, (datetime, date)):
+        return encode_basestring_ascii(value.isoformat(sep=' ') if isinstance(value, datetime) else value.isoformat())
+    if isinstance(value, bytes):
+        return encode_basestring_ascii(value.decode('utf-8', 'replace'))
+    return json.dumps(value)
+
+def _orjson_default(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    raise TypeError
+
+def encode_row_items(rows, columns, indexes):
+    """Comma-separated JSON objects for rows (no surrounding brackets)"""
+    if orjson is not None:
+        names = [columns[i] for i in indexes]
+        objects = [dict(zip(names, [row[i] for i in indexes])) for row in rows]
+        return orjson.dumps(objects, default=_orjson_default)[1:-1]
+    # Key prefixes are encoded once per response instead of once per row
+    prefixes = [('{' if n == 0 else ',') + encode_basestring_ascii(columns[i]) + ':'
+                for n, i in enumerate(indexes)]
+    pairs = list(zip(prefixes, indexes))
+    encoded = [''.join([prefix + _encode_value(row[i]) for prefix, i in pairs]) + '}' for row in rows]
+    return ','.join(encoded).encode('ascii')
+
+def encode_rows(rows, columns, indexes):
+    if not indexes:
+        return ('[' + ','.join('{}' for _ in rows) + ']').encode()
+    return b'[' + encode_row_items(rows, columns, indexes) + b']'
+
+def iter_encoded_rows(rows, columns, indexes, chunk_rows=CHUNK_ROWS):
+    """Yield the JSON array for rows in chunks so large bodies are never built whole"""
+    yield b'['
+    for start in range(0, len(rows), chunk_rows):
+        chunk = rows[start:start + chunk_rows]
+        if indexes:
+            body = encode_row_items(chunk, columns, indexes)
+        else:
+            body = ','.join('{}' for _ in chunk).encode()
+        yield body if start == 0 else b',' + body
+    yield b']'
+
+
+def iter_csv_rows(rows, columns, chunk_rows=CHUNK_ROWS):
+    """Yield rows as CSV (header first) in chunks, like iter_encoded_rows"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for start in range(0, len(rows), chunk_rows):
+        writer.writerows(rows[start:start + chunk_rows])
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def negotiate_encoding(accept_encodings):
+    """Best of gzip/deflate the client accepts (werkzeug Accept object), or None"""
+    return accept_encodings.best_match(list(_ENCODINGS))
+
+def compress_body(data, encoding):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, _ENCODINGS[encoding])
+    return compressor.compress(data) + compressor.flush()
+
+def compress_stream(chunks, encoding):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, _ENCODINGS[encoding])
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -8,10 +8,14 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 });
 
+// Last ETag and body per GET endpoint, revalidated with If-None-Match
+let etagCache = {};
+
 // API helper function
 async function apiCall(endpoint, method = 'GET', body = null) {
     const options = {
         method,
+        cache: 'no-store',
         headers: {
             'Content-Type': 'application/json',
             'X-API-Key': apiKey
@@ -22,16 +26,237 @@ async function apiCall(endpoint, method = 'GET', body = null) {
         options.body = JSON.stringify(body);
     }
     
+    const cached = method === 'GET' ? etagCache[endpoint] : null;
+    if (cached) {
+        options.headers['If-None-Match'] = cached.etag;
+    }
+    
     const response = await fetch(`/api${endpoint}`, options);
+    if (response.status === 304 && cached) {
+        return cached.data;
+    }
+    
     const data = await response.json();
     
     if (!response.ok) {
         throw new Error(data.error || 'Request failed');
     }
     
+    const etag = response.headers.get('ETag');
+    if (method === 'GET' && etag) {
+        etagCache[endpoint] = { etag, data };
+    }
+    
     return data;
 }
 
+// Lists are kept as client-side copies and refreshed with deltas
+// (?updated_since= or ?since_id=), merged by row id
+const LIST_LIMIT = 2000;
+// Deltas start a little before the newest change seen, for rows committed late
+const SYNC_OVERLAP_MS = 2000;
+// Deletions do not show up in deltas; a periodic full reload catches them
+const FULL_RELOAD_MS = 5 * 60 * 1000;
+// Rows rendered beyond each edge of the visible part of a list
+const OVERSCAN_ROWS = 8;
+
+function newestFirst(a, b) {
+    if (a.created_at !== b.created_at) return a.created_at < b.created_at ? 1 : -1;
+    return a.id - b.id;
+}
+
+// updated_at ('YYYY-MM-DD HH:MM:SS.mmm', UTC) minus the overlap, as ISO 8601
+function syncSince(updatedAt) {
+    const moment = new Date(updatedAt.replace(' ', 'T') + 'Z');
+    return new Date(moment.getTime() - SYNC_OVERLAP_MS).toISOString().replace('Z', '+00:00');
+}
+
+class SyncedList {
+    constructor(endpoint, { cursor = 'updated_at', keep = () => true, compare = newestFirst, limit = null } = {}) {
+        this.endpoint = endpoint;
+        this.cursorField = cursor;
+        this.keep = keep;
+        this.compare = compare;
+        this.limit = limit;
+        this.reset();
+    }
+
+    reset() {
+        this.rows = new Map();
+        this.cursor = null;
+        this.loadedAt = 0;
+        this.deltaEndpoint = null;
+    }
+
+    remove(id) {
+        this.rows.delete(id);
+    }
+
+    // Fetch what changed since the last sync and return the merged, sorted rows
+    async sync() {
+        const full = !this.loadedAt || this.cursor === null || Date.now() - this.loadedAt > FULL_RELOAD_MS;
+        const params = new URLSearchParams();
+        if (this.limit) params.set('limit', this.limit);
+        if (!full && this.cursorField === 'id') params.set('since_id', this.cursor);
+        if (!full && this.cursorField === 'updated_at') params.set('updated_since', syncSince(this.cursor));
+        const query = params.toString();
+        const endpoint = query ? `${this.endpoint}?${query}` : this.endpoint;
+        const rows = await apiCall(endpoint);
+        
+        if (!full) {
+            // Only the latest delta is worth revalidating
+            if (this.deltaEndpoint && this.deltaEndpoint !== endpoint) delete etagCache[this.deltaEndpoint];
+            this.deltaEndpoint = endpoint;
+            if (this.limit && rows.length >= this.limit) {
+                // More changed than one delta holds: start over
+                this.loadedAt = 0;
+                return this.sync();
+            }
+        } else {
+            this.rows.clear();
+            this.cursor = null;
+            this.loadedAt = Date.now();
+        }
+        
+        for (const row of rows) {
+            if (this.keep(row)) {
+                this.rows.set(row.id, row);
+            } else {
+                this.rows.delete(row.id);
+            }
+            const mark = row[this.cursorField];
+            if (mark != null && (this.cursor === null || mark > this.cursor)) this.cursor = mark;
+        }
+        
+        const sorted = [...this.rows.values()].sort(this.compare);
+        if (this.limit && sorted.length > this.limit) {
+            sorted.splice(this.limit).forEach(row => this.rows.delete(row.id));
+        }
+        return sorted;
+    }
+}
+
+const historyStore = new SyncedList('/commands', { limit: LIST_LIMIT });
+const usersStore = new SyncedList('/users', { compare: (a, b) => a.id - b.id });
+const auditStore = new SyncedList('/audit-logs', { cursor: 'id', limit: LIST_LIMIT });
+// Pending deltas include decided commands, which are dropped
+const pendingStore = new SyncedList('/commands/pending', { keep: cmd => cmd.status === 'pending' });
+
+// Renders only the rows in and near view of a scrolling list; spacers above
+// and below stand in for the rest, sized from measured (or estimated) heights
+class VirtualList {
+    constructor(container, renderRow, estimate = 110) {
+        this.container = container;
+        this.renderRow = renderRow;
+        this.estimate = estimate;
+        this.rows = [];
+        this.heights = new Map();   // row id -> height including margins
+        this.elements = new Map();  // row id -> { html, el } for the rendered rows
+        this.scheduled = false;
+        
+        this.top = document.createElement('div');
+        this.body = document.createElement('div');
+        this.body.className = 'virtual-list-body';
+        this.bottom = document.createElement('div');
+        container.classList.add('virtual-list');
+        container.replaceChildren(this.top, this.body, this.bottom);
+        
+        container.addEventListener('scroll', () => this.schedule());
+        if (window.ResizeObserver) {
+            // Tab shown, window resized or a row grew (e.g. output expanded)
+            const observer = new ResizeObserver(() => this.schedule());
+            observer.observe(container);
+            observer.observe(this.body);
+        }
+    }
+
+    setRows(rows, emptyHtml) {
+        if (rows.length === 0) {
+            this.showMessage(emptyHtml);
+            return;
+        }
+        this.rows = rows;
+        this.render();
+    }
+
+    showMessage(html) {
+        this.rows = [];
+        this.elements.clear();
+        this.top.style.height = this.bottom.style.height = '0px';
+        this.body.innerHTML = html;
+    }
+
+    schedule() {
+        if (this.scheduled) return;
+        this.scheduled = true;
+        requestAnimationFrame(() => {
+            this.scheduled = false;
+            this.render();
+        });
+    }
+
+    render() {
+        const rows = this.rows;
+        if (rows.length === 0) return;
+        
+        const tops = [0];
+        rows.forEach((row, i) => tops.push(tops[i] + (this.heights.get(row.id) ?? this.estimate)));
+        const viewTop = this.container.scrollTop;
+        const viewBottom = viewTop + (this.container.clientHeight || window.innerHeight);
+        let start = 0;
+        while (start < rows.length && tops[start + 1] <= viewTop) start++;
+        let end = start;
+        while (end < rows.length && tops[end] < viewBottom) end++;
+        start = Math.max(0, start - OVERSCAN_ROWS);
+        end = Math.min(rows.length, end + OVERSCAN_ROWS);
+        
+        // Rows whose markup is unchanged keep their element (and any input state)
+        const elements = new Map();
+        const nodes = rows.slice(start, end).map(row => {
+            const html = this.renderRow(row);
+            let entry = this.elements.get(row.id);
+            if (!entry || entry.html !== html) {
+                const template = document.createElement('template');
+                template.innerHTML = html.trim();
+                entry = { html, el: template.content.firstElementChild };
+            }
+            elements.set(row.id, entry);
+            return entry.el;
+        });
+        this.elements = elements;
+        
+        this.top.style.height = `${tops[start]}px`;
+        this.bottom.style.height = `${tops[rows.length] - tops[end]}px`;
+        const current = this.body.children;
+        if (nodes.length !== current.length || nodes.some((node, i) => node !== current[i])) {
+            this.body.replaceChildren(...nodes);
+        }
+        
+        // Nothing to measure while the tab is hidden
+        if (!this.container.clientHeight) return;
+        let changed = false;
+        nodes.forEach((node, i) => {
+            const style = getComputedStyle(node);
+            const height = node.offsetHeight + parseFloat(style.marginTop) + parseFloat(style.marginBottom);
+            const id = rows[start + i].id;
+            if (this.heights.get(id) !== height) {
+                this.heights.set(id, height);
+                changed = true;
+            }
+        });
+        if (changed) this.schedule();
+    }
+}
+
+const listViews = {};
+
+function listView(elementId, renderRow) {
+    if (!listViews[elementId]) {
+        listViews[elementId] = new VirtualList(document.getElementById(elementId), renderRow);
+    }
+    return listViews[elementId];
+}
+
 // Login
 async function login() {
     const input = document.getElementById('api-key-input');
@@ -80,6 +305,8 @@ async function login() {
 // Logout
 function logout() {
     apiKey = '';
+    etagCache = {};
+    [historyStore, usersStore, auditStore, pendingStore].forEach(store => store.reset());
     localStorage.removeItem('apiKey');
     currentUser = null;
     document.getElementById('login-section').style.display = 'block';
@@ -166,6 +393,17 @@ async function submitCommand() {
             `;
             currentUser.credits = result.new_balance;
             updateUserInfo();
+        } else if (result.status === 'accepted') {
+            resultBox.className = 'result-box info';
+            resultBox.innerHTML = `
+                <strong>▶ Command Accepted, running…</strong><br>
+                Credits deducted: ${result.credits_deducted}<br>
+                New balance: ${result.new_balance}
+                <pre class="command-output"></pre>
+            `;
+            currentUser.credits = result.new_balance;
+            updateUserInfo();
+            streamOutput(result.output_url, resultBox);
         } else if (result.status === 'rejected') {
             resultBox.className = 'result-box error';
             resultBox.innerHTML = `
@@ -195,42 +433,85 @@ async function submitCommand() {
     }
 }
 
+// Follow the output of a queued command until it finishes
+async function streamOutput(outputUrl, resultBox) {
+    const pre = resultBox.querySelector('.command-output');
+    try {
+        const response = await fetch(outputUrl, {
+            cache: 'no-store',
+            headers: { 'X-API-Key': apiKey }
+        });
+        if (!response.ok) {
+            throw new Error('Could not read command output');
+        }
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            pre.textContent += decoder.decode(value, { stream: true });
+        }
+        const command = await apiCall(outputUrl.replace('/api', '').replace(/\/output$/, ''));
+        const succeeded = command.execution_status === 'succeeded';
+        resultBox.className = `result-box ${succeeded ? 'success' : 'error'}`;
+        resultBox.querySelector('strong').textContent = succeeded
+            ? '✓ Command Executed'
+            : `✗ Command ${command.execution_status.replace('_', ' ')} (exit ${command.exit_code ?? '-'})`;
+    } catch (error) {
+        pre.textContent += `\n${error.message}`;
+    }
+    loadHistory();
+}
+
+function formatBytes(size) {
+    if (size < 1024) return `${size} B`;
+    if (size < 1024 * 1024) return `${(size / 1024).toFixed(1)} KB`;
+    return `${(size / 1024 / 1024).toFixed(1)} MB`;
+}
+
+// History lists only output sizes; fetch one output when asked
+async function showOutput(commandId, button) {
+    const response = await fetch(`/api/commands/${commandId}/output?follow=0`, {
+        headers: { 'X-API-Key': apiKey }
+    });
+    const pre = document.createElement('pre');
+    pre.className = 'command-output';
+    pre.textContent = response.ok ? await response.text() : 'Could not load output';
+    button.replaceWith(pre);
+}
+
 // Load command history
 async function loadHistory() {
+    const view = listView('history-list', renderHistoryItem);
     try {
-        const commands = await apiCall('/commands');
-        const historyList = document.getElementById('history-list');
-        
-        if (commands.length === 0) {
-            historyList.innerHTML = '<div class="empty-state">No commands yet</div>';
-            return;
-        }
-        
-        historyList.innerHTML = commands.map(cmd => {
-            const date = new Date(cmd.created_at).toLocaleString();
-            const statusClass = cmd.status.toLowerCase();
-            
-            return `
-                <div class="history-item ${statusClass}">
-                    <div class="item-header">
-                        <div class="item-title">${escapeHtml(cmd.command_text)}</div>
-                        <span class="status-badge ${statusClass}">${cmd.status}</span>
-                    </div>
-                    <div class="item-meta">
-                        ${cmd.execution_output ? `Output: ${escapeHtml(cmd.execution_output)}<br>` : ''}
-                        ${cmd.credits_deducted > 0 ? `Credits: -${cmd.credits_deducted}<br>` : ''}
-                        ${currentUser.role === 'admin' ? `User: ${cmd.username || 'N/A'}<br>` : ''}
-                        Time: ${date}
-                    </div>
-                </div>
-            `;
-        }).join('');
+        const commands = await historyStore.sync();
+        view.setRows(commands, '<div class="empty-state">No commands yet</div>');
     } catch (error) {
-        document.getElementById('history-list').innerHTML = 
-            `<div class="result-box error">Error loading history: ${error.message}</div>`;
+        view.showMessage(`<div class="result-box error">Error loading history: ${error.message}</div>`);
     }
 }
 
+function renderHistoryItem(cmd) {
+    const date = new Date(cmd.created_at).toLocaleString();
+    const statusClass = cmd.status.toLowerCase();
+    
+    return `
+        <div class="history-item ${statusClass}">
+            <div class="item-header">
+                <div class="item-title">${escapeHtml(cmd.command_text)}</div>
+                <span class="status-badge ${statusClass}">${cmd.status}</span>
+            </div>
+            <div class="item-meta">
+                ${cmd.output_size != null ? `Output: ${formatBytes(cmd.output_size)}
+                    <button class="btn-link" onclick="showOutput(${cmd.id}, this)">show</button><br>` : ''}
+                ${cmd.credits_deducted > 0 ? `Credits: -${cmd.credits_deducted}<br>` : ''}
+                ${currentUser.role === 'admin' ? `User: ${cmd.username || 'N/A'}<br>` : ''}
+                Time: ${date}
+            </div>
+        </div>
+    `;
+}
+
 // Load rules (Admin only)
 async function loadRules() {
     // Security check: Only admins can load rules
@@ -263,7 +544,10 @@ async function loadRules() {
                 <div class="rule-item">
                     <div class="item-header">
                         <div class="item-title">${escapeHtml(rule.pattern)}</div>
-                        <span class="status-badge ${rule.action === 'AUTO_ACCEPT' ? 'executed' : rule.action === 'AUTO_REJECT' ? 'rejected' : 'pending'}">${rule.action}</span>
+                        <div style="display: flex; gap: 8px; align-items: center;">
+                            ${rule.scope && rule.scope !== 'global' ? `<span class="status-badge" style="background: #dbeafe; color: #1e40af;">${escapeHtml(rule.scope)}</span>` : ''}
+                            <span class="status-badge ${rule.action === 'AUTO_ACCEPT' ? 'executed' : rule.action === 'AUTO_REJECT' ? 'rejected' : 'pending'}">${rule.action}</span>
+                        </div>
                     </div>
                     <div class="item-meta">
                         ${rule.description ? `Description: ${escapeHtml(rule.description)}<br>` : ''}
@@ -305,6 +589,7 @@ function showAddRuleModal() {
     document.getElementById('rule-time-start').value = '';
     document.getElementById('rule-time-end').value = '';
     document.getElementById('rule-timezone').value = 'UTC';
+    document.getElementById('rule-scope').value = 'global';
     document.getElementById('rule-conflict-warning').style.display = 'none';
     toggleApprovalFields();
     toggleTimeFields();
@@ -312,6 +597,7 @@ function showAddRuleModal() {
 
 async function checkRuleConflict() {
     const pattern = document.getElementById('rule-pattern').value.trim();
+    const scope = document.getElementById('rule-scope').value.trim() || 'global';
     const warningDiv = document.getElementById('rule-conflict-warning');
     
     if (!pattern) {
@@ -320,10 +606,17 @@ async function checkRuleConflict() {
     }
     
     try {
-        const result = await apiCall('/rules/check-conflict', 'POST', { pattern });
+        const result = await apiCall('/rules/check-conflict', 'POST', { pattern, scope });
+        const warnings = [];
         if (result.has_conflicts) {
+            warnings.push(`⚠️ Conflicts with ${result.conflicts.length} existing rule(s)`);
+        }
+        (result.complexity || []).forEach(issue => {
+            warnings.push(`${issue.severity === 'high' ? '⛔' : '⚠️'} ${issue.message}`);
+        });
+        if (warnings.length) {
             warningDiv.style.display = 'block';
-            warningDiv.textContent = `⚠️ Conflicts with ${result.conflicts.length} existing rule(s)`;
+            warningDiv.textContent = warnings.join(' · ');
         } else {
             warningDiv.style.display = 'none';
         }
@@ -358,6 +651,7 @@ async function addRule() {
     const time_start = timeBased ? document.getElementById('rule-time-start').value : '';
     const time_end = timeBased ? document.getElementById('rule-time-end').value : '';
     const timezone = timeBased ? (document.getElementById('rule-timezone').value || 'UTC') : 'UTC';
+    const scope = document.getElementById('rule-scope').value.trim() || 'global';
     
     if (!pattern) {
         alert('Please enter a pattern');
@@ -372,7 +666,8 @@ async function addRule() {
             approval_threshold: action === 'REQUIRE_APPROVAL' ? approval_threshold : undefined,
             time_start,
             time_end,
-            timezone
+            timezone,
+            scope
         });
         
         closeModal('add-rule-modal');
@@ -412,70 +707,52 @@ async function loadUsers() {
         return;
     }
     
+    const view = listView('users-list', renderUserItem);
     try {
         console.log('Loading users...');
-        const users = await apiCall('/users');
-        console.log('Users loaded:', users);
-        console.log('Users count:', users ? users.length : 0);
-        const usersList = document.getElementById('users-list');
-        
-        if (!usersList) {
-            console.error('users-list element not found!');
-            return;
-        }
-        
-        if (!users || users.length === 0) {
-            console.log('No users found, showing empty state');
-            usersList.innerHTML = '<div class="empty-state">No users found</div>';
-            return;
-        }
-        
-        console.log('Rendering', users.length, 'users');
-        const html = users.map(user => {
-            return `
-                <div class="user-item">
-                    <div class="item-header">
-                        <div class="item-title">${escapeHtml(user.username)}</div>
-                        <div style="display: flex; gap: 8px; align-items: center;">
-                            <span class="status-badge ${user.role === 'admin' ? 'executed' : 'accepted'}">${user.role}</span>
-                            <span class="status-badge" style="background: #dbeafe; color: #1e40af;">${user.tier || 'junior'}</span>
-                        </div>
-                    </div>
-                    <div class="item-meta">
-                        Credits: ${user.credits}<br>
-                        Tier: ${user.tier || 'junior'} (Threshold: ${user.tier === 'junior' ? 3 : user.tier === 'mid' ? 2 : 1})<br>
-                        ${user.email ? `Email: ${escapeHtml(user.email)}<br>` : ''}
-                        ${user.telegram_chat_id ? `Telegram: ${escapeHtml(user.telegram_chat_id)}<br>` : ''}
-                        Created: ${new Date(user.created_at).toLocaleString()}
-                    </div>
-                    <div style="margin-top: 12px; display: flex; gap: 8px; align-items: center; flex-wrap: wrap;">
-                        <input type="number" id="credits-${user.id}" value="${user.credits}" min="0" style="width: 120px; padding: 6px;">
-                        <button onclick="updateUserCredits(${user.id})" class="btn btn-secondary" style="padding: 6px 12px; font-size: 0.8rem;">Update Credits</button>
-                        <select id="tier-${user.id}" style="padding: 6px; font-size: 0.8rem;">
-                            <option value="junior" ${(user.tier || 'junior') === 'junior' ? 'selected' : ''}>Junior</option>
-                            <option value="mid" ${user.tier === 'mid' ? 'selected' : ''}>Mid</option>
-                            <option value="senior" ${user.tier === 'senior' ? 'selected' : ''}>Senior</option>
-                            <option value="lead" ${user.tier === 'lead' ? 'selected' : ''}>Lead</option>
-                        </select>
-                        <button onclick="updateUserTier(${user.id})" class="btn btn-secondary" style="padding: 6px 12px; font-size: 0.8rem;">Update Tier</button>
-                        ${user.role === 'member' ? `<button onclick="deleteUser(${user.id}, '${escapeHtml(user.username)}')" class="btn btn-danger" style="padding: 6px 12px; font-size: 0.8rem;">Delete</button>` : ''}
-                    </div>
-                </div>
-            `;
-        }).join('');
-        console.log('Setting innerHTML for users-list');
-        usersList.innerHTML = html;
-        console.log('Users rendered successfully');
+        const users = await usersStore.sync();
+        console.log('Users count:', users.length);
+        view.setRows(users, '<div class="empty-state">No users found</div>');
     } catch (error) {
         console.error('Error loading users:', error);
-        const usersList = document.getElementById('users-list');
-        if (usersList) {
-            usersList.innerHTML = 
-                `<div class="result-box error">Error loading users: ${error.message}</div>`;
-        }
+        view.showMessage(`<div class="result-box error">Error loading users: ${error.message}</div>`);
     }
 }
 
+function renderUserItem(user) {
+    return `
+        <div class="user-item">
+            <div class="item-header">
+                <div class="item-title">${escapeHtml(user.username)}</div>
+                <div style="display: flex; gap: 8px; align-items: center;">
+                    <span class="status-badge ${user.role === 'admin' ? 'executed' : 'accepted'}">${user.role}</span>
+                    <span class="status-badge" style="background: #dbeafe; color: #1e40af;">${user.tier || 'junior'}</span>
+                </div>
+            </div>
+            <div class="item-meta">
+                Credits: ${user.credits}${user.credits_reserved ? ` (${user.credits_reserved} reserved for pending commands)` : ''}<br>
+                Tier: ${user.tier || 'junior'} (Threshold: ${user.tier === 'junior' ? 3 : user.tier === 'mid' ? 2 : 1})<br>
+                ${user.team ? `Team: ${escapeHtml(user.team)}<br>` : ''}
+                ${user.email ? `Email: ${escapeHtml(user.email)}<br>` : ''}
+                ${user.telegram_chat_id ? `Telegram: ${escapeHtml(user.telegram_chat_id)}<br>` : ''}
+                Created: ${new Date(user.created_at).toLocaleString()}
+            </div>
+            <div style="margin-top: 12px; display: flex; gap: 8px; align-items: center; flex-wrap: wrap;">
+                <input type="number" id="credits-${user.id}" value="${user.credits}" min="0" style="width: 120px; padding: 6px;">
+                <button onclick="updateUserCredits(${user.id})" class="btn btn-secondary" style="padding: 6px 12px; font-size: 0.8rem;">Update Credits</button>
+                <select id="tier-${user.id}" style="padding: 6px; font-size: 0.8rem;">
+                    <option value="junior" ${(user.tier || 'junior') === 'junior' ? 'selected' : ''}>Junior</option>
+                    <option value="mid" ${user.tier === 'mid' ? 'selected' : ''}>Mid</option>
+                    <option value="senior" ${user.tier === 'senior' ? 'selected' : ''}>Senior</option>
+                    <option value="lead" ${user.tier === 'lead' ? 'selected' : ''}>Lead</option>
+                </select>
+                <button onclick="updateUserTier(${user.id})" class="btn btn-secondary" style="padding: 6px 12px; font-size: 0.8rem;">Update Tier</button>
+                ${user.role === 'member' ? `<button onclick="deleteUser(${user.id}, '${escapeHtml(user.username)}')" class="btn btn-danger" style="padding: 6px 12px; font-size: 0.8rem;">Delete</button>` : ''}
+            </div>
+        </div>
+    `;
+}
+
 // Add user (Admin only)
 function showAddUserModal() {
     // Security check: Only admins can add users
@@ -488,6 +765,7 @@ function showAddUserModal() {
     document.getElementById('user-username').value = '';
     document.getElementById('user-role').value = 'member';
     document.getElementById('user-tier').value = 'junior';
+    document.getElementById('user-team').value = '';
     document.getElementById('user-credits').value = '100';
     document.getElementById('user-email').value = '';
     document.getElementById('user-telegram').value = '';
@@ -504,6 +782,7 @@ async function addUser() {
     const username = document.getElementById('user-username').value.trim();
     const role = document.getElementById('user-role').value;
     const tier = document.getElementById('user-tier').value;
+    const team = document.getElementById('user-team').value.trim();
     const credits = parseInt(document.getElementById('user-credits').value);
     const email = document.getElementById('user-email').value.trim();
     const telegram_chat_id = document.getElementById('user-telegram').value.trim();
@@ -518,6 +797,7 @@ async function addUser() {
             username,
             role,
             tier,
+            team: team || undefined,
             credits,
             email: email || undefined,
             telegram_chat_id: telegram_chat_id || undefined
@@ -630,6 +910,7 @@ async function deleteUser(userId, username) {
     
     try {
         await apiCall(`/users/${userId}`, 'DELETE');
+        usersStore.remove(userId);
         await loadUsers();
         alert('User deleted successfully!');
     } catch (error) {
@@ -645,52 +926,33 @@ async function loadAuditLogs() {
         return;
     }
     
+    const view = listView('audit-logs-list', renderAuditItem);
     try {
         console.log('Loading audit logs...');
-        const logs = await apiCall('/audit-logs');
-        console.log('Audit logs loaded:', logs);
-        console.log('Logs count:', logs ? logs.length : 0);
-        const auditList = document.getElementById('audit-logs-list');
-        
-        if (!auditList) {
-            console.error('audit-logs-list element not found!');
-            return;
-        }
-        
-        if (!logs || logs.length === 0) {
-            console.log('No audit logs found, showing empty state');
-            auditList.innerHTML = '<div class="empty-state">No audit logs</div>';
-            return;
-        }
-        
-        console.log('Rendering', logs.length, 'audit logs');
-        const html = logs.map(log => {
-            return `
-                <div class="audit-item">
-                    <div class="item-header">
-                        <div class="item-title">${escapeHtml(log.action_type)}</div>
-                        <span class="item-meta">${new Date(log.created_at).toLocaleString()}</span>
-                    </div>
-                    <div class="item-meta">
-                        User: ${log.username || 'System'}<br>
-                        Details: ${escapeHtml(log.details || 'N/A')}
-                    </div>
-                </div>
-            `;
-        }).join('');
-        console.log('Setting innerHTML for audit-logs-list');
-        auditList.innerHTML = html;
-        console.log('Audit logs rendered successfully');
+        const logs = await auditStore.sync();
+        console.log('Logs count:', logs.length);
+        view.setRows(logs, '<div class="empty-state">No audit logs</div>');
     } catch (error) {
         console.error('Error loading audit logs:', error);
-        const auditList = document.getElementById('audit-logs-list');
-        if (auditList) {
-            auditList.innerHTML = 
-                `<div class="result-box error">Error loading audit logs: ${error.message}</div>`;
-        }
+        view.showMessage(`<div class="result-box error">Error loading audit logs: ${error.message}</div>`);
     }
 }
 
+function renderAuditItem(log) {
+    return `
+        <div class="audit-item">
+            <div class="item-header">
+                <div class="item-title">${escapeHtml(log.action_type)}</div>
+                <span class="item-meta">${new Date(log.created_at).toLocaleString()}</span>
+            </div>
+            <div class="item-meta">
+                User: ${log.username || 'System'}<br>
+                Details: ${escapeHtml(log.details || 'N/A')}
+            </div>
+        </div>
+    `;
+}
+
 // Modal functions
 function closeModal(modalId) {
     document.getElementById(modalId).style.display = 'none';
@@ -719,54 +981,46 @@ async function loadPendingApprovals() {
         return;
     }
     
+    if (!document.getElementById('approvals-list')) return;
+    const view = listView('approvals-list', renderPendingItem);
     try {
-        const commands = await apiCall('/commands/pending');
-        const approvalsList = document.getElementById('approvals-list');
-        
-        if (!approvalsList) return;
-        
-        if (!commands || commands.length === 0) {
-            approvalsList.innerHTML = '<div class="empty-state">No pending approvals</div>';
-            return;
-        }
-        
-        approvalsList.innerHTML = commands.map(cmd => {
-            const threshold = cmd.approval_threshold || 1;
-            const approvalCount = cmd.approval_count || 0;
-            const rejectionCount = cmd.rejection_count || 0;
-            const progress = Math.min((approvalCount / threshold) * 100, 100);
-            
-            return `
-                <div class="history-item pending">
-                    <div class="item-header">
-                        <div class="item-title">${escapeHtml(cmd.command_text)}</div>
-                        <span class="status-badge pending">Pending</span>
-                    </div>
-                    <div class="item-meta">
-                        User: ${escapeHtml(cmd.username)} (${cmd.tier || 'junior'})<br>
-                        Approvals: ${approvalCount}/${threshold} | Rejections: ${rejectionCount}<br>
-                        <div style="background: #e5e7eb; border-radius: 4px; height: 8px; margin: 8px 0;">
-                            <div style="background: #3b82f6; height: 100%; width: ${progress}%; border-radius: 4px; transition: width 0.3s;"></div>
-                        </div>
-                        Created: ${new Date(cmd.created_at).toLocaleString()}<br>
-                        ${cmd.escalation_at ? `Escalation: ${new Date(cmd.escalation_at).toLocaleString()}<br>` : ''}
-                    </div>
-                    <div style="margin-top: 12px; display: flex; gap: 8px;">
-                        <button onclick="approveCommand(${cmd.id})" class="btn btn-primary">Approve</button>
-                        <button onclick="rejectCommand(${cmd.id})" class="btn btn-danger">Reject</button>
-                    </div>
-                </div>
-            `;
-        }).join('');
+        const commands = await pendingStore.sync();
+        view.setRows(commands, '<div class="empty-state">No pending approvals</div>');
     } catch (error) {
         console.error('Error loading pending approvals:', error);
-        const approvalsList = document.getElementById('approvals-list');
-        if (approvalsList) {
-            approvalsList.innerHTML = `<div class="result-box error">Error: ${error.message}</div>`;
-        }
+        view.showMessage(`<div class="result-box error">Error: ${error.message}</div>`);
     }
 }
 
+function renderPendingItem(cmd) {
+    const threshold = cmd.approval_threshold || 1;
+    const approvalCount = cmd.approval_count || 0;
+    const rejectionCount = cmd.rejection_count || 0;
+    const progress = Math.min((approvalCount / threshold) * 100, 100);
+    
+    return `
+        <div class="history-item pending">
+            <div class="item-header">
+                <div class="item-title">${escapeHtml(cmd.command_text)}</div>
+                <span class="status-badge pending">Pending</span>
+            </div>
+            <div class="item-meta">
+                User: ${escapeHtml(cmd.username)} (${cmd.tier || 'junior'})<br>
+                Approvals: ${approvalCount}/${threshold} | Rejections: ${rejectionCount}<br>
+                <div style="background: #e5e7eb; border-radius: 4px; height: 8px; margin: 8px 0;">
+                    <div style="background: #3b82f6; height: 100%; width: ${progress}%; border-radius: 4px; transition: width 0.3s;"></div>
+                </div>
+                Created: ${new Date(cmd.created_at).toLocaleString()}<br>
+                ${cmd.escalation_at ? `Escalation: ${new Date(cmd.escalation_at).toLocaleString()}<br>` : ''}
+            </div>
+            <div style="margin-top: 12px; display: flex; gap: 8px;">
+                <button onclick="approveCommand(${cmd.id})" class="btn btn-primary">Approve</button>
+                <button onclick="rejectCommand(${cmd.id})" class="btn btn-danger">Reject</button>
+            </div>
+        </div>
+    `;
+}
+
 // Approve command
 async function approveCommand(commandId) {
     try {
@@ -0,0 +1,382 @@
+"""Repository layer for users, rules, commands, votes, credits, audit logs and resource versions.
+
+Routes talk to a Storage object instead of issuing SQL. Two backends exist:
+
+    sqlite  - the gateway schema in a WAL-mode SQLite file, audit logs in a second
+              one (storage_sqlite.py)
+    memory  - lock-protected dicts, for benchmarks and tests (storage_memory.py)
+
+Selected with STORAGE_BACKEND (default sqlite). Single lookups return dicts;
+list endpoints get a Table (column names plus row tuples) that the serializer
+encodes without building a dict per row.
+
+Writes that must be atomic go inside ``with storage.transaction():``. Nested
+transactions join the outermost one; an exception rolls everything back.
+"""
+import os
+from datetime import datetime, timezone
+
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sqlite')
+
+# credits is the spendable balance, credits_reserved what pending commands hold;
+# both are materialized from the credit ledger
+USER_COLUMNS = ('id', 'username', 'api_key', 'role', 'tier', 'credits', 'email', 'telegram_chat_id', 'created_at',
+                'updated_at', 'credits_reserved', 'team')
+# Listings never include API keys
+USER_LIST_COLUMNS = ('id', 'username', 'role', 'credits', 'tier', 'email', 'telegram_chat_id', 'created_at',
+                     'updated_at', 'credits_reserved', 'team')
+# scope is 'global', 'team:<name>' or 'tier:<tier>' (see rule_sets.py)
+RULE_COLUMNS = ('id', 'pattern', 'action', 'description', 'approval_threshold', 'time_start', 'time_end',
+                'timezone', 'created_at', 'created_by', 'scope')
+COMMAND_COLUMNS = ('id', 'user_id', 'command_text', 'status', 'matched_rule_id', 'credits_deducted',
+                   'execution_output', 'approval_token', 'escalation_at', 'created_at', 'executed_at',
+                   'execution_status', 'exit_code', 'output_hash', 'output_size', 'updated_at')
+# Listings leave output out; finished output is fetched from the blob store
+COMMAND_LIST_COLUMNS = tuple(c for c in COMMAND_COLUMNS if c != 'execution_output')
+# Columns update_command may set
+COMMAND_UPDATE_COLUMNS = ('status', 'credits_deducted', 'execution_output', 'execution_status', 'exit_code',
+                          'executed_at', 'output_hash', 'output_size')
+# Delta sync (?updated_since=): changing any of these sets a row's updated_at, as
+# does a vote on a command. Streaming output alone does not.
+USER_SYNC_COLUMNS = ('username', 'role', 'tier', 'credits', 'email', 'telegram_chat_id', 'credits_reserved', 'team')
+COMMAND_SYNC_COLUMNS = ('status', 'credits_deducted', 'approval_token', 'escalation_at', 'executed_at',
+                        'execution_status', 'exit_code', 'output_hash', 'output_size')
+VOTE_COLUMNS = ('id', 'command_id', 'approver_id', 'vote', 'created_at')
+AUDIT_COLUMNS = ('id', 'user_id', 'action_type', 'details', 'created_at')
+# Append-only credit history. available and reserved are the entry's changes to
+# users.credits and users.credits_reserved:
+#   grant    +n (or -n),  0    initial credits and admin changes
+#   reserve  -n,         +n    held for a command waiting for approval
+#   capture   0,         -n    spent from the command's reservation
+#            -n,          0    or straight from the balance when it had none
+#   release  +n,         -n    reservation returned (command rejected or gone)
+LEDGER_COLUMNS = ('id', 'user_id', 'entry_type', 'available', 'reserved', 'command_id', 'actor_id', 'note',
+                  'created_at')
+# Rule effectiveness counters (rule_profile.py), per rule in evaluation order
+RULE_STATS_COLUMNS = ('id', 'pattern', 'action', 'scope', 'evaluations', 'matches', 'shadowed', 'total_ns', 'max_ns',
+                      'last_match_at', 'since')
+RULE_SHADOW_COLUMNS = ('rule_id', 'shadowed_by', 'samples')
+PENDING_EXTRA_COLUMNS = ('username', 'tier', 'approval_count', 'rejection_count', 'approval_threshold')
+BLOB_COLUMNS = ('hash', 'size', 'encoding', 'data')
+# Analytics rollups, kept current by every command write (see rollup_bucket)
+USAGE_USER_COLUMNS = ('bucket', 'user_id', 'username', 'commands', 'credits')
+USAGE_RULE_COLUMNS = ('rule_id', 'pattern', 'status', 'commands')
+USAGE_TIER_COLUMNS = ('bucket', 'tier', 'commands', 'credits')
+TURNAROUND_COLUMNS = ('bucket', 'outcome', 'decisions', 'total_seconds', 'max_seconds')
+
+
+class IntegrityError(Exception):
+    """A uniqueness or constraint violation, whatever the backend"""
+
+
+class InsufficientCredits(Exception):
+    """A reserve or capture the user's spendable balance does not cover; nothing was changed"""
+
+
+class Table:
+    """Column names plus row tuples, the shape list endpoints serialize from"""
+    __slots__ = ('columns', 'rows')
+
+    def __init__(self, columns, rows):
+        self.columns = list(columns)
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def dicts(self):
+        return [dict(zip(self.columns, row)) for row in self.rows]
+
+
+def timestamp(value=None):
+    """Stored form of a timestamp: datetimes as sqlite3 adapts them, None as CURRENT_TIMESTAMP"""
+    if value is None:
+        return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, datetime):
+        return value.isoformat(' ')
+    return value
+
+
+def change_timestamp():
+    """updated_at for a row changed now: UTC with milliseconds, the format of the SQLite triggers"""
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S.%f')[:23]
+
+
+def audit_database_path(path):
+    """Audit log file for a database: AUDIT_DATABASE_PATH, or <name>_audit.db beside it"""
+    return os.environ.get('AUDIT_DATABASE_PATH') or f'{os.path.splitext(path)[0]}_audit.db'
+
+
+def rollup_bucket(value):
+    """Hour bucket ('YYYY-MM-DD HH:00') of a stored timestamp"""
+    return str(value)[:13] + ':00'
+
+
+class Storage:
+    """Interface every backend implements"""
+
+    name = None
+
+    def init_schema(self):
+        """Create tables and apply migrations; cheap when the schema is already current"""
+        raise NotImplementedError
+
+    def close(self):
+        """Release this process's handles (before forking workers); they reopen on next use"""
+
+    def transaction(self, lock_wait=None):
+        """Context manager for an atomic write; lock_wait(seconds) is told how long the lock took"""
+        raise NotImplementedError
+
+    # Resource versions (conditional GETs)
+    def bump_versions(self, *resources):
+        raise NotImplementedError
+
+    def get_versions(self, resources):
+        """Tuple of versions for resources, or None if versioning is unavailable"""
+        raise NotImplementedError
+
+    # Users
+    def get_user(self, user_id):
+        raise NotImplementedError
+
+    def get_user_by_api_key(self, api_key):
+        raise NotImplementedError
+
+    def list_users(self, updated_since=None):
+        """Table of USER_LIST_COLUMNS; only users changed at or after updated_since when given"""
+        raise NotImplementedError
+
+    def list_admins(self):
+        raise NotImplementedError
+
+    def create_user(self, username, api_key, role, credits=100, tier='junior', email=None, telegram_chat_id=None,
+                    team=None):
+        """Insert a user and return its id; IntegrityError on a duplicate username or key"""
+        raise NotImplementedError
+
+    def create_users(self, rows):
+        """Insert many users atomically; rows are (username, api_key, role, credits, tier, email, telegram_chat_id,
+        team)"""
+        raise NotImplementedError
+
+    def user_ids_by_username(self, usernames):
+        """{username: id} for those of usernames that exist"""
+        raise NotImplementedError
+
+    def existing_user_ids(self, user_ids):
+        """The subset of user_ids that exist"""
+        raise NotImplementedError
+
+    def update_credits(self, changes, add=False, actor_id=None):
+        """Apply (user_id, amount) pairs atomically: set credits to amount, or add it when add is true.
+        Each change is a grant in the credit ledger."""
+        raise NotImplementedError
+
+    def update_user(self, user_id, fields, actor_id=None):
+        """Set the given columns (credits, tier, email, telegram_chat_id, team); a credits change is a ledger grant"""
+        raise NotImplementedError
+
+    def delete_user(self, user_id):
+        """Delete a user and their commands (and outputs no other command shares);
+        their audit rows are kept with user_id NULL"""
+        raise NotImplementedError
+
+    # Rules
+    def list_rules(self, scope=None):
+        """Table of all rules, or those of one scope, in evaluation (id) order"""
+        raise NotImplementedError
+
+    def create_rule(self, pattern, action, description='', approval_threshold=1, time_start=None,
+                    time_end=None, timezone='UTC', created_by=None, scope='global'):
+        raise NotImplementedError
+
+    def create_rules(self, rows):
+        """Append many rules in order; rows are (pattern, action, description, approval_threshold,
+        time_start, time_end, timezone, created_by, scope)"""
+        raise NotImplementedError
+
+    def update_rules(self, rows):
+        """Rewrite many rules in place; rows are (rule_id, action, description, approval_threshold,
+        time_start, time_end, timezone)"""
+        raise NotImplementedError
+
+    def delete_all_rules(self):
+        raise NotImplementedError
+
+    def get_rule(self, rule_id):
+        raise NotImplementedError
+
+    def delete_rule(self, rule_id):
+        raise NotImplementedError
+
+    # Rule effectiveness
+    def add_rule_stats(self, rows, shadows):
+        """Add one worker's counts since its last flush. rows are (rule_id, evaluations, matches, shadowed,
+        total_ns, max_ns, last_match_at); shadows are (rule_id, shadowed_by, samples)"""
+        raise NotImplementedError
+
+    def rule_stats(self):
+        """Table of RULE_STATS_COLUMNS for every rule in evaluation order, zeros where nothing was counted"""
+        raise NotImplementedError
+
+    def rule_shadows(self):
+        """Table of RULE_SHADOW_COLUMNS"""
+        raise NotImplementedError
+
+    def reset_rule_stats(self):
+        raise NotImplementedError
+
+    # Commands
+    def get_command(self, command_id):
+        raise NotImplementedError
+
+    def find_command_by_token(self, approval_token, status):
+        raise NotImplementedError
+
+    def create_command(self, user_id, command_text, status, matched_rule_id=None, credits_deducted=0,
+                       execution_output=None, approval_token=None, escalation_at=None, executed_at=None,
+                       created_at=None, execution_status=None, output_hash=None, output_size=None):
+        raise NotImplementedError
+
+    def mark_executed(self, command_id, credits_deducted, execution_output, executed_at):
+        raise NotImplementedError
+
+    def update_command(self, command_id, fields):
+        """Set the given columns (any of COMMAND_UPDATE_COLUMNS)"""
+        raise NotImplementedError
+
+    def set_command_status(self, command_id, status):
+        raise NotImplementedError
+
+    def set_escalation(self, command_id, escalation_at):
+        raise NotImplementedError
+
+    def due_escalations(self, now):
+        """Pending commands whose escalation time has passed"""
+        raise NotImplementedError
+
+    def list_commands(self, user_id=None, limit=100, since_id=None, updated_since=None):
+        """Table of COMMAND_LIST_COLUMNS for the newest commands; all users (with username) when user_id is None.
+
+        since_id keeps only commands with a larger id, updated_since only those
+        changed at or after it (updated_at >= updated_since).
+        """
+        raise NotImplementedError
+
+    def list_pending(self, default_threshold, updated_since=None):
+        """Table of pending commands (COMMAND_LIST_COLUMNS) with username, tier, vote counts and threshold.
+
+        With updated_since: every command changed since then, in any status, so
+        a client can drop the ones no longer pending.
+        """
+        raise NotImplementedError
+
+    # Output blobs (output_store.py), keyed by content hash
+    def put_blob(self, digest, size, encoding, data):
+        """Store a blob unless one with this hash already exists"""
+        raise NotImplementedError
+
+    def get_blob(self, digest):
+        """Dict of BLOB_COLUMNS, or None"""
+        raise NotImplementedError
+
+    def get_blobs(self, digests):
+        """{hash: blob dict} for those of digests that exist"""
+        raise NotImplementedError
+
+    def blob_stats(self):
+        """{'blobs', 'bytes', 'stored_bytes'}: count, original size and stored (compressed) size"""
+        raise NotImplementedError
+
+    # Execution queue: accepted commands with execution_status 'queued' or 'running'
+    def queued_commands(self, limit):
+        """Oldest queued commands with their owner's tier and role"""
+        raise NotImplementedError
+
+    def running_counts(self):
+        """{user_id: number of running commands}"""
+        raise NotImplementedError
+
+    def count_queued(self):
+        raise NotImplementedError
+
+    def lease_commands(self, owner, command_ids, seconds):
+        """Record owner as running command_ids for the next seconds (by the storage's clock),
+        dropping its leases on any other commands"""
+        raise NotImplementedError
+
+    def interrupt_running(self, now):
+        """Finish running commands whose lease has run out (or that never had one) as
+        'interrupted': their process died. Returns how many."""
+        raise NotImplementedError
+
+    # Analytics rollups. Commands are counted in the hour they were created,
+    # under their current status; approval decisions in the hour they were made.
+    # Ranges are hour buckets with since <= bucket < until; day=True groups by day.
+    def usage_by_user(self, since, until, day=False):
+        """Table of USAGE_USER_COLUMNS: commands and credits per user per bucket"""
+        raise NotImplementedError
+
+    def usage_by_rule(self, since, until):
+        """Table of USAGE_RULE_COLUMNS: commands per matched rule (0 for none) and status"""
+        raise NotImplementedError
+
+    def usage_by_tier(self, since, until, day=False):
+        """Table of USAGE_TIER_COLUMNS: commands and credits per user tier per bucket"""
+        raise NotImplementedError
+
+    def approval_turnaround(self, since, until, day=False):
+        """Table of TURNAROUND_COLUMNS: approval decisions and their time from submission, per bucket"""
+        raise NotImplementedError
+
+    # Votes
+    def cast_vote(self, command_id, approver_id, vote):
+        """Record or change an approver's vote"""
+        raise NotImplementedError
+
+    def count_votes(self, command_id, vote):
+        raise NotImplementedError
+
+    # Credit ledger
+    def reserve_credits(self, user_id, command_id, amount):
+        """Hold amount of the user's credits for a command; returns the new balance or raises InsufficientCredits"""
+        raise NotImplementedError
+
+    def capture_credits(self, user_id, command_id, amount):
+        """Spend amount for a command, from its reservation if it has one, else from the balance.
+        Returns the new balance or raises InsufficientCredits."""
+        raise NotImplementedError
+
+    def release_credits(self, command_id, note=None):
+        """Return what is still reserved for a command to its user; the amount released (0 if none)"""
+        raise NotImplementedError
+
+    def credit_ledger(self, user_id=None, limit=100, since_id=None):
+        """Table of LEDGER_COLUMNS, newest first; one user's entries when user_id is given"""
+        raise NotImplementedError
+
+    def reconcile_credits(self):
+        """Release reservations of commands that are no longer pending or approved, then check every
+        user's balances against the ledger and reset any that drifted. Returns what was changed."""
+        raise NotImplementedError
+
+    # Audit
+    def add_audit(self, user_id, action_type, details, created_at=None):
+        raise NotImplementedError
+
+    def list_audit_logs(self, limit=200, since_id=None):
+        """Newest audit rows with the acting username; only ids above since_id when given"""
+        raise NotImplementedError
+
+
+def create_storage(backend=None, path=None):
+    """Storage for the configured backend ('sqlite' or 'memory')"""
+    backend = backend or STORAGE_BACKEND
+    if backend == 'sqlite':
+        from storage_sqlite import SQLiteStorage
+        return SQLiteStorage(path or os.environ.get('DATABASE_PATH', 'command_gateway.db'))
+    if backend == 'memory':
+        from storage_memory import MemoryStorage
+        return MemoryStorage()
+    raise ValueError(f'Unknown storage backend: {backend}')
@@ -0,0 +1,634 @@
+import heapq
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+from storage import (AUDIT_COLUMNS, BLOB_COLUMNS, COMMAND_COLUMNS, COMMAND_LIST_COLUMNS, COMMAND_SYNC_COLUMNS,
+                     COMMAND_UPDATE_COLUMNS, LEDGER_COLUMNS, PENDING_EXTRA_COLUMNS, RULE_COLUMNS, RULE_SHADOW_COLUMNS,
+                     RULE_STATS_COLUMNS, TURNAROUND_COLUMNS, USAGE_RULE_COLUMNS, USAGE_TIER_COLUMNS, USAGE_USER_COLUMNS, USER_COLUMNS, USER_LIST_COLUMNS,
+                     USER_SYNC_COLUMNS, VOTE_COLUMNS, InsufficientCredits, IntegrityError, Storage, Table,
+                     change_timestamp, rollup_bucket, timestamp)
+
+# Changing any of these moves a row's updated_at, like the SQLite touch_* triggers
+_SYNC_COLUMNS = {'users': set(USER_SYNC_COLUMNS), 'commands': set(COMMAND_SYNC_COLUMNS)}
+
+
+class MemoryStorage(Storage):
+    """All data in process memory behind one re-entrant lock.
+
+    Meant for benchmarks and tests: it has the same semantics as the SQLite
+    backend (ordering, joins, defaults) with no I/O, so comparing the two
+    separates application overhead from storage cost. Data is per process.
+    A transaction holds the lock throughout and keeps an undo log, so an
+    exception restores everything it changed.
+    """
+
+    name = 'memory'
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._undo = []
+        self._tables = {'users': {}, 'rules': {}, 'commands': {}, 'approval_votes': {}, 'audit_logs': {},
+                        'credit_ledger': {}}
+        self._next_id = {name: 1 for name in self._tables}
+        self._api_keys = {}
+        self._usernames = {}
+        self._votes = {}  # command_id -> {approver_id: vote id}
+        self._versions = {}
+        self._blobs = {}  # hash -> blob dict
+        self._leases = {}  # command_id -> (owner, expires_at)
+        self._held = {}  # (command_id, user_id) -> credits still reserved, when not 0
+        self._rule_stats = {}  # rule_id -> [evaluations, matches, shadowed, total_ns, max_ns, last_match_at, since]
+        self._rule_shadows = {}  # (rule_id, shadowed_by) -> samples
+        # Analytics rollups, maintained on every command write like the SQLite triggers
+        self._command_rollups = {}  # (bucket, user_id, rule_id, status) -> [commands, credits]
+        self._approval_rollups = {}  # (bucket, outcome) -> [decisions, total_seconds, max_seconds]
+
+    def init_schema(self):
+        pass
+
+    @contextmanager
+    def transaction(self, lock_wait=None):
+        start = time.monotonic()
+        with self._lock:
+            if self._depth:
+                self._depth += 1
+                try:
+                    yield self
+                finally:
+                    self._depth -= 1
+                return
+
+            if lock_wait:
+                lock_wait(time.monotonic() - start)
+            self._depth = 1
+            self._undo = []
+            try:
+                yield self
+            except BaseException:
+                for undo in reversed(self._undo):
+                    undo()
+                raise
+            finally:
+                self._depth = 0
+                self._undo = []
+
+    def _record(self, undo):
+        if self._depth:
+            self._undo.append(undo)
+
+    def _insert(self, table, columns, values):
+        record_id = self._next_id[table]
+        self._next_id[table] += 1
+        record = dict(zip(columns, (record_id,) + tuple(values)))
+        rows = self._tables[table]
+        rows[record_id] = record
+        self._record(lambda: rows.pop(record_id, None))
+        if table == 'commands':
+            self._roll_command(record, 1)
+        return record
+
+    def _update(self, table, record_id, fields):
+        record = self._tables[table].get(record_id)
+        if record is None:
+            return
+        if _SYNC_COLUMNS.get(table, set()).intersection(fields):
+            fields = dict(fields, updated_at=change_timestamp())
+        before = dict(record)
+        previous = {k: record[k] for k in fields}
+        record.update(fields)
+        self._record(lambda: record.update(previous))
+        if table == 'commands' and (before['status'], before['credits_deducted']) != (record['status'], record['credits_deducted']):
+            self._roll_command(before, -1)
+            self._roll_command(record, 1)
+            if before['status'] == 'pending' and record['status'] in ('approved', 'rejected'):
+                self._roll_decision(before, record['status'])
+
+    def _delete(self, table, record_id):
+        rows = self._tables[table]
+        record = rows.pop(record_id, None)
+        if record is not None:
+            self._record(lambda: rows.__setitem__(record_id, record))
+            if table == 'commands':
+                self._roll_command(record, -1)
+        return record
+
+    def _roll_command(self, command, sign):
+        key = (rollup_bucket(command['created_at']), command['user_id'], command['matched_rule_id'] or 0, command['status'])
+        counts = self._command_rollups.setdefault(key, [0, 0])
+        previous = list(counts)
+        counts[0] += sign
+        counts[1] += sign * (command['credits_deducted'] or 0)
+        self._record(lambda: counts.__setitem__(slice(None), previous))
+
+    def _roll_decision(self, command, outcome):
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        seconds = max(0.0, (now - datetime.fromisoformat(str(command['created_at']))).total_seconds())
+        totals = self._approval_rollups.setdefault((now.strftime('%Y-%m-%d %H:00'), outcome), [0, 0.0, 0.0])
+        previous = list(totals)
+        totals[0] += 1
+        totals[1] += seconds
+        totals[2] = max(totals[2], seconds)
+        self._record(lambda: totals.__setitem__(slice(None), previous))
+
+    # Resource versions
+    def bump_versions(self, *resources):
+        with self._lock:
+            for resource in resources:
+                previous = self._versions.get(resource, 0)
+                self._versions[resource] = previous + 1
+                self._record(lambda resource=resource, previous=previous: self._versions.__setitem__(resource, previous))
+
+    def get_versions(self, resources):
+        with self._lock:
+            return tuple(self._versions.get(resource, 0) for resource in resources)
+
+    # Users
+    def get_user(self, user_id):
+        with self._lock:
+            user = self._tables['users'].get(user_id)
+            return dict(user) if user else None
+
+    def get_user_by_api_key(self, api_key):
+        with self._lock:
+            return self.get_user(self._api_keys.get(api_key))
+
+    def list_users(self, updated_since=None):
+        with self._lock:
+            return Table(USER_LIST_COLUMNS, [tuple(u[c] for c in USER_LIST_COLUMNS)
+                                             for u in self._tables['users'].values()
+                                             if updated_since is None or u['updated_at'] >= updated_since])
+
+    def list_admins(self):
+        with self._lock:
+            return [dict(u) for u in self._tables['users'].values() if u['role'] == 'admin']
+
+    def create_user(self, username, api_key, role, credits=100, tier='junior', email=None, telegram_chat_id=None,
+                    team=None):
+        with self._lock:
+            if username in self._usernames:
+                raise IntegrityError('UNIQUE constraint failed: users.username')
+            if api_key in self._api_keys:
+                raise IntegrityError('UNIQUE constraint failed: users.api_key')
+            user = self._insert('users', USER_COLUMNS, (username, api_key, role, tier, credits, email,
+                                                        telegram_chat_id, timestamp(), change_timestamp(), 0,
+                                                        team))
+            self._post(user['id'], 'grant', credits, 0, note='initial credits')
+            self._usernames[username] = user['id']
+            self._api_keys[api_key] = user['id']
+            self._record(lambda: (self._usernames.pop(username, None), self._api_keys.pop(api_key, None)))
+            return user['id']
+
+    def create_users(self, rows):
+        with self.transaction():
+            for row in rows:
+                self.create_user(*row)
+
+    def user_ids_by_username(self, usernames):
+        with self._lock:
+            return {name: self._usernames[name] for name in usernames if name in self._usernames}
+
+    def existing_user_ids(self, user_ids):
+        with self._lock:
+            return {user_id for user_id in user_ids if user_id in self._tables['users']}
+
+    def update_credits(self, changes, add=False, actor_id=None):
+        with self.transaction():
+            users = self._tables['users']
+            for user_id, amount in changes:
+                if user_id not in users:
+                    continue
+                current = users[user_id]['credits']
+                if add:
+                    self._post(user_id, 'grant', amount, 0, actor_id=actor_id, note=f'added {amount}')
+                elif current != amount:
+                    self._post(user_id, 'grant', amount - current, 0, actor_id=actor_id, note=f'set to {amount}')
+                self._update('users', user_id, {'credits': current + amount if add else amount})
+
+    def update_user(self, user_id, fields, actor_id=None):
+        with self.transaction():
+            if 'credits' in fields:
+                self.update_credits([(user_id, fields['credits'])], actor_id=actor_id)
+            self._update('users', user_id, {c: fields[c] for c in ('tier', 'email', 'telegram_chat_id', 'team')
+                                            if c in fields})
+
+    def delete_user(self, user_id):
+        with self.transaction():
+            for command in list(self._tables['commands'].values()):
+                if command['user_id'] == user_id:
+                    self._delete('commands', command['id'])
+            for log in self._tables['audit_logs'].values():
+                if log['user_id'] == user_id:
+                    self._update('audit_logs', log['id'], {'user_id': None})
+            user = self._delete('users', user_id)
+            if user:
+                self._usernames.pop(user['username'], None)
+                self._api_keys.pop(user['api_key'], None)
+                self._record(lambda: (self._usernames.__setitem__(user['username'], user_id),
+                                      self._api_keys.__setitem__(user['api_key'], user_id)))
+            referenced = {c['output_hash'] for c in self._tables['commands'].values()}
+            for digest in [d for d in self._blobs if d not in referenced]:
+                blob = self._blobs.pop(digest)
+                self._record(lambda digest=digest, blob=blob: self._blobs.__setitem__(digest, blob))
+
+    # Rules
+    def list_rules(self, scope=None):
+        with self._lock:
+            return Table(RULE_COLUMNS, [tuple(r[c] for c in RULE_COLUMNS) for r in self._tables['rules'].values()
+                                        if scope is None or r['scope'] == scope])
+
+    def create_rule(self, pattern, action, description='', approval_threshold=1, time_start=None,
+                    time_end=None, timezone='UTC', created_by=None, scope='global'):
+        with self._lock:
+            return self._insert('rules', RULE_COLUMNS, (pattern, action, description, approval_threshold, time_start,
+                                                        time_end, timezone, timestamp(), created_by, scope))['id']
+
+    def create_rules(self, rows):
+        with self.transaction():
+            for row in rows:
+                self.create_rule(*row)
+
+    def update_rules(self, rows):
+        with self.transaction():
+            for rule_id, *values in rows:
+                self._update('rules', rule_id, dict(zip(RULE_COLUMNS[2:8], values)))
+
+    def delete_all_rules(self):
+        with self._lock:
+            for rule_id in list(self._tables['rules']):
+                self._delete('rules', rule_id)
+
+    def get_rule(self, rule_id):
+        with self._lock:
+            rule = self._tables['rules'].get(rule_id)
+            return dict(rule) if rule else None
+
+    def delete_rule(self, rule_id):
+        with self._lock:
+            self._delete('rules', rule_id)
+
+    # Rule effectiveness
+    def add_rule_stats(self, rows, shadows):
+        with self._lock:
+            for rule_id, evaluations, matches, shadowed, total_ns, max_ns, last_match_at in rows:
+                stats = self._rule_stats.setdefault(rule_id, [0, 0, 0, 0, 0, None, timestamp()])
+                stats[0] += evaluations
+                stats[1] += matches
+                stats[2] += shadowed
+                stats[3] += total_ns
+                stats[4] = max(stats[4], max_ns)
+                if last_match_at is not None and (stats[5] is None or last_match_at > stats[5]):
+                    stats[5] = last_match_at
+            for rule_id, shadowed_by, samples in shadows:
+                self._rule_shadows[(rule_id, shadowed_by)] = self._rule_shadows.get((rule_id, shadowed_by), 0) + samples
+
+    def rule_stats(self):
+        with self._lock:
+            empty = [0, 0, 0, 0, 0, None, None]
+            return Table(RULE_STATS_COLUMNS, [(rule['id'], rule['pattern'], rule['action'], rule['scope'],
+                                               *self._rule_stats.get(rule['id'], empty))
+                                              for rule in self._tables['rules'].values()])
+
+    def rule_shadows(self):
+        with self._lock:
+            return Table(RULE_SHADOW_COLUMNS, [(rule_id, shadowed_by, samples) for (rule_id, shadowed_by), samples
+                                               in sorted(self._rule_shadows.items())])
+
+    def reset_rule_stats(self):
+        with self._lock:
+            self._rule_stats.clear()
+            self._rule_shadows.clear()
+
+    # Commands
+    def get_command(self, command_id):
+        with self._lock:
+            command = self._tables['commands'].get(command_id)
+            return dict(command) if command else None
+
+    def find_command_by_token(self, approval_token, status):
+        with self._lock:
+            for command in self._tables['commands'].values():
+                if command['approval_token'] == approval_token and command['status'] == status:
+                    return dict(command)
+            return None
+
+    def create_command(self, user_id, command_text, status, matched_rule_id=None, credits_deducted=0,
+                       execution_output=None, approval_token=None, escalation_at=None, executed_at=None,
+                       created_at=None, execution_status=None, output_hash=None, output_size=None):
+        with self._lock:
+            return self._insert('commands', COMMAND_COLUMNS, (
+                user_id, command_text, status, matched_rule_id, credits_deducted, execution_output, approval_token,
+                timestamp(escalation_at) if escalation_at else None,
+                timestamp(created_at),
+                timestamp(executed_at) if executed_at else None,
+                execution_status, None, output_hash, output_size, change_timestamp(),
+            ))['id']
+
+    def mark_executed(self, command_id, credits_deducted, execution_output, executed_at):
+        with self._lock:
+            self._update('commands', command_id, {'status': 'executed', 'credits_deducted': credits_deducted,
+                                                  'execution_output': execution_output,
+                                                  'executed_at': timestamp(executed_at)})
+
+    def update_command(self, command_id, fields):
+        with self._lock:
+            self._update('commands', command_id, {c: timestamp(fields[c]) if c == 'executed_at' else fields[c]
+                                                  for c in COMMAND_UPDATE_COLUMNS if c in fields})
+
+    def set_command_status(self, command_id, status):
+        with self._lock:
+            self._update('commands', command_id, {'status': status})
+
+    def set_escalation(self, command_id, escalation_at):
+        with self._lock:
+            self._update('commands', command_id, {'escalation_at': timestamp(escalation_at)})
+
+    def due_escalations(self, now):
+        now = timestamp(now)
+        with self._lock:
+            return [dict(c) for c in self._tables['commands'].values()
+                    if c['status'] == 'pending' and c['escalation_at'] is not None and c['escalation_at'] <= now]
+
+    def _newest(self, records, limit):
+        # Stable like SQLite's sort: equal timestamps stay in id order
+        return heapq.nlargest(limit, records, key=lambda r: r['created_at'])
+
+    def _changed(self, command, since_id, updated_since):
+        if since_id is not None and command['id'] <= since_id:
+            return False
+        return updated_since is None or command['updated_at'] >= updated_since
+
+    def list_commands(self, user_id=None, limit=100, since_id=None, updated_since=None):
+        if updated_since is not None:
+            since_id = None
+        with self._lock:
+            users = self._tables['users']
+            if user_id is None:
+                commands = self._newest([c for c in self._tables['commands'].values()
+                                         if c['user_id'] in users and self._changed(c, since_id, updated_since)], limit)
+                return Table(COMMAND_LIST_COLUMNS + ('username',),
+                             [tuple(c[k] for k in COMMAND_LIST_COLUMNS) + (users[c['user_id']]['username'],)
+                              for c in commands])
+            commands = self._newest([c for c in self._tables['commands'].values()
+                                     if c['user_id'] == user_id and self._changed(c, since_id, updated_since)], limit)
+            return Table(COMMAND_LIST_COLUMNS, [tuple(c[k] for k in COMMAND_LIST_COLUMNS) for c in commands])
+
+    def list_pending(self, default_threshold, updated_since=None):
+        with self._lock:
+            users = self._tables['users']
+            rules = self._tables['rules']
+            if updated_since is None:
+                pending = [c for c in self._tables['commands'].values()
+                           if c['status'] == 'pending' and c['user_id'] in users]
+            else:
+                pending = [c for c in self._tables['commands'].values()
+                           if c['updated_at'] >= updated_since and c['user_id'] in users]
+            rows = []
+            for c in self._newest(pending, len(pending)):
+                user = users[c['user_id']]
+                votes = [self._tables['approval_votes'][v]['vote'] for v in self._votes.get(c['id'], {}).values()]
+                rule = rules.get(c['matched_rule_id'])
+                threshold = rule['approval_threshold'] if rule and rule['approval_threshold'] is not None else default_threshold
+                rows.append(tuple(c[k] for k in COMMAND_LIST_COLUMNS) + (
+                    user['username'], user['tier'], votes.count('approve'), votes.count('reject'), threshold))
+            return Table(COMMAND_LIST_COLUMNS + PENDING_EXTRA_COLUMNS, rows)
+
+    # Execution queue
+    def queued_commands(self, limit):
+        with self._lock:
+            users = self._tables['users']
+            queued = [c for c in self._tables['commands'].values()
+                      if c['execution_status'] == 'queued' and c['user_id'] in users]
+            return [dict(c, tier=users[c['user_id']]['tier'], role=users[c['user_id']]['role'])
+                    for c in queued[:limit]]
+
+    def running_counts(self):
+        with self._lock:
+            counts = {}
+            for c in self._tables['commands'].values():
+                if c['execution_status'] == 'running':
+                    counts[c['user_id']] = counts.get(c['user_id'], 0) + 1
+            return counts
+
+    def count_queued(self):
+        with self._lock:
+            return sum(1 for c in self._tables['commands'].values() if c['execution_status'] == 'queued')
+
+    def lease_commands(self, owner, command_ids, seconds):
+        expires_at = (datetime.now(timezone.utc) + timedelta(seconds=seconds)).strftime('%Y-%m-%d %H:%M:%S.%f')[:23]
+        with self._lock:
+            before = dict(self._leases)
+            command_ids = set(command_ids)
+            for command_id, (holder, _) in list(self._leases.items()):
+                if holder == owner and command_id not in command_ids:
+                    del self._leases[command_id]
+            self._leases.update((command_id, (owner, expires_at)) for command_id in command_ids)
+            self._record(lambda: (self._leases.clear(), self._leases.update(before)))
+
+    def interrupt_running(self, now):
+        current = change_timestamp()
+        with self._lock:
+            running = [c['id'] for c in self._tables['commands'].values() if c['execution_status'] == 'running'
+                       and self._leases.get(c['id'], (None, ''))[1] < current]
+            for command_id in running:
+                self._update('commands', command_id, {'status': 'executed', 'execution_status': 'interrupted',
+                                                      'executed_at': timestamp(now)})
+            for command_id in list(self._leases):
+                if self._tables['commands'].get(command_id, {}).get('execution_status') != 'running':
+                    del self._leases[command_id]
+            return len(running)
+
+    # Output blobs
+    def put_blob(self, digest, size, encoding, data):
+        with self._lock:
+            if digest in self._blobs:
+                return
+            self._blobs[digest] = dict(zip(BLOB_COLUMNS, (digest, size, encoding, bytes(data))))
+            self._record(lambda: self._blobs.pop(digest, None))
+
+    def get_blob(self, digest):
+        with self._lock:
+            blob = self._blobs.get(digest)
+            return dict(blob) if blob else None
+
+    def get_blobs(self, digests):
+        with self._lock:
+            return {digest: dict(self._blobs[digest]) for digest in digests if digest in self._blobs}
+
+    def blob_stats(self):
+        with self._lock:
+            return {'blobs': len(self._blobs), 'bytes': sum(b['size'] for b in self._blobs.values()),
+                    'stored_bytes': sum(len(b['data']) for b in self._blobs.values())}
+
+    # Analytics rollups
+    def _sum_rollups(self, rollups, since, until, group):
+        """{group(key): summed values} over rollup entries with since <= bucket < until"""
+        sums = {}
+        for key, values in rollups.items():
+            if since <= key[0] < until:
+                group_key = group(key)
+                if group_key is None:
+                    continue
+                totals = sums.setdefault(group_key, [0] * len(values))
+                for i, value in enumerate(values):
+                    totals[i] += value
+        return sums
+
+    def usage_by_user(self, since, until, day=False):
+        with self._lock:
+            users = self._tables['users']
+            sums = self._sum_rollups(self._command_rollups, since, until,
+                                     lambda key: (key[0][:10] if day else key[0], key[1]))
+            return Table(USAGE_USER_COLUMNS, [
+                (bucket, user_id, (users.get(user_id) or {}).get('username'), commands, credits)
+                for (bucket, user_id), (commands, credits) in sorted(sums.items()) if commands > 0
+            ])
+
+    def usage_by_rule(self, since, until):
+        with self._lock:
+            rules = self._tables['rules']
+            sums = self._sum_rollups(self._command_rollups, since, until, lambda key: (key[2], key[3]))
+            return Table(USAGE_RULE_COLUMNS, [
+                (rule_id, (rules.get(rule_id) or {}).get('pattern'), status, commands)
+                for (rule_id, status), (commands, _) in sorted(sums.items()) if commands > 0
+            ])
+
+    def usage_by_tier(self, since, until, day=False):
+        with self._lock:
+            users = self._tables['users']
+            sums = self._sum_rollups(
+                self._command_rollups, since, until,
+                lambda key: (key[0][:10] if day else key[0], users[key[1]]['tier']) if key[1] in users else None
+            )
+            return Table(USAGE_TIER_COLUMNS, [(bucket, tier, commands, credits)
+                                              for (bucket, tier), (commands, credits) in sorted(sums.items())
+                                              if commands > 0])
+
+    def approval_turnaround(self, since, until, day=False):
+        with self._lock:
+            rows = []
+            for key in sorted({(b[:10] if day else b, outcome) for b, outcome in self._approval_rollups}):
+                entries = [v for (b, outcome), v in self._approval_rollups.items()
+                           if since <= b < until and ((b[:10] if day else b), outcome) == key]
+                if entries:
+                    rows.append(key + (sum(v[0] for v in entries), sum(v[1] for v in entries),
+                                       max(v[2] for v in entries)))
+            return Table(TURNAROUND_COLUMNS, rows)
+
+    # Votes
+    def cast_vote(self, command_id, approver_id, vote):
+        with self._lock:
+            by_approver = self._votes.setdefault(command_id, {})
+            vote_id = by_approver.get(approver_id)
+            self._touch_command(command_id)
+            if vote_id is not None:
+                self._update('approval_votes', vote_id, {'vote': vote, 'created_at': timestamp()})
+                return
+            record = self._insert('approval_votes', VOTE_COLUMNS, (command_id, approver_id, vote, timestamp()))
+            by_approver[approver_id] = record['id']
+            self._record(lambda: by_approver.pop(approver_id, None))
+
+    def _touch_command(self, command_id):
+        command = self._tables['commands'].get(command_id)
+        if command is not None:
+            previous = command['updated_at']
+            command['updated_at'] = change_timestamp()
+            self._record(lambda: command.update(updated_at=previous))
+
+    def count_votes(self, command_id, vote):
+        with self._lock:
+            votes = self._tables['approval_votes']
+            return sum(1 for v in self._votes.get(command_id, {}).values() if votes[v]['vote'] == vote)
+
+    # Credit ledger
+    def _post(self, user_id, entry_type, available, reserved, command_id=None, actor_id=None, note=None):
+        self._insert('credit_ledger', LEDGER_COLUMNS,
+                     (user_id, entry_type, available, reserved, command_id, actor_id, note, timestamp()))
+        if command_id is not None and reserved:
+            key = (command_id, user_id)
+            previous = self._held.get(key, 0)
+            if previous + reserved:
+                self._held[key] = previous + reserved
+            else:
+                del self._held[key]
+            self._record(lambda: self._held.__setitem__(key, previous) if previous else self._held.pop(key, None))
+
+    def _spend(self, user_id, command_id, entry_type, available, reserved):
+        user = self._tables['users'].get(user_id)
+        if user is None or (available < 0 and user['credits'] + available < 0):
+            raise InsufficientCredits(f'User {user_id} has fewer than {-available} credits')
+        self._update('users', user_id, {'credits': user['credits'] + available,
+                                        'credits_reserved': user['credits_reserved'] + reserved})
+        self._post(user_id, entry_type, available, reserved, command_id)
+        return user['credits']
+
+    def _release(self, command_id, user_id, amount, note):
+        user = self._tables['users'][user_id]
+        self._update('users', user_id, {'credits': user['credits'] + amount,
+                                        'credits_reserved': user['credits_reserved'] - amount})
+        self._post(user_id, 'release', amount, -amount, command_id, note=note)
+
+    def reserve_credits(self, user_id, command_id, amount):
+        with self.transaction():
+            return self._spend(user_id, command_id, 'reserve', -amount, amount)
+
+    def capture_credits(self, user_id, command_id, amount):
+        with self.transaction():
+            held = self._held.get((command_id, user_id), 0) if command_id else 0
+            from_reservation = max(0, min(held, amount))
+            return self._spend(user_id, command_id, 'capture', from_reservation - amount, -from_reservation)
+
+    def release_credits(self, command_id, note=None):
+        released = 0
+        with self.transaction():
+            for (held_command, user_id), amount in sorted(self._held.items()):
+                if held_command == command_id and amount > 0 and user_id in self._tables['users']:
+                    self._release(command_id, user_id, amount, note)
+                    released += amount
+        return released
+
+    def credit_ledger(self, user_id=None, limit=100, since_id=None):
+        with self._lock:
+            entries = heapq.nlargest(limit, (e for e in self._tables['credit_ledger'].values()
+                                             if (user_id is None or e['user_id'] == user_id)
+                                             and e['id'] > (since_id or 0)), key=lambda e: e['id'])
+            return Table(LEDGER_COLUMNS, [tuple(e[c] for c in LEDGER_COLUMNS) for e in entries])
+
+    def reconcile_credits(self):
+        released, drift = [], []
+        with self.transaction():
+            users, commands = self._tables['users'], self._tables['commands']
+            for (command_id, user_id), amount in sorted(self._held.items()):
+                command = commands.get(command_id)
+                if amount > 0 and user_id in users and (command is None or command['status'] not in ('pending', 'approved')):
+                    self._release(command_id, user_id, amount, 'reconciliation')
+                    released.append({'command_id': command_id, 'user_id': user_id, 'amount': amount})
+            sums = {}
+            for entry in self._tables['credit_ledger'].values():
+                totals = sums.setdefault(entry['user_id'], [0, 0])
+                totals[0] += entry['available']
+                totals[1] += entry['reserved']
+            for user_id in sorted(users):
+                user = users[user_id]
+                ledger_credits, ledger_reserved = sums.get(user_id, (0, 0))
+                if (user['credits'], user['credits_reserved']) != (ledger_credits, ledger_reserved):
+                    drift.append({'user_id': user_id, 'credits': user['credits'], 'ledger_credits': ledger_credits,
+                                  'reserved': user['credits_reserved'], 'ledger_reserved': ledger_reserved})
+                    self._update('users', user_id, {'credits': ledger_credits, 'credits_reserved': ledger_reserved})
+        return {'released': released, 'drift': drift}
+
+    # Audit
+    def add_audit(self, user_id, action_type, details, created_at=None):
+        with self._lock:
+            self._insert('audit_logs', AUDIT_COLUMNS, (user_id, action_type, details, timestamp(created_at)))
+
+    def list_audit_logs(self, limit=200, since_id=None):
+        with self._lock:
+            users = self._tables['users']
+            logs = self._newest([log for log in self._tables['audit_logs'].values()
+                                 if since_id is None or log['id'] > since_id], limit)
+            return Table(AUDIT_COLUMNS + ('username',),
+                         [tuple(log[k] for k in AUDIT_COLUMNS) + ((users.get(log['user_id']) or {}).get('username'),)
+                          for log in logs])
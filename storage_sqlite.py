@@ -0,0 +1,991 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from output_store import pack
+from storage import (COMMAND_LIST_COLUMNS, COMMAND_SYNC_COLUMNS, COMMAND_UPDATE_COLUMNS, LEDGER_COLUMNS,
+                     USER_LIST_COLUMNS, USER_SYNC_COLUMNS, InsufficientCredits, IntegrityError, Storage, Table,
+                     audit_database_path, timestamp)
+
+# Rollup maintenance shared by the command triggers; {row} is NEW or OLD
+_ROLLUP_ADD = '''INSERT INTO command_rollups (bucket, user_id, rule_id, status, commands, credits)
+           VALUES (substr({row}.created_at, 1, 13) || ':00', {row}.user_id, COALESCE({row}.matched_rule_id, 0), {row}.status,
+                   1, COALESCE({row}.credits_deducted, 0))
+           ON CONFLICT(bucket, user_id, rule_id, status) DO UPDATE SET
+               commands = commands + 1, credits = credits + excluded.credits'''
+_ROLLUP_REMOVE = '''UPDATE command_rollups SET commands = commands - 1, credits = credits - COALESCE({row}.credits_deducted, 0)
+           WHERE bucket = substr({row}.created_at, 1, 13) || ':00' AND user_id = {row}.user_id
+             AND rule_id = COALESCE({row}.matched_rule_id, 0) AND status = {row}.status'''
+
+# updated_at values, the format of storage.change_timestamp()
+_NOW_MS = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+
+SCHEMA = [
+    # Users table
+    '''CREATE TABLE IF NOT EXISTS users
+       (id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE NOT NULL,
+        api_key TEXT UNIQUE NOT NULL,
+        role TEXT NOT NULL CHECK(role IN ('admin', 'member')),
+        tier TEXT DEFAULT 'junior' CHECK(tier IN ('junior', 'mid', 'senior', 'lead')),
+        credits INTEGER DEFAULT 100,
+        email TEXT,
+        telegram_chat_id TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TEXT,
+        credits_reserved INTEGER NOT NULL DEFAULT 0,
+        team TEXT)''',
+    # Rules table
+    '''CREATE TABLE IF NOT EXISTS rules
+       (id INTEGER PRIMARY KEY AUTOINCREMENT,
+        pattern TEXT NOT NULL,
+        action TEXT NOT NULL CHECK(action IN ('AUTO_ACCEPT', 'AUTO_REJECT', 'REQUIRE_APPROVAL')),
+        description TEXT,
+        approval_threshold INTEGER DEFAULT 1,
+        time_start TEXT,
+        time_end TEXT,
+        timezone TEXT DEFAULT 'UTC',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        created_by INTEGER,
+        scope TEXT NOT NULL DEFAULT 'global',
+        FOREIGN KEY(created_by) REFERENCES users(id))''',
+    # Commands table
+    '''CREATE TABLE IF NOT EXISTS commands
+       (id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        command_text TEXT NOT NULL,
+        status TEXT NOT NULL CHECK(status IN ('pending', 'accepted', 'rejected', 'executed', 'approved')),
+        matched_rule_id INTEGER,
+        credits_deducted INTEGER DEFAULT 0,
+        execution_output TEXT,
+        approval_token TEXT,
+        escalation_at TIMESTAMP,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        executed_at TIMESTAMP,
+        execution_status TEXT,
+        exit_code INTEGER,
+        output_hash TEXT,
+        output_size INTEGER,
+        updated_at TEXT,
+        FOREIGN KEY(user_id) REFERENCES users(id),
+        FOREIGN KEY(matched_rule_id) REFERENCES rules(id))''',
+    # Executors poll for queued commands
+    'CREATE INDEX IF NOT EXISTS idx_commands_execution ON commands(execution_status)',
+    # The process running each running command, until expires_at unless it renews (executor.py)
+    '''CREATE TABLE IF NOT EXISTS execution_leases
+       (command_id INTEGER PRIMARY KEY,
+        owner TEXT NOT NULL,
+        expires_at TEXT NOT NULL)''',
+    # Finished command output, compressed and shared by content hash (output_store.py)
+    '''CREATE TABLE IF NOT EXISTS output_blobs
+       (hash TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        encoding TEXT NOT NULL,
+        data BLOB NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+    # Approval votes table
+    '''CREATE TABLE IF NOT EXISTS approval_votes
+       (id INTEGER PRIMARY KEY AUTOINCREMENT,
+        command_id INTEGER NOT NULL,
+        approver_id INTEGER NOT NULL,
+        vote TEXT NOT NULL CHECK(vote IN ('approve', 'reject')),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY(command_id) REFERENCES commands(id),
+        FOREIGN KEY(approver_id) REFERENCES users(id),
+        UNIQUE(command_id, approver_id))''',
+    # Audit log table of databases from before the audit file; its rows are
+    # moved to AUDIT_SCHEMA's table on migration
+    '''CREATE TABLE IF NOT EXISTS audit_logs
+       (id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        action_type TEXT NOT NULL,
+        details TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY(user_id) REFERENCES users(id))''',
+    # Analytics rollups (storage.py), maintained by the triggers below inside
+    # every command write; rule_id 0 stands for "no rule matched"
+    '''CREATE TABLE IF NOT EXISTS command_rollups
+       (bucket TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        rule_id INTEGER NOT NULL,
+        status TEXT NOT NULL,
+        commands INTEGER NOT NULL DEFAULT 0,
+        credits INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (bucket, user_id, rule_id, status)) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS approval_rollups
+       (bucket TEXT NOT NULL,
+        outcome TEXT NOT NULL,
+        decisions INTEGER NOT NULL DEFAULT 0,
+        total_seconds REAL NOT NULL DEFAULT 0,
+        max_seconds REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (bucket, outcome)) WITHOUT ROWID''',
+    f'''CREATE TRIGGER IF NOT EXISTS rollup_command_insert AFTER INSERT ON commands
+       BEGIN
+           {_ROLLUP_ADD.format(row='NEW')};
+       END''',
+    f'''CREATE TRIGGER IF NOT EXISTS rollup_command_update AFTER UPDATE OF status, credits_deducted ON commands
+       WHEN OLD.status IS NOT NEW.status OR OLD.credits_deducted IS NOT NEW.credits_deducted
+       BEGIN
+           {_ROLLUP_REMOVE.format(row='OLD')};
+           {_ROLLUP_ADD.format(row='NEW')};
+       END''',
+    f'''CREATE TRIGGER IF NOT EXISTS rollup_command_delete AFTER DELETE ON commands
+       BEGIN
+           {_ROLLUP_REMOVE.format(row='OLD')};
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS rollup_approval_decision AFTER UPDATE OF status ON commands
+       WHEN OLD.status = 'pending' AND NEW.status IN ('approved', 'rejected')
+       BEGIN
+           INSERT INTO approval_rollups (bucket, outcome, decisions, total_seconds, max_seconds)
+           VALUES (strftime('%Y-%m-%d %H:00', 'now'), NEW.status, 1,
+                   MAX(0, (julianday('now') - julianday(OLD.created_at)) * 86400),
+                   MAX(0, (julianday('now') - julianday(OLD.created_at)) * 86400))
+           ON CONFLICT(bucket, outcome) DO UPDATE SET
+               decisions = decisions + 1,
+               total_seconds = total_seconds + excluded.total_seconds,
+               max_seconds = MAX(max_seconds, excluded.max_seconds);
+       END''',
+    # Credit ledger (storage.LEDGER_COLUMNS). Kept after a user is deleted, so
+    # no foreign key; users.credits and credits_reserved are its running sums
+    '''CREATE TABLE IF NOT EXISTS credit_ledger
+       (id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        entry_type TEXT NOT NULL CHECK(entry_type IN ('grant', 'reserve', 'capture', 'release')),
+        available INTEGER NOT NULL,
+        reserved INTEGER NOT NULL,
+        command_id INTEGER,
+        actor_id INTEGER,
+        note TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+    'CREATE INDEX IF NOT EXISTS idx_credit_ledger_user ON credit_ledger(user_id, id)',
+    'CREATE INDEX IF NOT EXISTS idx_credit_ledger_command ON credit_ledger(command_id) WHERE command_id IS NOT NULL',
+    '''CREATE TRIGGER IF NOT EXISTS credit_ledger_no_update BEFORE UPDATE ON credit_ledger
+       BEGIN
+           SELECT RAISE(ABORT, 'credit_ledger is append-only');
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS credit_ledger_no_delete BEFORE DELETE ON credit_ledger
+       BEGIN
+           SELECT RAISE(ABORT, 'credit_ledger is append-only');
+       END''',
+    # Rule effectiveness counters, added to by every worker (rule_profile.py).
+    # No foreign keys: stats of deleted rules are simply never reported
+    '''CREATE TABLE IF NOT EXISTS rule_stats
+       (rule_id INTEGER PRIMARY KEY,
+        evaluations INTEGER NOT NULL DEFAULT 0,
+        matches INTEGER NOT NULL DEFAULT 0,
+        shadowed INTEGER NOT NULL DEFAULT 0,
+        total_ns INTEGER NOT NULL DEFAULT 0,
+        max_ns INTEGER NOT NULL DEFAULT 0,
+        last_match_at TEXT,
+        since TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+    '''CREATE TABLE IF NOT EXISTS rule_shadows
+       (rule_id INTEGER NOT NULL,
+        shadowed_by INTEGER NOT NULL,
+        samples INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (rule_id, shadowed_by)) WITHOUT ROWID''',
+    # Resource versions for conditional GETs, bumped on every mutation
+    '''CREATE TABLE IF NOT EXISTS resource_versions
+       (resource TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0)''',
+]
+
+# The audit file (storage.audit_database_path). Audit rows have their own
+# file, and so their own write lock: audit inserts never wait for, or hold up,
+# credit, command and vote writes. No foreign key: users live in the main file.
+AUDIT_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS audit_logs
+       (id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        action_type TEXT NOT NULL,
+        details TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+    'CREATE INDEX IF NOT EXISTS idx_audit_logs_created ON audit_logs(created_at)',
+]
+
+# Columns added to existing databases after the first release
+# (table, column, definition); new tables only need an entry in SCHEMA
+MIGRATIONS = [
+    ('users', 'tier', "TEXT DEFAULT 'junior' CHECK(tier IN ('junior', 'mid', 'senior', 'lead'))"),
+    ('users', 'email', 'TEXT'),
+    ('users', 'telegram_chat_id', 'TEXT'),
+    ('commands', 'execution_status', 'TEXT'),
+    ('commands', 'exit_code', 'INTEGER'),
+    ('commands', 'output_hash', 'TEXT'),
+    ('commands', 'output_size', 'INTEGER'),
+    ('users', 'updated_at', 'TEXT'),
+    ('commands', 'updated_at', 'TEXT'),
+    ('users', 'credits_reserved', 'INTEGER NOT NULL DEFAULT 0'),
+    ('users', 'team', 'TEXT'),
+    ('rules', 'scope', "TEXT NOT NULL DEFAULT 'global'"),
+]
+
+# Indexes and triggers on migrated columns, created after MIGRATIONS
+SCHEMA_AFTER_MIGRATIONS = [
+    'CREATE INDEX IF NOT EXISTS idx_commands_updated ON commands(updated_at)',
+    # One scope's rules, in order, for its compiled matcher
+    'CREATE INDEX IF NOT EXISTS idx_rules_scope ON rules(scope, id)',
+    # Delta sync: storage.USER_SYNC_COLUMNS / COMMAND_SYNC_COLUMNS changes, and votes, move updated_at.
+    # Recreated so a changed column list takes effect
+    'DROP TRIGGER IF EXISTS touch_user',
+    f'''CREATE TRIGGER IF NOT EXISTS touch_user AFTER UPDATE OF {", ".join(USER_SYNC_COLUMNS)} ON users
+        BEGIN
+            UPDATE users SET updated_at = {_NOW_MS} WHERE id = NEW.id;
+        END''',
+    f'''CREATE TRIGGER IF NOT EXISTS touch_command AFTER UPDATE OF {", ".join(COMMAND_SYNC_COLUMNS)} ON commands
+        BEGIN
+            UPDATE commands SET updated_at = {_NOW_MS} WHERE id = NEW.id;
+        END''',
+    f'''CREATE TRIGGER IF NOT EXISTS touch_command_vote AFTER INSERT ON approval_votes
+        BEGIN
+            UPDATE commands SET updated_at = {_NOW_MS} WHERE id = NEW.command_id;
+        END''',
+    f'''CREATE TRIGGER IF NOT EXISTS touch_command_revote AFTER UPDATE OF vote ON approval_votes
+        BEGIN
+            UPDATE commands SET updated_at = {_NOW_MS} WHERE id = NEW.command_id;
+        END''',
+]
+
+# Stored in PRAGMA user_version once SCHEMA and MIGRATIONS are applied; bump it
+# whenever either changes so existing databases pick the change up
+SCHEMA_VERSION = 10
+
+# Statements are fixed strings so each connection's statement cache keeps
+# them prepared across requests
+SQL_GET_USER = 'SELECT * FROM users WHERE id = ?'
+SQL_GET_USER_BY_KEY = 'SELECT * FROM users WHERE api_key = ?'
+SQL_LIST_USERS = f'SELECT {", ".join(USER_LIST_COLUMNS)} FROM users'
+SQL_LIST_USERS_CHANGED = SQL_LIST_USERS + ' WHERE updated_at >= ?'
+SQL_LIST_ADMINS = "SELECT * FROM users WHERE role = 'admin' ORDER BY id"
+SQL_INSERT_USER = f'''INSERT INTO users (username, api_key, role, credits, tier, email, telegram_chat_id, team, updated_at)
+                      VALUES (?, ?, ?, ?, ?, ?, ?, ?, {_NOW_MS})'''
+SQL_USER_IDS_BY_USERNAME = 'SELECT username, id FROM users WHERE username IN (SELECT value FROM json_each(?))'
+SQL_EXISTING_USER_IDS = 'SELECT id FROM users WHERE id IN (SELECT value FROM json_each(?))'
+SQL_SET_CREDITS = 'UPDATE users SET credits = ? WHERE id = ?'
+SQL_ADD_CREDITS = 'UPDATE users SET credits = credits + ? WHERE id = ?'
+# Credit ledger. Every entry and the matching balance change share a transaction
+SQL_INSERT_LEDGER = '''INSERT INTO credit_ledger (user_id, entry_type, available, reserved, command_id, actor_id, note)
+                       VALUES (?, ?, ?, ?, ?, ?, ?)'''
+SQL_GRANT_NEW_USER = '''INSERT INTO credit_ledger (user_id, entry_type, available, reserved, note)
+                        SELECT id, 'grant', credits, 0, 'initial credits' FROM users WHERE username = ?'''
+# (amount, actor_id, note, user_id, amount): the difference to a new balance, if any
+SQL_GRANT_SET = '''INSERT INTO credit_ledger (user_id, entry_type, available, reserved, actor_id, note)
+                   SELECT id, 'grant', ? - credits, 0, ?, ? FROM users WHERE id = ? AND credits IS NOT ?'''
+SQL_GRANT_ADD = '''INSERT INTO credit_ledger (user_id, entry_type, available, reserved, actor_id, note)
+                   SELECT id, 'grant', ?, 0, ?, ? FROM users WHERE id = ?'''
+# (available, reserved, user_id, available, available): the entry's changes, applied only
+# if they take nothing from the balance or leave it >= 0
+SQL_SPEND_CREDITS = '''UPDATE users SET credits = credits + ?, credits_reserved = credits_reserved + ?
+                       WHERE id = ? AND (? >= 0 OR credits + ? >= 0)'''
+SQL_RELEASE_CREDITS = 'UPDATE users SET credits = credits + ?, credits_reserved = credits_reserved - ? WHERE id = ?'
+SQL_USER_CREDITS = 'SELECT credits FROM users WHERE id = ?'
+SQL_OPEN_RESERVATION = 'SELECT COALESCE(SUM(reserved), 0) FROM credit_ledger WHERE command_id = ? AND user_id = ?'
+SQL_OPEN_RESERVATIONS = '''SELECT user_id, SUM(reserved) FROM credit_ledger WHERE command_id = ?
+                           GROUP BY user_id HAVING SUM(reserved) > 0'''
+_LEDGER_SELECT = ', '.join(LEDGER_COLUMNS)
+SQL_LEDGER_ALL = f'SELECT {_LEDGER_SELECT} FROM credit_ledger WHERE id > ? ORDER BY id DESC LIMIT ?'
+SQL_LEDGER_USER = f'SELECT {_LEDGER_SELECT} FROM credit_ledger WHERE user_id = ? AND id > ? ORDER BY id DESC LIMIT ?'
+# Users from before the ledger open it with their balance
+SQL_OPEN_LEDGER = '''INSERT INTO credit_ledger (user_id, entry_type, available, reserved, note)
+                     SELECT id, 'grant', COALESCE(credits, 0), 0, 'opening balance' FROM users u
+                     WHERE NOT EXISTS (SELECT 1 FROM credit_ledger l WHERE l.user_id = u.id)'''
+# Reconciliation: reservations whose command was decided without a release, or deleted
+SQL_STALE_RESERVATIONS = '''SELECT l.command_id, l.user_id, SUM(l.reserved) FROM credit_ledger l
+                            JOIN users u ON u.id = l.user_id
+                            WHERE l.command_id IS NOT NULL AND NOT EXISTS
+                                (SELECT 1 FROM commands c WHERE c.id = l.command_id AND c.status IN ('pending', 'approved'))
+                            GROUP BY l.command_id, l.user_id HAVING SUM(l.reserved) > 0 ORDER BY l.command_id'''
+SQL_LEDGER_DRIFT = '''SELECT u.id, u.credits, u.credits_reserved, COALESCE(l.available, 0), COALESCE(l.reserved, 0)
+                      FROM users u LEFT JOIN (SELECT user_id, SUM(available) AS available, SUM(reserved) AS reserved
+                                              FROM credit_ledger GROUP BY user_id) l ON l.user_id = u.id
+                      WHERE u.credits IS NOT COALESCE(l.available, 0)
+                         OR u.credits_reserved IS NOT COALESCE(l.reserved, 0)
+                      ORDER BY u.id'''
+SQL_RESET_BALANCES = 'UPDATE users SET credits = ?, credits_reserved = ? WHERE id = ?'
+SQL_DELETE_USER_COMMANDS = 'DELETE FROM commands WHERE user_id = ?'
+SQL_DELETE_USER = 'DELETE FROM users WHERE id = ?'
+
+SQL_LIST_RULES = 'SELECT * FROM rules ORDER BY id'
+SQL_LIST_SCOPE_RULES = 'SELECT * FROM rules WHERE scope = ? ORDER BY id'
+SQL_GET_RULE = 'SELECT * FROM rules WHERE id = ?'
+SQL_INSERT_RULE = '''INSERT INTO rules (pattern, action, description, approval_threshold, time_start, time_end, timezone, created_by,
+                                        scope)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+SQL_DELETE_RULE = 'DELETE FROM rules WHERE id = ?'
+SQL_UPDATE_RULE = '''UPDATE rules SET action = ?, description = ?, approval_threshold = ?, time_start = ?, time_end = ?,
+                     timezone = ? WHERE id = ?'''
+SQL_DELETE_ALL_RULES = 'DELETE FROM rules'
+
+# MAX() of a NULL is NULL, hence the COALESCE for last_match_at
+SQL_ADD_RULE_STATS = '''INSERT INTO rule_stats (rule_id, evaluations, matches, shadowed, total_ns, max_ns, last_match_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                        ON CONFLICT(rule_id) DO UPDATE SET
+                            evaluations = evaluations + excluded.evaluations,
+                            matches = matches + excluded.matches,
+                            shadowed = shadowed + excluded.shadowed,
+                            total_ns = total_ns + excluded.total_ns,
+                            max_ns = MAX(max_ns, excluded.max_ns),
+                            last_match_at = COALESCE(MAX(last_match_at, excluded.last_match_at),
+                                                     last_match_at, excluded.last_match_at)'''
+SQL_ADD_RULE_SHADOWS = '''INSERT INTO rule_shadows (rule_id, shadowed_by, samples) VALUES (?, ?, ?)
+                          ON CONFLICT(rule_id, shadowed_by) DO UPDATE SET samples = samples + excluded.samples'''
+SQL_RULE_STATS = '''SELECT r.id, r.pattern, r.action, r.scope, COALESCE(s.evaluations, 0) AS evaluations,
+                         COALESCE(s.matches, 0) AS matches, COALESCE(s.shadowed, 0) AS shadowed,
+                         COALESCE(s.total_ns, 0) AS total_ns, COALESCE(s.max_ns, 0) AS max_ns,
+                         s.last_match_at, s.since
+                  FROM rules r LEFT JOIN rule_stats s ON s.rule_id = r.id ORDER BY r.id'''
+SQL_RULE_SHADOWS = 'SELECT rule_id, shadowed_by, samples FROM rule_shadows ORDER BY rule_id, shadowed_by'
+SQL_RESET_RULE_STATS = 'DELETE FROM rule_stats'
+SQL_RESET_RULE_SHADOWS = 'DELETE FROM rule_shadows'
+
+SQL_GET_COMMAND = 'SELECT * FROM commands WHERE id = ?'
+SQL_COMMAND_BY_TOKEN = 'SELECT * FROM commands WHERE approval_token = ? AND status = ?'
+SQL_INSERT_COMMAND = f'''INSERT INTO commands (user_id, command_text, status, matched_rule_id, credits_deducted, execution_output,
+                                               approval_token, escalation_at, executed_at, created_at, execution_status,
+                                               output_hash, output_size, updated_at)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), ?, ?, ?, {_NOW_MS})'''
+SQL_MARK_EXECUTED = 'UPDATE commands SET status = ?, credits_deducted = ?, execution_output = ?, executed_at = ? WHERE id = ?'
+SQL_SET_STATUS = 'UPDATE commands SET status = ? WHERE id = ?'
+SQL_SET_ESCALATION = 'UPDATE commands SET escalation_at = ? WHERE id = ?'
+SQL_DUE_ESCALATIONS = 'SELECT * FROM commands WHERE status = ? AND escalation_at IS NOT NULL AND escalation_at <= ?'
+# Listings name their columns so execution_output is never read
+_COMMAND_LIST_SELECT = ', '.join('c.' + c for c in COMMAND_LIST_COLUMNS)
+SQL_LIST_COMMANDS_ALL = f'''SELECT {_COMMAND_LIST_SELECT}, u.username FROM commands c JOIN users u ON c.user_id = u.id
+                            ORDER BY c.created_at DESC LIMIT ?'''
+SQL_LIST_COMMANDS_USER = f'SELECT {_COMMAND_LIST_SELECT} FROM commands c WHERE c.user_id = ? ORDER BY c.created_at DESC LIMIT ?'
+# Deltas: (since_id, limit) and (updated_since, limit), after the user id for the _USER forms.
+# Ties are broken by id explicitly, since the updated_at index changes scan order
+SQL_COMMANDS_SINCE_ID_ALL = f'''SELECT {_COMMAND_LIST_SELECT}, u.username FROM commands c JOIN users u ON c.user_id = u.id
+                                WHERE c.id > ? ORDER BY c.created_at DESC, c.id LIMIT ?'''
+SQL_COMMANDS_SINCE_ID_USER = f'''SELECT {_COMMAND_LIST_SELECT} FROM commands c WHERE c.user_id = ? AND c.id > ?
+                                 ORDER BY c.created_at DESC, c.id LIMIT ?'''
+SQL_COMMANDS_CHANGED_ALL = f'''SELECT {_COMMAND_LIST_SELECT}, u.username FROM commands c JOIN users u ON c.user_id = u.id
+                               WHERE c.updated_at >= ? ORDER BY c.created_at DESC, c.id LIMIT ?'''
+SQL_COMMANDS_CHANGED_USER = f'''SELECT {_COMMAND_LIST_SELECT} FROM commands c WHERE c.user_id = ? AND c.updated_at >= ?
+                                ORDER BY c.created_at DESC, c.id LIMIT ?'''
+_PENDING_SELECT = f'''SELECT {_COMMAND_LIST_SELECT}, u.username, u.tier,
+                      (SELECT COUNT(*) FROM approval_votes WHERE command_id = c.id AND vote = 'approve') as approval_count,
+                      (SELECT COUNT(*) FROM approval_votes WHERE command_id = c.id AND vote = 'reject') as rejection_count,
+                      COALESCE(r.approval_threshold, ?) as approval_threshold
+                      FROM commands c
+                      JOIN users u ON c.user_id = u.id
+                      LEFT JOIN rules r ON c.matched_rule_id = r.id'''
+SQL_LIST_PENDING = _PENDING_SELECT + " WHERE c.status = 'pending' ORDER BY c.created_at DESC"
+SQL_PENDING_CHANGED = _PENDING_SELECT + ' WHERE c.updated_at >= ? ORDER BY c.created_at DESC, c.id'
+
+SQL_QUEUED_COMMANDS = '''SELECT c.*, u.tier, u.role FROM commands c JOIN users u ON c.user_id = u.id
+                         WHERE c.execution_status = 'queued' ORDER BY c.id LIMIT ?'''
+SQL_RUNNING_COUNTS = "SELECT user_id, COUNT(*) FROM commands WHERE execution_status = 'running' GROUP BY user_id"
+SQL_COUNT_QUEUED = "SELECT COUNT(*) FROM commands WHERE execution_status = 'queued'"
+# Lease times are UTC by the database's clock, in the format of change_timestamp()
+SQL_DROP_LEASES = 'DELETE FROM execution_leases WHERE owner = ? AND command_id NOT IN (SELECT value FROM json_each(?))'
+SQL_RENEW_LEASES = '''INSERT INTO execution_leases (command_id, owner, expires_at)
+                      SELECT value, ?, strftime('%Y-%m-%d %H:%M:%f', 'now', ?) FROM json_each(?) WHERE true
+                      ON CONFLICT(command_id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at'''
+SQL_INTERRUPT_RUNNING = """UPDATE commands SET status = 'executed', execution_status = 'interrupted', executed_at = ?
+                           WHERE execution_status = 'running' AND id NOT IN
+                               (SELECT command_id FROM execution_leases
+                                WHERE expires_at >= strftime('%Y-%m-%d %H:%M:%f', 'now'))"""
+SQL_DELETE_FINISHED_LEASES = """DELETE FROM execution_leases
+                                WHERE command_id NOT IN (SELECT id FROM commands WHERE execution_status = 'running')"""
+
+SQL_INSERT_BLOB = 'INSERT INTO output_blobs (hash, size, encoding, data) VALUES (?, ?, ?, ?) ON CONFLICT(hash) DO NOTHING'
+SQL_GET_BLOB = 'SELECT hash, size, encoding, data FROM output_blobs WHERE hash = ?'
+SQL_GET_BLOBS = 'SELECT hash, size, encoding, data FROM output_blobs WHERE hash IN (SELECT value FROM json_each(?))'
+SQL_BLOB_STATS = 'SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(LENGTH(data)), 0) FROM output_blobs'
+SQL_DELETE_ORPHAN_BLOBS = '''DELETE FROM output_blobs
+                             WHERE hash NOT IN (SELECT output_hash FROM commands WHERE output_hash IS NOT NULL)'''
+SQL_INLINE_OUTPUTS = """SELECT id, execution_output FROM commands WHERE execution_output IS NOT NULL
+                        AND COALESCE(execution_status, '') NOT IN ('queued', 'running')"""
+SQL_MOVE_OUTPUT = 'UPDATE commands SET output_hash = ?, output_size = ?, execution_output = NULL WHERE id = ?'
+
+SQL_REBUILD_COMMAND_ROLLUPS = '''INSERT INTO command_rollups (bucket, user_id, rule_id, status, commands, credits)
+                                 SELECT substr(created_at, 1, 13) || ':00', user_id, COALESCE(matched_rule_id, 0), status,
+                                        COUNT(*), COALESCE(SUM(credits_deducted), 0)
+                                 FROM commands GROUP BY 1, 2, 3, 4'''
+# Earlier decisions are dated by their last vote
+SQL_REBUILD_APPROVAL_ROLLUPS = '''INSERT INTO approval_rollups (bucket, outcome, decisions, total_seconds, max_seconds)
+                                  SELECT substr(decided_at, 1, 13) || ':00', outcome, COUNT(*), SUM(seconds), MAX(seconds)
+                                  FROM (SELECT MAX(v.created_at) AS decided_at,
+                                               CASE WHEN c.status = 'rejected' THEN 'rejected' ELSE 'approved' END AS outcome,
+                                               MAX(0, (julianday(MAX(v.created_at)) - julianday(c.created_at)) * 86400) AS seconds
+                                        FROM commands c JOIN approval_votes v ON v.command_id = c.id
+                                        WHERE c.status != 'pending' GROUP BY c.id)
+                                  GROUP BY 1, 2'''
+_BUCKET = "CASE WHEN ? THEN substr(r.bucket, 1, 10) ELSE r.bucket END"
+SQL_USAGE_BY_USER = f'''SELECT {_BUCKET} AS bucket, r.user_id, u.username, SUM(r.commands) AS commands, SUM(r.credits) AS credits
+                        FROM command_rollups r LEFT JOIN users u ON u.id = r.user_id
+                        WHERE r.bucket >= ? AND r.bucket < ?
+                        GROUP BY 1, r.user_id HAVING SUM(r.commands) > 0 ORDER BY 1, r.user_id'''
+SQL_USAGE_BY_RULE = '''SELECT r.rule_id, ru.pattern, r.status, SUM(r.commands) AS commands
+                        FROM command_rollups r LEFT JOIN rules ru ON ru.id = r.rule_id
+                        WHERE r.bucket >= ? AND r.bucket < ?
+                        GROUP BY r.rule_id, r.status HAVING SUM(r.commands) > 0 ORDER BY r.rule_id, r.status'''
+SQL_USAGE_BY_TIER = f'''SELECT {_BUCKET} AS bucket, u.tier, SUM(r.commands) AS commands, SUM(r.credits) AS credits
+                        FROM command_rollups r JOIN users u ON u.id = r.user_id
+                        WHERE r.bucket >= ? AND r.bucket < ?
+                        GROUP BY 1, u.tier HAVING SUM(r.commands) > 0 ORDER BY 1, u.tier'''
+SQL_APPROVAL_TURNAROUND = f'''SELECT {_BUCKET} AS bucket, r.outcome, SUM(r.decisions) AS decisions,
+                              SUM(r.total_seconds) AS total_seconds, MAX(r.max_seconds) AS max_seconds
+                              FROM approval_rollups r
+                              WHERE r.bucket >= ? AND r.bucket < ?
+                              GROUP BY 1, r.outcome ORDER BY 1, r.outcome'''
+
+SQL_UPSERT_VOTE = '''INSERT INTO approval_votes (command_id, approver_id, vote) VALUES (?, ?, ?)
+                     ON CONFLICT(command_id, approver_id) DO UPDATE SET vote = excluded.vote, created_at = CURRENT_TIMESTAMP'''
+SQL_COUNT_VOTES = 'SELECT COUNT(*) FROM approval_votes WHERE command_id = ? AND vote = ?'
+
+# Run on the audit file's connection, which has the main file attached as gateway
+SQL_INSERT_AUDIT = 'INSERT INTO audit_logs (user_id, action_type, details, created_at) VALUES (?, ?, ?, ?)'
+SQL_DETACH_USER_AUDIT = 'UPDATE audit_logs SET user_id = NULL WHERE user_id = ?'
+SQL_LIST_AUDIT = '''SELECT a.*, u.username FROM audit_logs a LEFT JOIN gateway.users u ON a.user_id = u.id
+                    ORDER BY a.created_at DESC, a.id LIMIT ?'''
+SQL_LIST_AUDIT_SINCE = '''SELECT a.*, u.username FROM audit_logs a LEFT JOIN gateway.users u ON a.user_id = u.id
+                          WHERE a.id > ? ORDER BY a.created_at DESC, a.id LIMIT ?'''
+SQL_COPY_LEGACY_AUDIT = '''INSERT INTO audit_logs (id, user_id, action_type, details, created_at)
+                           SELECT id, user_id, action_type, details, created_at FROM gateway.audit_logs
+                           WHERE id > (SELECT COALESCE(MAX(id), 0) FROM audit_logs) AND id <= ? ORDER BY id'''
+
+SQL_BUMP_VERSION = '''INSERT INTO resource_versions (resource, version) VALUES (?, 1)
+                      ON CONFLICT(resource) DO UPDATE SET version = version + 1'''
+SQL_ALL_VERSIONS = 'SELECT resource, version FROM resource_versions'
+
+
+# Connections opened before a fork. SQLite handles must not cross fork, and
+# closing one in the child could disturb the parent's locks, so they are only
+# kept referenced here.
+_inherited = []
+
+
+def _new_database_settings(conn):
+    """Settings fixed when a database file is created: incremental auto-vacuum, for maintenance.py"""
+    # Setting it on an existing file needs the write lock, and changes nothing anyway
+    if conn.execute('PRAGMA page_count').fetchone()[0] == 0:
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+
+
+class SQLiteStorage(Storage):
+    """The gateway schema in one SQLite file, and audit logs in a second one.
+
+    Each thread keeps one connection (reopened after fork) in WAL mode so
+    readers never block the writer, and sqlite3's per-connection statement
+    cache keeps the SQL above prepared. Connections run in autocommit mode;
+    transaction() issues BEGIN IMMEDIATE / COMMIT explicitly.
+
+    Audit rows are written through a second per-thread connection to the
+    audit file, never inside the main file's write transaction. Durability
+    order: an audit row added inside transaction() is held until that
+    transaction commits, then written (and dropped if it rolls back). So the
+    audit log never records a change that did not happen; a crash between the
+    two commits can lose the audit rows of the last committed transaction.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path, audit_path=None):
+        self.path = path
+        self.audit_path = audit_path or audit_database_path(path)
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            if conn is not None:
+                # Inherited across fork: never use or close it here
+                _inherited.append(conn)
+                if self._local.audit_conn is not None:
+                    _inherited.append(self._local.audit_conn)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, cached_statements=256)
+            _new_database_settings(conn)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')  # Durable at checkpoints; safe in WAL mode
+            conn.execute('PRAGMA temp_store=MEMORY')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+            self._local.depth = 0
+            self._local.audit_conn = None
+            self._local.pending_audit = []
+            self._local.versions = None  # (data_version, {resource: version}) last read
+        return conn
+
+    def _audit_conn(self):
+        self._conn()  # Resets the thread's state after a fork
+        conn = self._local.audit_conn
+        if conn is None:
+            conn = sqlite3.connect(self.audit_path, timeout=30, isolation_level=None, cached_statements=64)
+            _new_database_settings(conn)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            for statement in AUDIT_SCHEMA:
+                conn.execute(statement)
+            # For the username join only; this connection never writes to it
+            conn.execute('ATTACH DATABASE ? AS gateway', (self.path,))
+            self._local.audit_conn = conn
+        return conn
+
+    def _write_audit(self, statements):
+        """Run (sql, params) pairs in one audit-file transaction (deferred: it locks only that file)"""
+        conn = self._audit_conn()
+        conn.execute('BEGIN')
+        try:
+            for sql, params in statements:
+                conn.execute(sql, params)
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def init_schema(self):
+        conn = self._conn()
+        if self._schema_version(conn) >= SCHEMA_VERSION:
+            return
+        # Before the main transaction: the audit connection only sees what is committed
+        moved_audit_id = self._copy_legacy_audit(conn)
+        with self.transaction():
+            if self._schema_version(conn) >= SCHEMA_VERSION:
+                return  # Another process migrated while we waited for the lock
+            for statement in SCHEMA:
+                conn.execute(statement)
+            for table, column, definition in MIGRATIONS:
+                if column not in {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}:
+                    print(f"[DB] Adding column {table}.{column}")
+                    conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+            # Rows from before updated_at count as changed when they were created
+            for table in ('users', 'commands'):
+                conn.execute(f"UPDATE {table} SET updated_at = strftime('%Y-%m-%d %H:%M:%f', created_at) "
+                             "WHERE updated_at IS NULL")
+            for statement in SCHEMA_AFTER_MIGRATIONS:
+                conn.execute(statement)
+            conn.execute(SQL_OPEN_LEDGER)
+            self._move_inline_outputs(conn)
+            self._rebuild_rollups(conn)
+            conn.execute('DELETE FROM audit_logs WHERE id <= ?', (moved_audit_id,))
+            conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+    def _move_inline_outputs(self, conn):
+        # Outputs of commands finished before the blob store existed
+        moved = 0
+        cursor = conn.execute(SQL_INLINE_OUTPUTS)
+        while True:
+            rows = cursor.fetchmany(500)
+            if not rows:
+                break
+            for command_id, output in rows:
+                digest, size, encoding, data = pack(output)
+                conn.execute(SQL_INSERT_BLOB, (digest, size, encoding, data))
+                conn.execute(SQL_MOVE_OUTPUT, (digest, size, command_id))
+            moved += len(rows)
+        if moved:
+            print(f"[DB] Moved {moved} command output(s) to the blob store")
+
+    def _rebuild_rollups(self, conn):
+        # The triggers only see writes from now on; count what is already there
+        conn.execute('DELETE FROM command_rollups')
+        conn.execute(SQL_REBUILD_COMMAND_ROLLUPS)
+        conn.execute('DELETE FROM approval_rollups')
+        conn.execute(SQL_REBUILD_APPROVAL_ROLLUPS)
+
+    def _copy_legacy_audit(self, conn):
+        # Audit rows written before the audit file existed. Copied (only ids not
+        # there yet, so an interrupted move is simply repeated), then deleted from
+        # the main file by init_schema; returns the last id copied
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'audit_logs'").fetchone() is None:
+            return 0
+        last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM audit_logs').fetchone()[0]
+        copied = self._audit_conn().execute(SQL_COPY_LEGACY_AUDIT, (last_id,)).rowcount
+        if copied:
+            print(f"[DB] Moved {copied} audit log row(s) to {self.audit_path}")
+        return last_id
+
+    def _schema_version(self, conn):
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            conn.close()
+            if self._local.audit_conn is not None:
+                self._local.audit_conn.close()
+        self._local.conn = None
+
+    @contextmanager
+    def transaction(self, lock_wait=None):
+        conn = self._conn()
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield self
+            finally:
+                self._local.depth -= 1
+            return
+
+        start = time.monotonic()
+        conn.execute('BEGIN IMMEDIATE')
+        if lock_wait:
+            lock_wait(time.monotonic() - start)
+        self._local.depth = 1
+        try:
+            yield self
+        except BaseException:
+            self._local.depth = 0
+            self._local.pending_audit = []
+            conn.execute('ROLLBACK')
+            raise
+        self._local.depth = 0
+        conn.execute('COMMIT')
+        self._flush_audit()
+
+    def _flush_audit(self):
+        pending, self._local.pending_audit = self._local.pending_audit, []
+        if not pending:
+            return
+        try:
+            self._write_audit(pending)
+        except sqlite3.Error as e:
+            # The change itself is committed; failing the request now would not undo it
+            print(f"[AUDIT] Could not write {len(pending)} audit row(s): {e}; {pending}")
+
+    def _execute(self, sql, params=()):
+        try:
+            return self._conn().execute(sql, params)
+        except sqlite3.IntegrityError as e:
+            raise IntegrityError(str(e)) from e
+
+    def _one(self, sql, params=()):
+        cursor = self._execute(sql, params)
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([d[0] for d in cursor.description], row))
+
+    def _all(self, sql, params=()):
+        cursor = self._execute(sql, params)
+        rows = cursor.fetchall()
+        return [dict(zip([d[0] for d in cursor.description], row)) for row in rows]
+
+    def _table(self, sql, params=()):
+        cursor = self._execute(sql, params)
+        return Table([d[0] for d in cursor.description], cursor.fetchall())
+
+    # Resource versions
+    def bump_versions(self, *resources):
+        self._local.versions = None
+        try:
+            with self.transaction():
+                for resource in resources:
+                    self._execute(SQL_BUMP_VERSION, (resource,))
+        except sqlite3.OperationalError as e:
+            if 'no such table' not in str(e):
+                raise
+            # Schema not migrated yet; conditional GETs stay disabled
+
+    def get_versions(self, resources):
+        conn = self._conn()
+        # data_version moves only when another connection commits, so this
+        # connection's own bumps drop the snapshot (see bump_versions)
+        data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+        snapshot = self._local.versions
+        if snapshot is None or snapshot[0] != data_version or self._local.depth:
+            try:
+                found = dict(conn.execute(SQL_ALL_VERSIONS).fetchall())
+            except sqlite3.OperationalError as e:
+                if 'no such table' not in str(e):
+                    raise
+                return None
+            # Uncommitted versions inside a transaction are never kept
+            snapshot = None if self._local.depth else (data_version, found)
+            self._local.versions = snapshot
+        else:
+            found = snapshot[1]
+        return tuple(found.get(resource, 0) for resource in resources)
+
+    # Users
+    def get_user(self, user_id):
+        return self._one(SQL_GET_USER, (user_id,))
+
+    def get_user_by_api_key(self, api_key):
+        return self._one(SQL_GET_USER_BY_KEY, (api_key,))
+
+    def list_users(self, updated_since=None):
+        if updated_since is not None:
+            return self._table(SQL_LIST_USERS_CHANGED, (updated_since,))
+        return self._table(SQL_LIST_USERS)
+
+    def list_admins(self):
+        return self._all(SQL_LIST_ADMINS)
+
+    def create_user(self, username, api_key, role, credits=100, tier='junior', email=None, telegram_chat_id=None,
+                    team=None):
+        with self.transaction():
+            user_id = self._execute(SQL_INSERT_USER, (username, api_key, role, credits, tier, email,
+                                                      telegram_chat_id, team)).lastrowid
+            self._execute(SQL_INSERT_LEDGER, (user_id, 'grant', credits, 0, None, None, 'initial credits'))
+        return user_id
+
+    def create_users(self, rows):
+        with self.transaction():
+            try:
+                self._conn().executemany(SQL_INSERT_USER, rows)
+            except sqlite3.IntegrityError as e:
+                raise IntegrityError(str(e)) from e
+            self._conn().executemany(SQL_GRANT_NEW_USER, [(row[0],) for row in rows])
+
+    def user_ids_by_username(self, usernames):
+        # One statement whatever the list length: the names travel as a JSON array
+        return dict(self._execute(SQL_USER_IDS_BY_USERNAME, (json.dumps(list(usernames)),)).fetchall())
+
+    def existing_user_ids(self, user_ids):
+        return {row[0] for row in self._execute(SQL_EXISTING_USER_IDS, (json.dumps(list(user_ids)),))}
+
+    def update_credits(self, changes, add=False, actor_id=None):
+        with self.transaction():
+            conn = self._conn()
+            if add:
+                conn.executemany(SQL_GRANT_ADD, [(amount, actor_id, f'added {amount}', user_id)
+                                                 for user_id, amount in changes])
+            else:
+                conn.executemany(SQL_GRANT_SET, [(amount, actor_id, f'set to {amount}', user_id, amount)
+                                                 for user_id, amount in changes])
+            conn.executemany(SQL_ADD_CREDITS if add else SQL_SET_CREDITS,
+                             [(amount, user_id) for user_id, amount in changes])
+
+    def update_user(self, user_id, fields, actor_id=None):
+        columns = [c for c in ('tier', 'email', 'telegram_chat_id', 'team') if c in fields]
+        with self.transaction():
+            if 'credits' in fields:
+                self.update_credits([(user_id, fields['credits'])], actor_id=actor_id)
+            if columns:
+                self._execute(
+                    f'UPDATE users SET {", ".join(c + " = ?" for c in columns)} WHERE id = ?',
+                    tuple(fields[c] for c in columns) + (user_id,)
+                )
+
+    def delete_user(self, user_id):
+        with self.transaction():
+            self._execute(SQL_DELETE_USER_COMMANDS, (user_id,))
+            self._audit(SQL_DETACH_USER_AUDIT, (user_id,))
+            self._execute(SQL_DELETE_USER, (user_id,))
+            self._execute(SQL_DELETE_ORPHAN_BLOBS)
+
+    # Rules
+    def list_rules(self, scope=None):
+        if scope is not None:
+            return self._table(SQL_LIST_SCOPE_RULES, (scope,))
+        return self._table(SQL_LIST_RULES)
+
+    def create_rule(self, pattern, action, description='', approval_threshold=1, time_start=None,
+                    time_end=None, timezone='UTC', created_by=None, scope='global'):
+        return self._execute(SQL_INSERT_RULE, (pattern, action, description, approval_threshold,
+                                               time_start, time_end, timezone, created_by, scope)).lastrowid
+
+    def create_rules(self, rows):
+        with self.transaction():
+            self._conn().executemany(SQL_INSERT_RULE, rows)
+
+    def update_rules(self, rows):
+        with self.transaction():
+            self._conn().executemany(SQL_UPDATE_RULE, [tuple(row[1:]) + (row[0],) for row in rows])
+
+    def delete_all_rules(self):
+        self._execute(SQL_DELETE_ALL_RULES)
+
+    def get_rule(self, rule_id):
+        return self._one(SQL_GET_RULE, (rule_id,))
+
+    def delete_rule(self, rule_id):
+        self._execute(SQL_DELETE_RULE, (rule_id,))
+
+    # Rule effectiveness
+    def add_rule_stats(self, rows, shadows):
+        with self.transaction():
+            self._conn().executemany(SQL_ADD_RULE_STATS, rows)
+            self._conn().executemany(SQL_ADD_RULE_SHADOWS, shadows)
+
+    def rule_stats(self):
+        return self._table(SQL_RULE_STATS)
+
+    def rule_shadows(self):
+        return self._table(SQL_RULE_SHADOWS)
+
+    def reset_rule_stats(self):
+        with self.transaction():
+            self._execute(SQL_RESET_RULE_STATS)
+            self._execute(SQL_RESET_RULE_SHADOWS)
+
+    # Commands
+    def get_command(self, command_id):
+        return self._one(SQL_GET_COMMAND, (command_id,))
+
+    def find_command_by_token(self, approval_token, status):
+        return self._one(SQL_COMMAND_BY_TOKEN, (approval_token, status))
+
+    def create_command(self, user_id, command_text, status, matched_rule_id=None, credits_deducted=0,
+                       execution_output=None, approval_token=None, escalation_at=None, executed_at=None,
+                       created_at=None, execution_status=None, output_hash=None, output_size=None):
+        return self._execute(SQL_INSERT_COMMAND, (
+            user_id, command_text, status, matched_rule_id, credits_deducted, execution_output, approval_token,
+            timestamp(escalation_at) if escalation_at else None,
+            timestamp(executed_at) if executed_at else None,
+            timestamp(created_at) if created_at else None,
+            execution_status, output_hash, output_size,
+        )).lastrowid
+
+    def mark_executed(self, command_id, credits_deducted, execution_output, executed_at):
+        self._execute(SQL_MARK_EXECUTED, ('executed', credits_deducted, execution_output, timestamp(executed_at), command_id))
+
+    def update_command(self, command_id, fields):
+        columns = [c for c in COMMAND_UPDATE_COLUMNS if c in fields]
+        if not columns:
+            return
+        values = [timestamp(fields[c]) if c == 'executed_at' else fields[c] for c in columns]
+        self._execute(f'UPDATE commands SET {", ".join(c + " = ?" for c in columns)} WHERE id = ?',
+                      tuple(values) + (command_id,))
+
+    def set_command_status(self, command_id, status):
+        self._execute(SQL_SET_STATUS, (status, command_id))
+
+    def set_escalation(self, command_id, escalation_at):
+        self._execute(SQL_SET_ESCALATION, (timestamp(escalation_at), command_id))
+
+    def due_escalations(self, now):
+        return self._all(SQL_DUE_ESCALATIONS, ('pending', timestamp(now)))
+
+    def list_commands(self, user_id=None, limit=100, since_id=None, updated_since=None):
+        if updated_since is not None:
+            sql, params = (SQL_COMMANDS_CHANGED_ALL, SQL_COMMANDS_CHANGED_USER), (updated_since, limit)
+        elif since_id is not None:
+            sql, params = (SQL_COMMANDS_SINCE_ID_ALL, SQL_COMMANDS_SINCE_ID_USER), (since_id, limit)
+        else:
+            sql, params = (SQL_LIST_COMMANDS_ALL, SQL_LIST_COMMANDS_USER), (limit,)
+        if user_id is None:
+            return self._table(sql[0], params)
+        return self._table(sql[1], (user_id,) + params)
+
+    def list_pending(self, default_threshold, updated_since=None):
+        if updated_since is not None:
+            return self._table(SQL_PENDING_CHANGED, (default_threshold, updated_since))
+        return self._table(SQL_LIST_PENDING, (default_threshold,))
+
+    # Execution queue
+    def queued_commands(self, limit):
+        return self._all(SQL_QUEUED_COMMANDS, (limit,))
+
+    def running_counts(self):
+        return dict(self._execute(SQL_RUNNING_COUNTS).fetchall())
+
+    def count_queued(self):
+        return self._execute(SQL_COUNT_QUEUED).fetchone()[0]
+
+    def lease_commands(self, owner, command_ids, seconds):
+        ids = json.dumps(list(command_ids))
+        with self.transaction():
+            self._execute(SQL_DROP_LEASES, (owner, ids))
+            self._execute(SQL_RENEW_LEASES, (owner, f'{seconds:+g} seconds', ids))
+
+    def interrupt_running(self, now):
+        with self.transaction():
+            count = self._execute(SQL_INTERRUPT_RUNNING, (timestamp(now),)).rowcount
+            self._execute(SQL_DELETE_FINISHED_LEASES)
+        return count
+
+    # Output blobs
+    def put_blob(self, digest, size, encoding, data):
+        self._execute(SQL_INSERT_BLOB, (digest, size, encoding, data))
+
+    def get_blob(self, digest):
+        return self._one(SQL_GET_BLOB, (digest,))
+
+    def get_blobs(self, digests):
+        return {blob['hash']: blob for blob in self._all(SQL_GET_BLOBS, (json.dumps(list(digests)),))}
+
+    def blob_stats(self):
+        blobs, size, stored = self._execute(SQL_BLOB_STATS).fetchone()
+        return {'blobs': blobs, 'bytes': size, 'stored_bytes': stored}
+
+    # Analytics rollups
+    def usage_by_user(self, since, until, day=False):
+        return self._table(SQL_USAGE_BY_USER, (day, since, until))
+
+    def usage_by_rule(self, since, until):
+        return self._table(SQL_USAGE_BY_RULE, (since, until))
+
+    def usage_by_tier(self, since, until, day=False):
+        return self._table(SQL_USAGE_BY_TIER, (day, since, until))
+
+    def approval_turnaround(self, since, until, day=False):
+        return self._table(SQL_APPROVAL_TURNAROUND, (day, since, until))
+
+    # Votes
+    def cast_vote(self, command_id, approver_id, vote):
+        self._execute(SQL_UPSERT_VOTE, (command_id, approver_id, vote))
+
+    def count_votes(self, command_id, vote):
+        return self._execute(SQL_COUNT_VOTES, (command_id, vote)).fetchone()[0]
+
+    # Credit ledger
+    def _spend(self, user_id, command_id, entry_type, available, reserved):
+        # The balance check is part of the UPDATE, so concurrent spends never act on a stale read
+        if self._execute(SQL_SPEND_CREDITS, (available, reserved, user_id, available, available)).rowcount == 0:
+            raise InsufficientCredits(f'User {user_id} has fewer than {-available} credits')
+        self._execute(SQL_INSERT_LEDGER, (user_id, entry_type, available, reserved, command_id, None, None))
+        return self._execute(SQL_USER_CREDITS, (user_id,)).fetchone()[0]
+
+    def reserve_credits(self, user_id, command_id, amount):
+        with self.transaction():
+            return self._spend(user_id, command_id, 'reserve', -amount, amount)
+
+    def capture_credits(self, user_id, command_id, amount):
+        with self.transaction():
+            held = self._execute(SQL_OPEN_RESERVATION, (command_id, user_id)).fetchone()[0] if command_id else 0
+            from_reservation = max(0, min(held, amount))
+            return self._spend(user_id, command_id, 'capture', from_reservation - amount, -from_reservation)
+
+    def release_credits(self, command_id, note=None):
+        released = 0
+        with self.transaction():
+            for user_id, amount in self._execute(SQL_OPEN_RESERVATIONS, (command_id,)).fetchall():
+                if self._execute(SQL_RELEASE_CREDITS, (amount, amount, user_id)).rowcount:
+                    self._execute(SQL_INSERT_LEDGER, (user_id, 'release', amount, -amount, command_id, None, note))
+                    released += amount
+        return released
+
+    def credit_ledger(self, user_id=None, limit=100, since_id=None):
+        if user_id is None:
+            return self._table(SQL_LEDGER_ALL, (since_id or 0, limit))
+        return self._table(SQL_LEDGER_USER, (user_id, since_id or 0, limit))
+
+    def reconcile_credits(self):
+        released, drift = [], []
+        with self.transaction():
+            for command_id, user_id, amount in self._execute(SQL_STALE_RESERVATIONS).fetchall():
+                self._execute(SQL_RELEASE_CREDITS, (amount, amount, user_id))
+                self._execute(SQL_INSERT_LEDGER, (user_id, 'release', amount, -amount, command_id, None,
+                                                  'reconciliation'))
+                released.append({'command_id': command_id, 'user_id': user_id, 'amount': amount})
+            for user_id, credits, reserved, ledger_credits, ledger_reserved in self._execute(SQL_LEDGER_DRIFT).fetchall():
+                self._execute(SQL_RESET_BALANCES, (ledger_credits, ledger_reserved, user_id))
+                drift.append({'user_id': user_id, 'credits': credits, 'ledger_credits': ledger_credits,
+                              'reserved': reserved, 'ledger_reserved': ledger_reserved})
+        return {'released': released, 'drift': drift}
+
+    # Audit
+    def _audit(self, sql, params):
+        """Write to the audit file now, or after the current transaction commits"""
+        self._conn()
+        if self._local.depth:
+            self._local.pending_audit.append((sql, params))
+        else:
+            self._write_audit([(sql, params)])
+
+    def add_audit(self, user_id, action_type, details, created_at=None):
+        # Stamped now, not when a held row is written
+        self._audit(SQL_INSERT_AUDIT, (user_id, action_type, details, timestamp(created_at)))
+
+    def list_audit_logs(self, limit=200, since_id=None):
+        if since_id is not None:
+            cursor = self._audit_conn().execute(SQL_LIST_AUDIT_SINCE, (since_id, limit))
+        else:
+            cursor = self._audit_conn().execute(SQL_LIST_AUDIT, (limit,))
+        return Table([d[0] for d in cursor.description], cursor.fetchall())
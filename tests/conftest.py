@@ -0,0 +1,72 @@
+"""Shared fixtures.
+
+The gateway reads its configuration from the environment at import time, so
+every file it would write goes to a temporary directory before app.py is
+imported; the directory is removed when the run ends. STORAGE_BACKEND picks
+the backend the app tests run against (default sqlite); the storage contract
+tests run against both.
+"""
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Made at import rather than in a fixture: test modules import the gateway's
+# modules, which read these, during collection
+_DATA_DIR = tempfile.mkdtemp(prefix='gateway-tests-')
+atexit.register(shutil.rmtree, _DATA_DIR, ignore_errors=True)
+for _name, _file in (('DATABASE_PATH', 'command_gateway.db'), ('RATE_LIMIT_DB', 'rate_limits.db'),
+                     ('IDEMPOTENCY_DB', 'idempotency.db'), ('MAINTENANCE_DB', 'maintenance.db'),
+                     ('MAINTENANCE_BACKUP_DIR', 'backups')):
+    os.environ.setdefault(_name, os.path.join(_DATA_DIR, _file))
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+os.environ.setdefault('RULE_PROFILE_FLUSH_S', '3600')
+
+from storage import create_storage  # noqa: E402
+
+BACKENDS = ('sqlite', 'memory')
+
+
+def make_storage(backend, tmp_path):
+    storage = create_storage(backend, str(tmp_path / 'gateway.db'))
+    storage.init_schema()
+    return storage
+
+
+@pytest.fixture(params=BACKENDS)
+def storage(request, tmp_path):
+    storage = make_storage(request.param, tmp_path)
+    yield storage
+    storage.close()
+
+
+@pytest.fixture(scope='session')
+def gateway():
+    """app.py with its schema and seed data in place"""
+    import app
+    app.init_db()
+    app.seed_data()
+    return app
+
+
+@pytest.fixture
+def admin_key(gateway):
+    return gateway.storage.list_admins()[0]['api_key']
+
+
+@pytest.fixture
+def api(gateway, admin_key):
+    """call(method, path, json=None, key=admin_key) -> (status, parsed JSON body)"""
+    client = gateway.app.test_client()
+
+    def call(method, path, json=None, key=admin_key, headers=None):
+        response = client.open(path, method=method.upper(), json=json,
+                               headers=dict({'X-API-Key': key}, **(headers or {})))
+        return response.status_code, response.get_json(silent=True)
+    return call
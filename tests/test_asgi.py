@@ -0,0 +1,86 @@
+"""asgi.py startup, run in a subprocess against a database of its own"""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import ROOT
+
+# With CRASHED set, first leaves a command 'running' as a crashed server
+# would. Then starts the ASGI app through its lifespan and makes one request.
+SCRIPT = '''
+import asyncio, json, os, threading
+from storage import create_storage
+
+command_id = None
+if os.environ.get('CRASHED'):
+    old = create_storage('sqlite')
+    old.init_schema()
+    user_id = old.create_user('crashed', 'crashed-key', 'admin')
+    command_id = old.create_command(user_id, 'sleep 60', 'executed', execution_status='running')
+    old.close()
+
+import asgi
+
+async def main():
+    startup = asyncio.Queue()
+    await startup.put({'type': 'lifespan.startup'})
+    sent = []
+    async def send(message):
+        sent.append(message)
+    lifespan = asyncio.create_task(asgi.app({'type': 'lifespan'}, startup.get, send))
+    while not sent:
+        await asyncio.sleep(0.01)
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+    response = []
+    async def collect(message):
+        response.append(message)
+    key = asgi.gateway.storage.list_admins()[0]['api_key'].encode()
+    scope = {'type': 'http', 'method': 'GET', 'path': '/api/users', 'query_string': b'',
+             'headers': [(b'x-api-key', key)]}
+    await asgi.app(scope, receive, collect)
+    threads = {thread.name for thread in threading.enumerate()}
+    await startup.put({'type': 'lifespan.shutdown'})
+    await lifespan
+    return sent[0]['type'], response[0]['status'], threads
+
+startup, status, threads = asyncio.run(main())
+print(json.dumps({
+    'startup': startup,
+    'status': status,
+    'execution_status': command_id and asgi.gateway.storage.get_command(command_id)['execution_status'],
+    'maintenance': 'maintenance' in threads,
+    'rule_profile': 'rule-profile' in threads,
+}))
+'''
+
+
+def start(tmp_path, **env):
+    env = dict(os.environ, STORAGE_BACKEND='sqlite', PYTHONPATH=ROOT, MAINTENANCE_ENABLED='1', **env)
+    for name in ('DATABASE_PATH', 'RATE_LIMIT_DB', 'IDEMPOTENCY_DB', 'MAINTENANCE_DB'):
+        env[name] = str(tmp_path / f'{name.lower()}.db')
+    env['MAINTENANCE_BACKUP_DIR'] = str(tmp_path / 'backups')
+    result = subprocess.run([sys.executable, '-c', SCRIPT], cwd=tmp_path, env=env, capture_output=True, text=True,
+                            timeout=60)
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def test_lifespan_sets_up_a_fresh_database(tmp_path):
+    assert start(tmp_path) == {'startup': 'lifespan.startup.complete', 'status': 200, 'execution_status': None,
+                               'maintenance': True, 'rule_profile': True}
+
+
+def test_lifespan_recovers_interrupted_commands(tmp_path):
+    assert start(tmp_path, CRASHED='1')['execution_status'] == 'interrupted'
+
+
+def test_forked_workers_do_not_repeat_setup(gateway, monkeypatch):
+    # What a worker forked from a preloading master sees
+    monkeypatch.setattr(gateway, '_created', True)
+    monkeypatch.setattr(gateway.executor, 'recover', lambda: pytest.fail('recovered again'))
+    assert gateway.create_app() is gateway.app
@@ -0,0 +1,89 @@
+"""Sandbox mode: commands run as EXECUTION_USER and cannot reach the gateway's files"""
+import os
+import pwd
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import pytest
+
+import executor
+from executor import Executor
+from conftest import ROOT
+
+as_root = pytest.mark.skipif(os.geteuid() != 0 or not hasattr(pwd, 'getpwnam'), reason='switching users needs root')
+
+
+def test_refuses_to_start_without_a_sandbox_user(tmp_path):
+    env = dict(os.environ, EXECUTION_MODE='sandbox', EXECUTION_USER='', DATABASE_PATH=str(tmp_path / 'gateway.db'),
+               PYTHONPATH=ROOT)
+    result = subprocess.run([sys.executable, '-c', 'import app; app.create_app()'], cwd=tmp_path, env=env,
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode != 0
+    assert 'SandboxUnavailable: EXECUTION_USER is not set' in result.stderr
+
+
+@pytest.fixture
+def nobody(monkeypatch):
+    monkeypatch.setattr(executor, 'EXECUTION_USER', 'nobody')
+    return pwd.getpwnam('nobody')
+
+
+@pytest.fixture
+def data_dir():
+    # Directly in /tmp: pytest's own temporary directories are closed to other users
+    path = tempfile.mkdtemp()
+    open(os.path.join(path, 'gateway.db'), 'w').close()
+    yield path
+    shutil.rmtree(path)
+
+
+@as_root
+def test_refuses_files_the_sandbox_user_can_read(nobody, data_dir):
+    os.chmod(data_dir, 0o755)
+    with pytest.raises(executor.SandboxUnavailable, match='gateway.db'):
+        executor.check_sandbox([os.path.join(data_dir, 'gateway.db'), os.path.join(data_dir, 'backups')])
+    os.chmod(data_dir, 0o700)
+    assert executor.check_sandbox([os.path.join(data_dir, 'gateway.db')]) == (nobody.pw_uid, nobody.pw_gid)
+
+
+@as_root
+def test_commands_run_as_the_sandbox_user(nobody, data_dir):
+    output = []
+    assert executor.run_sandboxed('id -u', output.append) == ('succeeded', 0)
+    assert ''.join(output).strip() == str(nobody.pw_uid)
+    output = []
+    assert executor.run_sandboxed(f'cat {data_dir}/gateway.db', output.append)[0] == 'failed'
+    assert 'Permission denied' in ''.join(output)
+
+
+def queued_job(storage):
+    user_id = storage.create_user('runner', 'runner-key', 'member')
+    storage.create_command(user_id, 'echo hi', 'executed', execution_status='queued')
+    return Executor(storage)
+
+
+def test_claimed_commands_survive_another_servers_recovery(storage):
+    pool = queued_job(storage)
+    pool.owner = 'host-a:1'
+    job = pool._claim()
+    # A second server starting against the same database
+    assert Executor(storage).recover() == 0
+    assert storage.get_command(job['id'])['execution_status'] == 'running'
+
+
+def test_a_result_that_cannot_be_saved_fails_the_command(storage, monkeypatch):
+    pool = queued_job(storage)
+    pool.owner = 'host-a:1'
+    job = pool._claim()
+
+    def run(command_text, on_output):
+        on_output('hi\n')
+        return 'succeeded', 0
+    monkeypatch.setattr(executor, 'run_sandboxed', run)
+    monkeypatch.setattr(storage, 'add_audit', lambda *args: 1 / 0)
+    pool._run(job)
+    command = storage.get_command(job['id'])
+    assert (command['execution_status'], command['exit_code']) == ('failed', 0)
+    assert command['execution_output'] == 'hi\n\n[Could not record the result: division by zero]\n'
@@ -0,0 +1,132 @@
+"""API contracts that span several modules: idempotency, scoped rules, conditional GETs"""
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+
+
+def new_user(api, **fields):
+    """API key of a new member; extra fields go to POST /api/users"""
+    status, body = api('post', '/api/users', dict({'username': f'user-{uuid.uuid4().hex[:8]}', 'credits': 100}, **fields))
+    assert status == 201, body
+    return body['api_key']
+
+
+def submit(api, key, command, **headers):
+    return api('post', '/api/commands', {'command_text': command}, key=key, headers=headers)
+
+
+def test_idempotency_key_runs_a_command_once(gateway, api):
+    key = new_user(api)
+    first = submit(api, key, 'echo once', **{'Idempotency-Key': 'k1'})
+    assert first[0] == 200
+    assert submit(api, key, 'echo once', **{'Idempotency-Key': 'k1'}) == first
+    assert submit(api, key, 'echo twice', **{'Idempotency-Key': 'k1'})[0] == 422
+    user = gateway.storage.get_user_by_api_key(key)
+    assert user['credits'] == 99
+    assert [c['command_text'] for c in gateway.storage.list_commands(user['id']).dicts()] == ['echo once']
+
+
+def test_concurrent_duplicates_run_once(gateway, api):
+    key = new_user(api)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(submit(api, key, 'ls', **{'Idempotency-Key': 'k2'})))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len({result[1]['command_id'] for result in results}) == 1
+    user = gateway.storage.get_user_by_api_key(key)
+    assert len(gateway.storage.list_commands(user['id'])) == 1
+
+
+def test_scoped_rules_follow_precedence(api):
+    team = f'team{uuid.uuid4().hex[:6]}'
+    for pattern, action, scope in (('^shipit', 'AUTO_ACCEPT', f'team:{team}'),
+                                   ('^shipit', 'AUTO_REJECT', 'tier:senior'),
+                                   ('^(shipit|buildit)', 'AUTO_ACCEPT', 'tier:senior')):
+        status, body = api('post', '/api/rules', {'pattern': pattern, 'action': action, 'scope': scope})
+        assert status == 201, body
+    member = new_user(api, team=team, tier='senior')
+    senior = new_user(api, tier='senior')
+    junior = new_user(api)
+    assert submit(api, member, 'shipit now')[1]['status'] == 'executed'
+    assert submit(api, senior, 'shipit now')[1]['status'] == 'rejected'
+    assert submit(api, senior, 'buildit')[1]['status'] == 'executed'
+    assert submit(api, junior, 'buildit')[1]['status'] == 'rejected'
+
+
+def test_conditional_get(gateway, admin_key):
+    client = gateway.app.test_client()
+    headers = {'X-API-Key': admin_key}
+    first = client.get('/api/rules', headers=headers)
+    etag = first.headers['ETag']
+    assert client.get('/api/rules', headers=dict(headers, **{'If-None-Match': etag})).status_code == 304
+    client.post('/api/rules', headers=headers, json={'pattern': f'^etag{uuid.uuid4().hex[:6]}', 'action': 'AUTO_REJECT'})
+    assert client.get('/api/rules', headers=dict(headers, **{'If-None-Match': etag})).status_code == 200
+
+
+def test_import_reports_a_malformed_timezone(api):
+    status, body = api('post', '/api/rules/import', {'rules': [
+        {'pattern': f'^tz{uuid.uuid4().hex[:6]}', 'action': 'AUTO_REJECT', 'timezone': ['UTC']}]})
+    assert status == 400
+    assert body['errors'][0]['errors'] == ["Unknown timezone: ['UTC']"]
+
+
+def test_team_must_be_a_string(gateway, api):
+    assert api('post', '/api/users', {'username': f'user-{uuid.uuid4().hex[:8]}', 'team': 5}) == (
+        400, {'error': 'Invalid team name'})
+    status, body = api('post', '/api/users/bulk', [{'username': f'user-{uuid.uuid4().hex[:8]}', 'team': ['ops']}])
+    assert status == 400 and body['errors'][0]['error'] == 'Invalid team name'
+    user = gateway.storage.get_user_by_api_key(new_user(api))
+    assert api('put', f"/api/users/{user['id']}", {'team': {'name': 'ops'}}) == (400, {'error': 'Invalid team name'})
+
+
+def running_command(gateway, output):
+    user = gateway.storage.list_admins()[0]
+    command_id = gateway.storage.create_command(user['id'], 'sleep 60', 'executed', execution_status='running')
+    gateway.storage.update_command(command_id, {'execution_output': output})
+    return command_id
+
+
+def test_output_followers_are_capped(gateway, admin_key, monkeypatch):
+    client = gateway.app.test_client()
+    command_id = running_command(gateway, 'hello')
+    monkeypatch.setattr(gateway, 'stream_followers', threading.BoundedSemaphore(1))
+    monkeypatch.setattr(gateway, 'STREAM_FOLLOW_S', 0.3)
+    gateway.stream_followers.acquire()
+    busy = client.get(f'/api/commands/{command_id}/output?offset=2', headers={'X-API-Key': admin_key})
+    assert (busy.get_data(as_text=True), busy.headers['Retry-After'], busy.headers['X-Output-Offset']) == ('llo', '1', '5')
+    gateway.stream_followers.release()
+
+    # With a free slot the stream follows, ends after STREAM_FOLLOW_S and gives the slot back
+    followed = client.get(f'/api/commands/{command_id}/output', headers={'X-API-Key': admin_key})
+    assert followed.get_data(as_text=True) == 'hello' and 'Retry-After' not in followed.headers
+    followed.close()
+    assert gateway.stream_followers.acquire(blocking=False)
+
+
+def test_approval_token_runs_only_for_its_submitter(gateway, api):
+    owner_key, other_key = new_user(api), new_user(api)
+    owner = gateway.storage.get_user_by_api_key(owner_key)
+    token = f'token-{uuid.uuid4().hex}'
+    with gateway.storage.transaction():
+        command_id = gateway.storage.create_command(owner['id'], 'rm -rf /tmp/x', 'approved', approval_token=token)
+        gateway.storage.reserve_credits(owner['id'], command_id, 1)
+    status, body = api('post', '/api/commands', {'command_text': 'ls', 'approval_token': token}, key=other_key)
+    assert status == 403, body
+    assert gateway.storage.get_command(command_id)['status'] == 'approved'
+    assert gateway.storage.get_user_by_api_key(other_key)['credits'] == 100
+
+    status, body = api('post', '/api/commands', {'command_text': 'ls', 'approval_token': token}, key=owner_key)
+    assert status == 200, body
+    assert gateway.storage.get_user_by_api_key(owner_key)['credits'] == 99
+
+
+def test_analytics_defaults_to_the_last_24_utc_hours(api):
+    def hour(offset):
+        return (datetime.now(timezone.utc) + timedelta(hours=offset)).strftime('%Y-%m-%d %H:00')
+    before = (hour(-23), hour(1))
+    status, body = api('get', '/api/analytics')
+    assert status == 200, body
+    assert (body['since'], body['until']) in (before, (hour(-23), hour(1)))
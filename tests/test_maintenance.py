@@ -0,0 +1,25 @@
+"""Online backups: snapshot files and pruning"""
+import os
+
+import maintenance
+from conftest import make_storage
+
+
+def test_backup_is_a_single_file(tmp_path):
+    source = make_storage('sqlite', tmp_path)
+    source.create_user('admin', 'admin-key', 'admin')
+    target_dir = tmp_path / 'backups'
+    detail = maintenance.backup(str(tmp_path / 'gateway.db'), str(target_dir), keep=5)
+    assert maintenance.verify_backup(detail['file'])['ok']
+    assert os.listdir(target_dir) == [os.path.basename(detail['file'])]
+    source.close()
+
+
+def test_prune_removes_wal_siblings(tmp_path):
+    for stamp in ('20260101-000000', '20260102-000000', '20260103-000000'):
+        for suffix in ('.db', '.db-wal', '.db-shm'):
+            (tmp_path / f'gateway-{stamp}{suffix}').write_bytes(b'')
+    assert maintenance._prune(str(tmp_path), 'gateway', 1) == ['gateway-20260101-000000.db',
+                                                              'gateway-20260102-000000.db']
+    assert sorted(os.listdir(tmp_path)) == ['gateway-20260103-000000.db', 'gateway-20260103-000000.db-shm',
+                                            'gateway-20260103-000000.db-wal']
@@ -0,0 +1,57 @@
+import re
+import time
+
+import pytest
+
+import regex_guard
+from regex_guard import GuardedSearch, RegexTimeout, guarded_search
+from rule_engine import RuleMatcher
+
+needs_worker = pytest.mark.skipif(regex_guard.re2 is not None, reason='RE2 matches without the helper process')
+
+
+@pytest.mark.parametrize('pattern', [r'.*sudo.*', r'kubectl\s+delete\s+.*', r'^(ls|cat|pwd|echo)'])
+def test_everyday_patterns_run_inline(pattern):
+    assert guarded_search(pattern) is None
+
+
+def test_high_risk_patterns_are_guarded():
+    assert guarded_search(r'^(a+)+$') is not None
+
+
+@needs_worker
+def test_catastrophic_backtracking_times_out():
+    with pytest.raises(RegexTimeout):
+        GuardedSearch(r'^(a+)+$', timeout_ms=50)('a' * 40 + '!')
+
+
+@needs_worker
+def test_a_busy_helper_does_not_hold_up_other_matches():
+    search = GuardedSearch(r'^(a+)+$', timeout_ms=50)
+    search.warm()
+    busy = regex_guard._workers._idle.get()
+    try:
+        assert search('aaaa') is True
+    finally:
+        regex_guard._workers._idle.put(busy)
+
+
+@needs_worker
+def test_waiting_for_a_helper_is_bounded(monkeypatch):
+    monkeypatch.setattr(regex_guard, '_workers', regex_guard.RegexWorkerPool(1))
+    busy = regex_guard._workers._idle.get()
+    start = time.monotonic()
+    with pytest.raises(RegexTimeout):
+        GuardedSearch(r'^(a+)+$', timeout_ms=50)('aaaa')
+    assert time.monotonic() - start < 1
+    regex_guard._workers._idle.put(busy)
+
+
+@needs_worker
+def test_helper_errors_never_match(monkeypatch):
+    def fail(pattern, text, timeout):
+        raise re.error('rejected by the helper')
+    monkeypatch.setattr(regex_guard._workers, 'search', fail)
+    matcher = RuleMatcher([{'id': 1, 'pattern': r'^(a+)+$', 'action': 'AUTO_ACCEPT', 'time_start': None,
+                            'time_end': None, 'timezone': 'UTC'}], profiler=None)
+    assert matcher.match('aaaa') is None
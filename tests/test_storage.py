@@ -0,0 +1,297 @@
+"""The Storage contract (storage.py), run against every backend.
+
+test_backends_agree replays one scenario on both backends and compares the
+results, so a behavior only one backend has shows up even where no test
+below pins it down.
+"""
+import threading
+import time
+
+import pytest
+
+from conftest import BACKENDS, make_storage
+from storage import (COMMAND_LIST_COLUMNS, RULE_COLUMNS, USER_LIST_COLUMNS, InsufficientCredits, IntegrityError,
+                     change_timestamp)
+
+
+def add_user(storage, name='alice', credits=100, **fields):
+    return storage.create_user(name, f'key-{name}', 'member', credits=credits, **fields)
+
+
+def balances(storage, user_id):
+    user = storage.get_user(user_id)
+    return user['credits'], user['credits_reserved']
+
+
+def ledger_totals(storage, user_id):
+    entries = storage.credit_ledger(user_id, limit=10000).dicts()
+    return sum(e['available'] for e in entries), sum(e['reserved'] for e in entries)
+
+
+# Transactions and versions
+
+def test_transaction_rolls_back_everything(storage):
+    user_id = add_user(storage)
+    with pytest.raises(RuntimeError):
+        with storage.transaction():
+            storage.update_user(user_id, {'tier': 'lead'})
+            with storage.transaction():
+                add_user(storage, 'bob')
+                storage.bump_versions('users')
+            raise RuntimeError('abort')
+    assert storage.get_user(user_id)['tier'] == 'junior'
+    assert storage.user_ids_by_username(['bob']) == {}
+    assert storage.get_versions(('users',)) == (0,)
+
+
+def test_versions_count_bumps(storage):
+    storage.bump_versions('users', 'rules')
+    storage.bump_versions('rules')
+    assert storage.get_versions(('users', 'rules', 'pending')) == (1, 2, 0)
+
+
+# Users
+
+def test_users(storage):
+    user_id = add_user(storage, email='a@example.com', team='payments')
+    user = storage.get_user(user_id)
+    assert user == storage.get_user_by_api_key('key-alice')
+    assert (user['credits'], user['tier'], user['team']) == (100, 'junior', 'payments')
+    with pytest.raises(IntegrityError):
+        storage.create_user('alice', 'other-key', 'member')
+    with pytest.raises(IntegrityError):
+        storage.create_user('carol', 'key-alice', 'member')
+
+    listing = storage.list_users()
+    assert listing.columns == list(USER_LIST_COLUMNS) and 'api_key' not in listing.columns
+
+    storage.update_user(user_id, {'tier': 'lead', 'team': None, 'credits': 40})
+    assert (storage.get_user(user_id)['tier'], storage.get_user(user_id)['team']) == ('lead', None)
+    assert ledger_totals(storage, user_id) == balances(storage, user_id) == (40, 0)
+
+
+def test_create_users_is_atomic(storage):
+    add_user(storage, 'bob')
+    rows = [('carol', 'k1', 'member', 5, 'mid', None, None, None), ('bob', 'k2', 'member', 5, 'mid', None, None, None)]
+    with pytest.raises(IntegrityError):
+        storage.create_users(rows)
+    assert storage.user_ids_by_username(['carol']) == {}
+
+
+def test_delete_user_keeps_audit_trail(storage):
+    user_id = add_user(storage)
+    storage.create_command(user_id, 'ls', 'executed')
+    storage.add_audit(user_id, 'command_executed', 'ls')
+    storage.delete_user(user_id)
+    assert storage.get_user(user_id) is None
+    assert len(storage.list_commands()) == 0
+    assert [(log['user_id'], log['details']) for log in storage.list_audit_logs().dicts()] == [(None, 'ls')]
+
+
+# Rules
+
+def test_rules_keep_order_and_scope(storage):
+    storage.create_rule('^ls', 'AUTO_ACCEPT')
+    storage.create_rules([('^deploy', 'AUTO_REJECT', '', 1, None, None, 'UTC', None, 'team:ops'),
+                          ('^make', 'AUTO_ACCEPT', '', 1, None, None, 'UTC', None, 'global')])
+    rules = storage.list_rules()
+    assert rules.columns == list(RULE_COLUMNS)
+    assert [(r['pattern'], r['scope']) for r in rules.dicts()] == [
+        ('^ls', 'global'), ('^deploy', 'team:ops'), ('^make', 'global')]
+    assert [r['pattern'] for r in storage.list_rules('global').dicts()] == ['^ls', '^make']
+
+    deploy = storage.list_rules('team:ops').dicts()[0]
+    storage.update_rules([(deploy['id'], 'REQUIRE_APPROVAL', 'd', 2, '09:00', '17:00', 'UTC')])
+    assert storage.get_rule(deploy['id'])['action'] == 'REQUIRE_APPROVAL'
+    assert storage.get_rule(deploy['id'])['scope'] == 'team:ops'
+    storage.delete_rule(deploy['id'])
+    assert storage.get_rule(deploy['id']) is None
+    storage.delete_all_rules()
+    assert len(storage.list_rules()) == 0
+
+
+def test_rule_stats_accumulate(storage):
+    rule_id = storage.create_rule('^ls', 'AUTO_ACCEPT')
+    other_id = storage.create_rule('^l', 'AUTO_ACCEPT')
+    storage.add_rule_stats([(rule_id, 2, 1, 0, 100, 60, '2024-01-01 00:00:00')], [(other_id, rule_id, 1)])
+    storage.add_rule_stats([(rule_id, 1, 1, 0, 50, 50, '2024-01-02 00:00:00')], [(other_id, rule_id, 2)])
+    stats = {row['id']: row for row in storage.rule_stats().dicts()}
+    assert [stats[rule_id][c] for c in ('evaluations', 'matches', 'total_ns', 'max_ns', 'last_match_at')] == [
+        3, 2, 150, 60, '2024-01-02 00:00:00']
+    assert stats[other_id]['evaluations'] == 0
+    assert storage.rule_shadows().dicts() == [{'rule_id': other_id, 'shadowed_by': rule_id, 'samples': 3}]
+    storage.reset_rule_stats()
+    assert storage.rule_stats().dicts()[0]['matches'] == 0 and len(storage.rule_shadows()) == 0
+
+
+# Commands, votes and the execution queue
+
+def test_commands_newest_first(storage):
+    user_id = add_user(storage)
+    ids = [storage.create_command(user_id, f'echo {i}', 'executed', created_at=f'2024-01-01 00:00:0{i}')
+           for i in range(3)]
+    listing = storage.list_commands(user_id)
+    assert listing.columns == list(COMMAND_LIST_COLUMNS)
+    assert [c['id'] for c in listing.dicts()] == ids[::-1]
+    assert [c['id'] for c in storage.list_commands(since_id=ids[0]).dicts()] == ids[:0:-1]
+    assert storage.list_commands().dicts()[0]['username'] == 'alice'
+
+
+def test_delta_sync(storage):
+    user_id = add_user(storage)
+    command_id = storage.create_command(user_id, 'ls', 'pending')
+    time.sleep(0.01)
+    since = change_timestamp()
+    storage.update_command(command_id, {'execution_output': 'partial'})
+    assert len(storage.list_commands(updated_since=since)) == 0
+    assert len(storage.list_users(updated_since=since)) == 0
+    time.sleep(0.01)
+    storage.update_user(user_id, {'tier': 'mid'})
+    storage.cast_vote(command_id, user_id, 'approve')
+    assert [u['id'] for u in storage.list_users(updated_since=since).dicts()] == [user_id]
+    assert [c['id'] for c in storage.list_commands(updated_since=since).dicts()] == [command_id]
+
+
+def test_pending_votes(storage):
+    user_id = add_user(storage)
+    approver_id = add_user(storage, 'bob')
+    rule_id = storage.create_rule('^deploy', 'REQUIRE_APPROVAL', approval_threshold=2)
+    command_id = storage.create_command(user_id, 'deploy', 'pending', matched_rule_id=rule_id)
+    storage.cast_vote(command_id, approver_id, 'reject')
+    storage.cast_vote(command_id, approver_id, 'approve')  # changes the vote
+    assert (storage.count_votes(command_id, 'approve'), storage.count_votes(command_id, 'reject')) == (1, 0)
+    pending = storage.list_pending(default_threshold=3).dicts()
+    assert [(p['id'], p['approval_count'], p['approval_threshold'], p['username']) for p in pending] == [
+        (command_id, 1, 2, 'alice')]
+
+
+def test_execution_queue(storage):
+    user_id = add_user(storage, tier='mid')
+    first = storage.create_command(user_id, 'ls', 'approved', execution_status='queued')
+    storage.create_command(user_id, 'pwd', 'approved', execution_status='queued')
+    assert [(c['id'], c['tier']) for c in storage.queued_commands(1)] == [(first, 'mid')]
+    storage.update_command(first, {'execution_status': 'running'})
+    assert (storage.running_counts(), storage.count_queued()) == ({user_id: 1}, 1)
+    assert storage.interrupt_running('2024-01-01 00:00:00') == 1
+    assert storage.get_command(first)['execution_status'] == 'interrupted'
+    assert storage.running_counts() == {}
+
+
+def test_leased_commands_are_not_interrupted(storage):
+    user_id = add_user(storage)
+    live, expired, dropped = (storage.create_command(user_id, 'ls', 'approved', execution_status='running')
+                              for _ in range(3))
+    storage.lease_commands('host-a:1', [live, dropped], 60)
+    storage.lease_commands('host-b:2', [expired], -1)
+    storage.lease_commands('host-a:1', [live], 60)  # Finished with dropped
+    assert storage.interrupt_running('2024-01-01 00:00:00') == 2
+    assert [storage.get_command(c)['execution_status'] for c in (live, expired, dropped)] == [
+        'running', 'interrupted', 'interrupted']
+
+
+def test_blobs_are_stored_once(storage):
+    storage.put_blob('abc', 3, 'raw', b'abc')
+    storage.put_blob('abc', 3, 'raw', b'xyz')
+    assert storage.get_blob('abc')['data'] == b'abc'
+    assert set(storage.get_blobs(['abc', 'missing'])) == {'abc'}
+    assert storage.blob_stats() == {'blobs': 1, 'bytes': 3, 'stored_bytes': 3}
+
+
+# Credit ledger
+
+def test_reserve_capture_release(storage):
+    user_id = add_user(storage, credits=10)
+    held = storage.create_command(user_id, 'deploy', 'pending')
+    dropped = storage.create_command(user_id, 'deploy 2', 'pending')
+    assert storage.reserve_credits(user_id, held, 4) == 6
+    assert storage.reserve_credits(user_id, dropped, 3) == 3
+    with pytest.raises(InsufficientCredits):
+        storage.reserve_credits(user_id, dropped, 4)
+    assert balances(storage, user_id) == (3, 7)
+
+    assert storage.capture_credits(user_id, held, 4) == 3
+    assert storage.release_credits(dropped, 'rejected') == 3
+    assert storage.release_credits(dropped) == 0
+    assert balances(storage, user_id) == ledger_totals(storage, user_id) == (6, 0)
+    assert [e['entry_type'] for e in storage.credit_ledger(user_id).dicts()] == [
+        'release', 'capture', 'reserve', 'reserve', 'grant']
+
+
+def test_reconcile_releases_orphaned_reservations(storage):
+    user_id = add_user(storage, credits=10)
+    command_id = storage.create_command(user_id, 'deploy', 'pending')
+    storage.reserve_credits(user_id, command_id, 5)
+    storage.set_command_status(command_id, 'rejected')
+    result = storage.reconcile_credits()
+    assert result == {'released': [{'command_id': command_id, 'user_id': user_id, 'amount': 5}], 'drift': []}
+    assert balances(storage, user_id) == (10, 0)
+    assert storage.reconcile_credits() == {'released': [], 'drift': []}
+
+
+def test_concurrent_reservations_never_overdraw(storage):
+    user_id = add_user(storage, credits=20)
+    command_ids = [storage.create_command(user_id, f'job {i}', 'pending') for i in range(40)]
+    outcomes = []
+
+    def reserve(command_id):
+        try:
+            storage.reserve_credits(user_id, command_id, 1)
+            outcomes.append(True)
+        except InsufficientCredits:
+            outcomes.append(False)
+
+    threads = [threading.Thread(target=reserve, args=(command_id,)) for command_id in command_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert outcomes.count(True) == 20
+    assert balances(storage, user_id) == ledger_totals(storage, user_id) == (0, 20)
+
+
+# Both backends
+
+def _scenario(storage):
+    """Exercise most of the interface; returns everything observable, minus timestamps"""
+    alice = add_user(storage, credits=50, tier='mid', team='payments')
+    bob = add_user(storage, 'bob', credits=5)
+    storage.create_rule('^ls', 'AUTO_ACCEPT')
+    storage.create_rule('^deploy', 'REQUIRE_APPROVAL', approval_threshold=2, scope='team:payments')
+    executed = storage.create_command(alice, 'ls', 'executed', credits_deducted=1, created_at='2024-01-01 10:00:00')
+    storage.capture_credits(alice, executed, 1)
+    pending = storage.create_command(alice, 'deploy', 'pending', matched_rule_id=2, created_at='2024-01-01 10:30:00')
+    storage.reserve_credits(alice, pending, 5)
+    storage.cast_vote(pending, bob, 'approve')
+    try:
+        storage.reserve_credits(bob, pending, 50)
+    except InsufficientCredits:
+        pass
+    storage.update_credits([(bob, 3)], add=True)
+    storage.update_user(alice, {'tier': 'lead'})
+    storage.bump_versions('users', 'rules:team:payments')
+    storage.add_audit(alice, 'command_executed', 'ls')
+
+    def rows(table, drop=('created_at', 'updated_at', 'executed_at')):
+        return [{k: v for k, v in row.items() if k not in drop} for row in table.dicts()]
+    return {
+        'users': rows(storage.list_users()),
+        'rules': rows(storage.list_rules()),
+        'commands': rows(storage.list_commands()),
+        'pending': rows(storage.list_pending(3)),
+        'ledger': rows(storage.credit_ledger()),
+        'usage': rows(storage.usage_by_user('2024-01-01 00:00', '2024-01-02 00:00')),
+        'usage_by_rule': rows(storage.usage_by_rule('2024-01-01 00:00', '2024-01-02 00:00')),
+        'audit': rows(storage.list_audit_logs()),
+        'versions': storage.get_versions(('users', 'rules:team:payments', 'rules:global')),
+        'reconcile': storage.reconcile_credits(),
+    }
+
+
+def test_backends_agree(tmp_path):
+    results = {}
+    for backend in BACKENDS:
+        (tmp_path / backend).mkdir()
+        storage = make_storage(backend, tmp_path / backend)
+        results[backend] = _scenario(storage)
+        storage.close()
+    assert results['sqlite'] == results['memory']